@@ -1,7 +1,5 @@
 import json
-import base64
 import asyncio
-import websockets
 
 from langchain.base_language import BaseLanguageModel
 from langchain.callbacks.manager import AsyncCallbackManagerForChainRun
@@ -12,17 +10,21 @@ from pydantic import Extra
 from typing import List
 from typing import Dict
 from typing import Any
+from typing import Callable
 from typing import Optional
 
-import global_var
-
-from assistant.utils import socket_no_proxy
+from assistant.server.protocol import ContentType
+from assistant.server.session import ServerException, SwitcherSession, get_session
 
 
 class ChatBotChain(Chain):
     prompt: BasePromptTemplate
     llm: BaseLanguageModel
     output_key: str = 'json_text'
+    # 与服务器之间的长连接会话, 为空时使用当前事件循环共享的会话
+    session: Optional[SwitcherSession] = None
+    # 流式上传的音频每得到一次中间识别结果就调用一次, 参数为当前的识别文本
+    on_partial: Optional[Callable[[str], Any]] = None
 
     class Config:
         extra = Extra.forbid
@@ -46,8 +48,8 @@ class ChatBotChain(Chain):
         run_manager: Optional[CallbackManagerForChainRun] = None,
     ) -> Dict[str, Any]:
         loop = asyncio.get_event_loop()
-        tasks = asyncio.gather(audios_to_text(inputs['audios']),
-                               images_to_text(inputs['images'])
+        tasks = asyncio.gather(audios_to_text(inputs['audios'], self.session, self.on_partial),
+                               images_to_text(inputs['images'], self.session)
                                )
         audios, images = loop.run_until_complete(tasks)
         inputs['images'] = images
@@ -70,8 +72,8 @@ class ChatBotChain(Chain):
     ) -> Dict[str, Any]:
 
         audios, images = await asyncio.gather(
-            audios_to_text(inputs['audios']),
-            images_to_text(inputs['images'])
+            audios_to_text(inputs['audios'], self.session, self.on_partial),
+            images_to_text(inputs['images'], self.session)
         )
         inputs['images'] = images
         inputs['audios'] = audios
@@ -86,215 +88,84 @@ class ChatBotChain(Chain):
         return {self.output_key: response.generations[0][0].text}
 
 
-class ServerException(Exception):
-    pass
-
-
-async def audios_to_text(audio_list: list):
-    # 处理音频
-    text_list_from_audios = []
-
-    async def send_and_recv():
-        async with websockets.connect(f'ws://{global_var.ip}:{global_var.port}/',
-                                      max_size=10 * 1024 * 1024) as websocket:
-            for audio in audio_list:
-                audio_content = audio.read()
-                audio.close()
-                encoded_audio = base64.b64encode(audio_content).decode()
-                message = {
-                    'from': 'CLIENT.STT',
-                    'to': 'STT',
-                    'content': encoded_audio
-                }
-                message = json.dumps(message)
-                await websocket.send(message)
-
-                recv = await websocket.recv()
-                recv = json.loads(recv)
-                if recv.get('status') == 404:
-                    global_var.logger.error(f'服务器后端出错：\n{recv}')
-
-                    raise ServerException()
-                else:
-                    text_list_from_audios.append(recv['content'])
-
-    if global_var.run_local_mode:
-        with socket_no_proxy():
-            await send_and_recv()
-    else:
-        await send_and_recv()
-
-    return text_list_from_audios
-
-
-async def images_to_text(images_list: list):
-    # 处理图片
-    text_list_from_images = []
-
-    async def send_and_recv():
-        async with websockets.connect(f'ws://{global_var.ip}:{global_var.port}/',
-                                      max_size=10 * 1024 * 1024) as websocket:
-            for image in images_list:
-                image_content = image.read()
-                image.close()
-                encoded_image = base64.b64encode(image_content).decode()
-                message = {
-                    'from': 'CLIENT.ITT',
-                    'to': 'ITT',
-                    'content': encoded_image
-                }
-                message = json.dumps(message)
-                await websocket.send(message)
-
-                recv = await websocket.recv()
-                recv = json.loads(recv)
-                if recv.get('status') == 404:
-                    global_var.logger.error(f'服务器后端出错：\n{recv}')
-
-                    raise ServerException()
-                else:
-                    for i in recv['content']:
-                        text_list_from_images.append(i)
-
-    if global_var.run_local_mode:
-        with socket_no_proxy():
-            await send_and_recv()
-    else:
-        await send_and_recv()
-    return text_list_from_images
-
-
-async def text_to_audio(text: str):
+async def audios_to_text(
+        audio_list: list,
+        session: Optional[SwitcherSession] = None,
+        on_partial: Optional[Callable[[str], Any]] = None
+):
+    # 处理音频, 文件一起发出, 按请求id收集结果
+    # 异步迭代的音频(正在上传的PCM块)边上传边识别, 图片等其他输入的处理不必等上传结束
+    session = session or get_session()
+    audio_contents = {}
+    streams = {}
+    for i, audio in enumerate(audio_list):
+        if hasattr(audio, '__aiter__'):
+            streams[i] = audio
+            continue
+        audio_contents[i] = audio.read()
+        audio.close()
+
+    responses, texts = await asyncio.gather(
+        session.request_many('STT', ContentType.audio, list(audio_contents.values())),
+        asyncio.gather(*[audio_stream_to_text(stream, session=session, on_partial=on_partial)
+                         for stream in streams.values()])
+    )
+    # 结果与输入顺序一致
+    results = dict(zip(audio_contents, [response.text() for response in responses]))
+    results.update(zip(streams, texts))
+    return [results[i] for i in range(len(audio_list))]
+
+
+async def audio_stream_to_text(
+        chunks,
+        sampling_rate: int = 16000,
+        dtype: str = 'int16',
+        session: Optional[SwitcherSession] = None,
+        on_partial: Optional[Callable[[str], Any]] = None
+) -> str:
+    # 流式识别: chunks异步产生单声道PCM音频块, 返回最终的识别文本
+    session = session or get_session()
+    meta = {'stream': True, 'sampling_rate': sampling_rate, 'dtype': dtype}
+    text = ''
+    async for response in session.stream('STT', ContentType.audio, chunks, meta):
+        if not response.partial:
+            text = response.text()
+        elif on_partial is not None:
+            on_partial(response.text())
+    return text
+
+
+async def images_to_text(images_list: list, session: Optional[SwitcherSession] = None):
     # 处理图片
-    recv_list = []
+    session = session or get_session()
+    image_contents = []
+    for image in images_list:
+        image_contents.append(image.read())
+        image.close()
 
-    async def send_and_recv():
-        async with websockets.connect(f'ws://{global_var.ip}:{global_var.port}/',
-                                      max_size=10 * 1024 * 1024) as websocket:
-            message = {
-                'from': 'CLIENT.TTS',
-                'to': 'TTS',
-                'content': text
-            }
-            message = json.dumps(message)
-            await websocket.send(message)
+    responses = await session.request_many('ITT', ContentType.image, image_contents)
+    return [text for response in responses for text in response.json()]
 
-            recv = await websocket.recv()
-            recv = json.loads(recv)
-            if recv.get('status') == 404:
-                global_var.logger.error(f'服务器后端出错：\n{recv}')
 
-                raise ServerException()
-            else:
-                recv['content']['speech_value'] = base64.b64decode(recv['content']['speech_value'].encode())
-                recv_list.append(recv)
+async def text_to_audio(text: str, session: Optional[SwitcherSession] = None):
+    session = session or get_session()
+    response = await session.request('TTS', ContentType.text, text.encode('utf-8'))
+    return response.payload, response.meta['sampling_rate']
 
-    if global_var.run_local_mode:
-        with socket_no_proxy():
-            await send_and_recv()
-    else:
-        await send_and_recv()
-    return recv_list[0]['content']['speech_value'], recv_list[0]['content']['sampling_rate']
 
+async def text_to_image(text: str, session: Optional[SwitcherSession] = None):
+    session = session or get_session()
+    response = await session.request('TTI', ContentType.text, text.encode('utf-8'))
+    return response.payload
 
-async def text_to_image(text: str):
-    # 处理图片
-    recv_list = []
-
-    async def send_and_recv():
-        async with websockets.connect(f'ws://{global_var.ip}:{global_var.port}/',
-                                      max_size=10 * 1024 * 1024) as websocket:
-            message = {
-                'from': 'CLIENT.TTI',
-                'to': 'TTI',
-                'content': text
-            }
-            message = json.dumps(message)
-            await websocket.send(message)
-
-            recv = await websocket.recv()
-            recv = json.loads(recv)
-            if recv.get('status') == 404:
-                global_var.logger.error(f'服务器后端出错：\n{recv}')
-
-                raise ServerException()
-            else:
-                recv['content'] = base64.b64decode(recv['content'].encode())
-                recv_list.append(recv)
-
-    if global_var.run_local_mode:
-        with socket_no_proxy():
-            await send_and_recv()
-    else:
-        await send_and_recv()
-    return recv_list[0]['content']
-
-
-async def text_to_video(text: str):
-    # 处理图片
-    recv_list = []
-
-    async def send_and_recv():
-        async with websockets.connect(f'ws://{global_var.ip}:{global_var.port}/',
-                                      max_size=10 * 1024 * 1024) as websocket:
-            message = {
-                'from': 'CLIENT.TTV',
-                'to': 'TTV',
-                'content': text
-            }
-            message = json.dumps(message)
-            await websocket.send(message)
-
-            recv = await websocket.recv()
-            recv = json.loads(recv)
-            if recv.get('status') == 404:
-                global_var.logger.error(f'服务器后端出错：\n{recv}')
-
-                raise ServerException()
-            else:
-                recv['content'] = base64.b64decode(recv['content'].encode())
-                recv_list.append(recv)
-
-    if global_var.run_local_mode:
-        with socket_no_proxy():
-            await send_and_recv()
-    else:
-        await send_and_recv()
-    return recv_list[0]['content']
-
-
-async def image_to_image(prompt: str, image: bytes):
-    # 处理图片
-    recv_list = []
-
-    async def send_and_recv():
-        async with websockets.connect(f'ws://{global_var.ip}:{global_var.port}/',
-                                      max_size=10 * 1024 * 1024) as websocket:
-            image_ = base64.b64encode(image).decode()
-            message = {
-                'from': 'CLIENT.ITI',
-                'to': 'ITI',
-                'content': {
-                    'prompt': prompt,
-                    'image': image_
-                }
-            }
-            message = json.dumps(message)
-            await websocket.send(message)
 
-            recv = await websocket.recv()
-            recv = json.loads(recv)
-            if recv.get('status') == 404:
-                global_var.logger.error(f'服务器后端出错：\n{recv}')
+async def text_to_video(text: str, session: Optional[SwitcherSession] = None):
+    session = session or get_session()
+    response = await session.request('TTV', ContentType.text, text.encode('utf-8'))
+    return response.payload
 
-                raise ServerException()
-            else:
-                recv['content'] = base64.b64decode(recv['content'].encode())
-                recv_list.append(recv)
 
-    if global_var.run_local_mode:
-        with socket_no_proxy():
-            await send_and_recv()
-    else:
-        await send_and_recv()
-    return recv_list[0]['content']
+async def image_to_image(prompt: str, image: bytes, session: Optional[SwitcherSession] = None):
+    session = session or get_session()
+    response = await session.request('ITI', ContentType.image, image, {'prompt': prompt})
+    return response.payload
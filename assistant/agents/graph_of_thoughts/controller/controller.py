@@ -1,12 +1,16 @@
 import json
+import time
+import asyncio
 import logging
 
-from typing import List
+from typing import List, Dict, Callable, Iterable, Optional
 
 from assistant.agents.graph_of_thoughts.parser import Parser
 from assistant.agents.prompts.prompter import Prompter
-from assistant.agents.graph_of_thoughts.operations import GraphOfOperations, Thought
-from assistant.llm.language_models import AbstractLanguageModel
+from assistant.agents.graph_of_thoughts.operations import GraphOfOperations, Operation, Thought, Score, ScoreMemo
+from assistant.llm.rate_limiter import AsyncRateLimiter
+from assistant.llm.telemetry import CallMetrics, track, write_chrome_trace
+from assistant.llm.abstract_language_model import AbstractLanguageModel
 
 
 class Controller:
@@ -25,11 +29,135 @@ class Controller:
         self.parser = parser
         self.problem_parameters = problem_parameter
         self.run_executed = False
+        # 同一次运行中所有开启memo的Score操作共享打分缓存
+        self.score_memo = ScoreMemo()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        # 满足停止条件的思维, 以及流式执行中因操作饱和或提前停止而取消的任务数
+        self.stopped_early = False
+        self.stop_thought: Optional[Thought] = None
+        self.cancelled_tasks = 0
+
+    def share_score_memo(self) -> None:
+        for operation in self.graph.operations:
+            if isinstance(operation, Score) and operation.memoize and operation.memo is None:
+                operation.memo = self.score_memo
+
+    def scoring_stats(self) -> Dict:
+        stats = {'lm_calls': 0, 'lm_calls_saved': 0, 'prompt_tokens_saved': 0, 'memo_hits': 0}
+        for operation in self.graph.operations:
+            if isinstance(operation, Score):
+                for key, value in operation.scoring_stats().items():
+                    stats[key] += value
+        return stats
+
+    def operation_metrics(self) -> List[Dict]:
+        return [
+            operation.metrics_dict()
+            for operation in self.graph.operations
+            if operation.executed
+        ]
+
+    def metrics(self) -> Dict:
+        operations = self.operation_metrics()
+        totals = {
+            key: sum(operation[key] for operation in operations)
+            for key in CallMetrics.fields
+        }
+        wall_time = 0.0
+        if self.started_at is not None and self.finished_at is not None:
+            wall_time = self.finished_at - self.started_at
+        return {
+            'wall_time': wall_time,
+            'cost': self.lm.cost,
+            'stopped_early': self.stopped_early,
+            'cancelled_tasks': self.cancelled_tasks,
+            'totals': totals,
+            'prompt_cache': self.prompt_cache_stats(totals),
+            'operations': operations,
+        }
+
+    def prompt_cache_stats(self, totals: Optional[Dict] = None) -> Dict:
+        # 本次运行中重复发送的前缀token数(估计)与提供方实际命中缓存的token数
+        if totals is None:
+            totals = self.metrics()['totals']
+        prompt_tokens = totals['prompt_tokens']
+        return {
+            'reused_prefix_tokens': totals['reused_prefix_tokens'],
+            'cached_prompt_tokens': totals['cached_prompt_tokens'],
+            'cached_ratio': totals['cached_prompt_tokens'] / prompt_tokens if prompt_tokens else 0.0,
+        }
+
+    def export_metrics(self, path: str) -> None:
+        with open(path, 'w') as file:
+            file.write(json.dumps(self.metrics(), indent=2))
+
+    def export_trace(self, path: str) -> None:
+        # 导出为Chrome trace事件文件, 可以在 chrome://tracing 或 Perfetto 中查看各操作的耗时和重叠情况
+        assert self.run_executed, "The run method has not been executed"
+        spans = [
+            {
+                'name': 'run',
+                'cat': 'controller',
+                'start': self.started_at,
+                'end': self.finished_at,
+                'args': self.metrics()['totals'],
+            }
+        ]
+        for operation in self.graph.operations:
+            if operation.started_at is None or operation.finished_at is None:
+                continue
+            spans.append({
+                'name': f"{operation.operation_type.name} #{operation.id}",
+                'start': operation.started_at,
+                'end': operation.finished_at,
+                'args': operation.metrics_dict(),
+            })
+        write_chrome_trace(path, spans, process_name=self.__class__.__name__)
+
+    def should_stop(
+            self,
+            thoughts: Iterable[Thought],
+            stop_when: Optional[Callable[[Thought], bool]]
+    ) -> bool:
+        if stop_when is None or self.stopped_early:
+            return self.stopped_early
+        for thought in thoughts:
+            if stop_when(thought):
+                self.logger.info(f"Thought {thought.id} satisfies the stop condition, stopping")
+                self.stopped_early = True
+                self.stop_thought = thought
+                return True
+        return False
+
+    def run(
+            self,
+            parallel: bool = False,
+            max_concurrency: int = 16,
+            streaming: bool = False,
+            stop_when: Optional[Callable[[Thought], bool]] = None
+    ) -> None:
+        # stop_when: 任一操作产生满足条件的思维时停止运行, 例如 lambda thought: thought.solved
+        # parallel/streaming 会新建事件循环, 在已经运行的事件循环中(如异步服务, Jupyter)请用 await controller.arun(...)
+        if parallel or streaming:
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                pass
+            else:
+                raise RuntimeError(
+                    "Controller.run(parallel=True) and run(streaming=True) cannot be called from a running "
+                    "event loop; use 'await controller.arun(max_concurrency, streaming, stop_when)' instead"
+                )
+            asyncio.run(self.arun(max_concurrency, streaming, stop_when))
+            return
+            return
 
-    def run(self) -> None:
         self.logger.debug("Checking that the program is in a valid state")
         assert self.graph.roots is not None, "The operations graph has no root"
         self.logger.debug("The program is in a valid state")
+        self.share_score_memo()
+        self.started_at = time.perf_counter()
 
         execution_queue = [
             operation
@@ -44,6 +172,8 @@ class Controller:
                 self.lm, self.prompter, self.parser, **self.problem_parameters
             )
             self.logger.info(f"Operation {current_operation.operation_type} executed")
+            if self.should_stop(current_operation.get_thoughts(), stop_when):
+                break
             for operation in current_operation.successors:
                 assert (
                     operation in self.graph.operations
@@ -51,6 +181,222 @@ class Controller:
                 if operation.can_be_executed():
                     execution_queue.append(operation)
 
+        self.finished_at = time.perf_counter()
+        self.logger.info("All operation executed")
+        self.run_executed = True
+
+    async def arun(
+            self,
+            max_concurrency: int = 16,
+            streaming: bool = False,
+            stop_when: Optional[Callable[[Thought], bool]] = None
+    ) -> None:
+        if streaming:
+            await self.astream(max_concurrency, stop_when)
+            return
+
+        self.logger.debug("Checking that the program is in a valid state")
+        assert self.graph.roots is not None, "The operations graph has no root"
+        self.logger.debug("The program is in a valid state")
+        self.share_score_memo()
+        self.started_at = time.perf_counter()
+
+        # 所有前驱都执行完的操作立即并发执行, 所有操作共享同一个语言模型并发上限
+        limiter = AsyncRateLimiter(max_concurrency)
+        scheduled = set()
+        running = {}
+
+        def schedule(operations) -> None:
+            for operation in operations:
+                assert (
+                    operation in self.graph.operations
+                ), "The successor of an operation is not in the operations graph"
+                if operation.id in scheduled or not operation.can_be_executed():
+                    continue
+                scheduled.add(operation.id)
+                self.logger.info(f"Executing operation {operation.operation_type}")
+                task = asyncio.create_task(operation.aexecute(
+                    self.lm, self.prompter, self.parser, limiter, **self.problem_parameters
+                ))
+                running[task] = operation
+
+        schedule(self.graph.operations)
+
+        try:
+            while running:
+                done, _ = await asyncio.wait(running.keys(), return_when=asyncio.FIRST_COMPLETED)
+                # 按操作id处理完成的任务, 使后继的调度顺序与完成时机无关
+                for task in sorted(done, key=lambda task: running[task].id):
+                    operation = running.pop(task)
+                    task.result()
+                    self.logger.info(f"Operation {operation.operation_type} executed")
+                    if self.should_stop(operation.get_thoughts(), stop_when):
+                        break
+                    schedule(operation.successors)
+                if self.stopped_early:
+                    break
+        finally:
+            for task in running:
+                task.cancel()
+            if running:
+                await asyncio.gather(*running.keys(), return_exceptions=True)
+
+        self.finished_at = time.perf_counter()
+        self.logger.info("All operation executed")
+        self.run_executed = True
+
+    def exclusive_ancestors(self, operation: Operation) -> List[Operation]:
+        # 所有后继都只通向该操作的上游操作, 它们的输出只会被该操作使用
+        ancestors = []
+        frontier = list(operation.predecessors)
+        while frontier:
+            ancestor = frontier.pop()
+            if ancestor not in ancestors:
+                ancestors.append(ancestor)
+                frontier.extend(ancestor.predecessors)
+
+        exclusive = {operation.id}
+        changed = True
+        while changed:
+            changed = False
+            for ancestor in ancestors:
+                if ancestor.id not in exclusive and all(
+                        successor.id in exclusive for successor in ancestor.successors
+                ):
+                    exclusive.add(ancestor.id)
+                    changed = True
+        return [ancestor for ancestor in ancestors if ancestor.id in exclusive]
+
+    async def astream(
+            self,
+            max_concurrency: int = 16,
+            stop_when: Optional[Callable[[Thought], bool]] = None
+    ) -> None:
+        self.logger.debug("Checking that the program is in a valid state")
+        assert self.graph.roots is not None, "The operations graph has no root"
+        self.logger.debug("The program is in a valid state")
+        self.share_score_memo()
+        self.started_at = time.perf_counter()
+
+        # 流式执行: 可流式处理的操作每收到一个前驱思维就立即处理, 产生的思维马上传给后继
+        # 其余操作(以及根操作)在所有前驱结束后整体执行
+        limiter = AsyncRateLimiter(max_concurrency)
+        tasks: Dict[asyncio.Task, Operation] = {}
+        whole = set()
+        pending = {operation.id: 0 for operation in self.graph.operations}
+        started = set()
+        finished = set()
+        cancelled = []
+
+        async def process(operation: Operation, thought: Thought) -> List[Thought]:
+            with track(operation.metrics):
+                return await operation.aprocess(
+                    thought, self.lm, self.prompter, self.parser, limiter, **self.problem_parameters
+                )
+
+        def spawn(operation: Operation, coroutine, executes_whole: bool = False) -> None:
+            task = asyncio.create_task(coroutine)
+            tasks[task] = operation
+            pending[operation.id] += 1
+            if executes_whole:
+                whole.add(task)
+
+        def streams(operation: Operation) -> bool:
+            return operation.streamable and len(operation.predecessors) > 0
+
+        def advance(operation: Operation) -> None:
+            assert (
+                operation in self.graph.operations
+            ), "The successor of an operation is not in the operations graph"
+            if operation.id in finished:
+                return
+            ready = all(predecessor.id in finished for predecessor in operation.predecessors)
+            if not streams(operation):
+                if ready and operation.id not in started:
+                    started.add(operation.id)
+                    self.logger.info(f"Executing operation {operation.operation_type}")
+                    spawn(operation, operation.aexecute(
+                        self.lm, self.prompter, self.parser, limiter, **self.problem_parameters
+                    ), executes_whole=True)
+            elif ready and pending[operation.id] == 0:
+                finish(operation, operation.finalize())
+
+        def finish(operation: Operation, thoughts: List[Thought]) -> None:
+            if operation.started_at is None:
+                operation.started_at = time.perf_counter()
+            if streams(operation):
+                operation.finished_at = time.perf_counter()
+                operation.executed = True
+            finished.add(operation.id)
+            self.logger.info(f"Operation {operation.operation_type} executed")
+            deliver(operation, thoughts)
+            for successor in operation.successors:
+                advance(successor)
+
+        def deliver(operation: Operation, thoughts: List[Thought]) -> None:
+            if self.should_stop(thoughts, stop_when):
+                return
+            for successor in operation.successors:
+                if successor.id in finished or not streams(successor):
+                    continue
+                if successor.started_at is None:
+                    started.add(successor.id)
+                    successor.started_at = time.perf_counter()
+                for thought in thoughts:
+                    spawn(successor, process(successor, thought))
+
+        def close(operation: Operation) -> None:
+            # 操作已经饱和: 取消它以及只为它提供输入的上游操作中尚未完成的任务
+            closing = [operation] + self.exclusive_ancestors(operation)
+            for task, owner in list(tasks.items()):
+                if owner in closing:
+                    task.cancel()
+                    tasks.pop(task)
+                    cancelled.append(task)
+                    pending[owner.id] -= 1
+            for ancestor in closing[1:]:
+                if ancestor.id not in finished:
+                    if ancestor.started_at is None:
+                        ancestor.started_at = time.perf_counter()
+                    ancestor.finished_at = time.perf_counter()
+                    ancestor.executed = True
+                    finished.add(ancestor.id)
+            self.logger.info(
+                f"Operation {operation.operation_type} saturated, closed {len(closing) - 1} upstream operations"
+            )
+            finish(operation, operation.finalize())
+
+        for operation in self.graph.operations:
+            advance(operation)
+
+        try:
+            while tasks and not self.stopped_early:
+                done, _ = await asyncio.wait(tasks.keys(), return_when=asyncio.FIRST_COMPLETED)
+                for task in sorted(done, key=lambda task: tasks[task].id if task in tasks else -1):
+                    if task not in tasks:
+                        continue
+                    operation = tasks.pop(task)
+                    pending[operation.id] -= 1
+                    result = task.result()
+                    if task in whole:
+                        finish(operation, operation.get_thoughts())
+                    else:
+                        deliver(operation, result)
+                        if operation.saturated():
+                            close(operation)
+                        else:
+                            advance(operation)
+                    if self.stopped_early:
+                        break
+        finally:
+            for task in tasks:
+                task.cancel()
+            cancelled.extend(tasks)
+            self.cancelled_tasks += len(cancelled)
+            if cancelled:
+                await asyncio.gather(*cancelled, return_exceptions=True)
+
+        self.finished_at = time.perf_counter()
         self.logger.info("All operation executed")
         self.run_executed = True
 
@@ -72,6 +418,8 @@ class Controller:
                 operation_serialized['scores'] = [
                     thought.score for thought in operation.get_thoughts()
                 ]
+            if isinstance(operation, Score):
+                operation_serialized['scoring'] = operation.scoring_stats()
 
             if any([thought.validated for thought in operation.get_thoughts()]):
                 operation_serialized['validated'] = [
@@ -100,6 +448,8 @@ class Controller:
                 'prompt_tokens': self.lm.prompt_tokens,
                 'completion_tokens': self.lm.completion_tokens,
                 'cost': self.lm.cost,
+                'scoring': self.scoring_stats(),
+                'prompt_cache': self.prompt_cache_stats(),
             }
         )
 
@@ -2,4 +2,4 @@ from .thought import Thought
 from .graph_of_operations import GraphOfOperations
 from .operations import (Operation, Score, ValidateAndImprove,
                          Generate, Aggregate, KeepBestN, KeepValid,
-                         Selector, GroundTruth, Improve)
+                         Selector, GroundTruth, Improve, ScoreMemo)
@@ -24,8 +24,8 @@ class GraphOfOperations:
         self.operations.append(operation)
 
         if len(self.roots) == 0:
-            self.roots = [Operation]
-            self.leaves = [Operation]
+            self.roots = [operation]
+            self.leaves = [operation]
             assert (
                 len(operation.predecessors) == 0
             ), "First operation should have no predecessors"
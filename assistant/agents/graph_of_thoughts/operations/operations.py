@@ -1,14 +1,30 @@
+from __future__ import annotations
+
+import json
+import time
+import heapq
+import asyncio
+import hashlib
 import logging
 import itertools
 
 from enum import Enum
+from contextlib import nullcontext
 from abc import ABC, abstractmethod
-from typing import List, Iterable, Dict, Callable, Union
+from typing import Any, List, Iterable, Dict, Callable, Generator, Optional, Tuple, Union
 
 from assistant.agents.graph_of_thoughts.parser import Parser
 from assistant.agents.prompts.prompter import Prompter
 from assistant.agents.graph_of_thoughts.operations.thought import Thought
-from assistant.llm.language_models import AbstractLanguageModel
+from assistant.llm.rate_limiter import AsyncRateLimiter
+from assistant.llm.prompt_cache import estimate_tokens
+from assistant.llm.telemetry import CallMetrics, track, record_usage
+from assistant.llm.abstract_language_model import AbstractLanguageModel
+
+
+# 单个思维的处理步骤: 生成器产生 (提示, 回答数), 收到语言模型的回答后继续, 最后返回处理结果
+# 同步和异步执行共用这些步骤, 区别只在于如何调用语言模型
+Steps = Generator[Tuple[str, int], List[str], Any]
 
 
 class OperationType(Enum):
@@ -27,6 +43,8 @@ class Operation(ABC):
     _ids: Iterable[int] = itertools.count(0)
 
     operation_type: OperationType = None
+    # 流式执行时是否可以逐个处理前驱产生的思维, 否则等所有前驱执行完后整体执行
+    streamable: bool = False
 
     def __init__(self) -> None:
         self.logger: logging.Logger = logging.getLogger(self.__class__.__name__)
@@ -35,6 +53,25 @@ class Operation(ABC):
         self.successors: List[Operation] = []
         self.executed: bool = False
 
+        # 执行耗时以及执行期间语言模型调用的统计
+        self.metrics: CallMetrics = CallMetrics()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    @property
+    def wall_time(self) -> float:
+        if self.started_at is None or self.finished_at is None:
+            return 0.0
+        return self.finished_at - self.started_at
+
+    def metrics_dict(self) -> Dict:
+        return {
+            'id': self.id,
+            'operation': self.operation_type.name,
+            'wall_time': self.wall_time,
+            **self.metrics.as_dict(),
+        }
+
     def can_be_executed(self) -> bool:
         return all(predecessor.executed for predecessor in self.predecessors)
 
@@ -72,10 +109,105 @@ class Operation(ABC):
         self.logger.info(
             f"Executing operation {self.id} of type {self.operation_type}"
         )
-        self._execute(lm, prompter, parser, **kwargs)
+        self.started_at = time.perf_counter()
+        with track(self.metrics):
+            self._execute(lm, prompter, parser, **kwargs)
+        self.finished_at = time.perf_counter()
         self.logger.debug(f"Operation {self.id} executed")
         self.executed = True
 
+    async def aexecute(
+            self,
+            lm: AbstractLanguageModel,
+            prompter: Prompter,
+            parser: Parser,
+            limiter: Optional[AsyncRateLimiter] = None,
+            **kwargs
+    ) -> None:
+        assert self.can_be_executed(), "Not all predecessors have been executed"
+        self.logger.info(
+            f"Executing operation {self.id} of type {self.operation_type}"
+        )
+        self.started_at = time.perf_counter()
+        with track(self.metrics):
+            await self._aexecute(lm, prompter, parser, limiter, **kwargs)
+        self.finished_at = time.perf_counter()
+        self.logger.debug(f"Operation {self.id} executed")
+        self.executed = True
+
+    async def _aexecute(
+            self,
+            lm: AbstractLanguageModel,
+            prompter: Prompter,
+            parser: Parser,
+            limiter: Optional[AsyncRateLimiter] = None,
+            **kwargs
+    ) -> None:
+        # 不调用语言模型的操作直接复用同步实现
+        self._execute(lm, prompter, parser, **kwargs)
+
+    async def aquery(
+            self,
+            lm: AbstractLanguageModel,
+            prompt: str,
+            num_responses: int,
+            limiter: Optional[AsyncRateLimiter] = None
+    ) -> List[str]:
+        start = time.monotonic()
+        async with limiter if limiter is not None else nullcontext():
+            record_usage(queue_wait=time.monotonic() - start)
+            response = await lm.aquery(prompt, num_responses=num_responses)
+        return lm.get_response_texts(response)
+
+    def run_steps(self, lm: AbstractLanguageModel, steps: Steps) -> Any:
+        # 同步执行: 依次回答处理步骤产生的提示, 返回步骤的结果
+        responses = None
+        while True:
+            try:
+                prompt, num_responses = steps.send(responses)
+            except StopIteration as stop:
+                return stop.value
+            self.logger.debug(f"Prompt for LM: {prompt}")
+            responses = lm.get_response_texts(lm.query(prompt, num_responses=num_responses))
+            self.logger.debug(f"Responses from LM: {responses}")
+
+    async def arun_steps(
+            self,
+            lm: AbstractLanguageModel,
+            steps: Steps,
+            limiter: Optional[AsyncRateLimiter] = None
+    ) -> Any:
+        # 异步执行同样的步骤, 多个思维的步骤可以并发, 调用语言模型时经过限流器
+        responses = None
+        while True:
+            try:
+                prompt, num_responses = steps.send(responses)
+            except StopIteration as stop:
+                return stop.value
+            self.logger.debug(f"Prompt for LM: {prompt}")
+            responses = await self.aquery(lm, prompt, num_responses, limiter)
+            self.logger.debug(f"Responses from LM: {responses}")
+
+    async def aprocess(
+            self,
+            thought: Thought,
+            lm: AbstractLanguageModel,
+            prompter: Prompter,
+            parser: Parser,
+            limiter: Optional[AsyncRateLimiter] = None,
+            **kwargs
+    ) -> List[Thought]:
+        # 流式执行: 处理一个前驱思维, 返回新产生并可以立即传给后继的思维
+        raise NotImplementedError(f"{self.__class__.__name__} does not support streaming execution")
+
+    def finalize(self) -> List[Thought]:
+        # 流式执行中所有输入都处理完后调用, 返回此时才确定的思维
+        return []
+
+    def saturated(self) -> bool:
+        # 为True时后续输入不会再改变结果, 控制器会取消仍在为它生成思维的任务
+        return False
+
     @abstractmethod
     def _execute(
             self,
@@ -91,6 +223,32 @@ class Operation(ABC):
         pass
 
 
+def state_hash(state: Dict) -> str:
+    payload = json.dumps(state, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+# 一次运行内多个Score操作共享的打分缓存, 状态相同的思维直接复用之前的分数
+class ScoreMemo:
+    def __init__(self) -> None:
+        self.scores: Dict[str, float] = {}
+        # 并行执行时正在打分的状态, 其他操作等待结果而不是重复调用语言模型
+        self.in_flight: Dict[str, asyncio.Future] = {}
+
+    def get(self, key: str) -> Optional[float]:
+        return self.scores.get(key)
+
+    def put(self, key: str, score: float) -> None:
+        self.scores[key] = score
+
+    def clear(self) -> None:
+        self.scores.clear()
+        self.in_flight.clear()
+
+    def __len__(self) -> int:
+        return len(self.scores)
+
+
 class Score(Operation):
     operation_type: OperationType = OperationType.score
 
@@ -101,8 +259,13 @@ class Score(Operation):
             scoring_function: Callable[
                 [Union[List[Dict], Dict]], Union[List[float], float]
             ] = None,
+            batch_token_budget: Optional[int] = None,
+            memo: Union[bool, ScoreMemo] = False,
     ) -> None:
         super().__init__()
+        if batch_token_budget is not None and batch_token_budget < 1:
+            raise ValueError("batch_token_budget must be at least 1")
+
         self.num_samples: int = num_samples
         self.combined_scoring: bool = combined_scoring
         self.thoughts: List[Thought] = []
@@ -110,9 +273,259 @@ class Score(Operation):
             [Union[List[Dict], Dict]], Union[List[float], float]
         ] = scoring_function
 
+        # batch_token_budget: 非combined模式下把多个状态打包进一个打分提示, 直到提示达到该token数
+        # memo: True 时使用Controller在一次运行内共享的缓存, 也可以直接传入一个 ScoreMemo
+        self.batch_token_budget: Optional[int] = batch_token_budget
+        self.memoize: bool = isinstance(memo, ScoreMemo) or bool(memo)
+        self.memo: Optional[ScoreMemo] = memo if isinstance(memo, ScoreMemo) else None
+
+        self.lm_calls: int = 0
+        self.lm_calls_saved: int = 0
+        self.prompt_tokens_saved: int = 0
+        self.memo_hits: int = 0
+
+    @property
+    def streamable(self) -> bool:
+        return not self.combined_scoring
+
     def get_thoughts(self) -> List[Thought]:
         return self.thoughts
 
+    def scoring_stats(self) -> Dict:
+        return {
+            'lm_calls': self.lm_calls,
+            'lm_calls_saved': self.lm_calls_saved,
+            'prompt_tokens_saved': self.prompt_tokens_saved,
+            'memo_hits': self.memo_hits,
+        }
+
+    def plan_scoring(
+            self,
+            states: List[Dict],
+            prompter: Prompter
+    ) -> Tuple[List[str], Dict[str, float], Dict[str, asyncio.Future], List[List[Tuple[str, Dict]]]]:
+        if self.memoize and self.memo is None:
+            self.memo = ScoreMemo()
+
+        # 开启缓存时相同的状态只打分一次, 已经在缓存中或正在被其他操作打分的状态不再调用语言模型;
+        # 不开启时每个状态按位置独立打分
+        if self.memo is not None:
+            keys = [state_hash(state) for state in states]
+        else:
+            keys = [str(position) for position in range(len(states))]
+        known: Dict[str, float] = {}
+        waiting: Dict[str, asyncio.Future] = {}
+        pending: Dict[str, Dict] = {}
+        for key, state in zip(keys, states):
+            if key in known or key in waiting or key in pending:
+                continue
+            score = self.memo.get(key) if self.memo is not None else None
+            if score is not None:
+                known[key] = score
+            elif self.memo is not None and key in self.memo.in_flight:
+                waiting[key] = self.memo.in_flight[key]
+            else:
+                pending[key] = state
+        self.memo_hits += len(keys) - len(pending)
+
+        # 提示器的 batched_score_prompt 返回None时不能合并, 每个状态单独打分
+        batches: List[List[Tuple[str, Dict]]] = []
+        batch: List[Tuple[str, Dict]] = []
+        for item in pending.items():
+            prompt = None
+            if self.batch_token_budget is not None and batch:
+                prompt = prompter.batched_score_prompt([state for _, state in batch + [item]])
+            if prompt is None or estimate_tokens(prompt) > self.batch_token_budget:
+                if batch:
+                    batches.append(batch)
+                batch = [item]
+            else:
+                batch.append(item)
+        if batch:
+            batches.append(batch)
+
+        # 与每个思维单独打分相比节省的调用次数和提示token数
+        single_tokens = sum(estimate_tokens(prompter.score_prompt([state])) for state in states)
+        batch_tokens = sum(
+            estimate_tokens(self.batch_prompt(prompter, batch)) for batch in batches
+        )
+        self.lm_calls_saved += len(states) - len(batches)
+        self.prompt_tokens_saved += single_tokens - batch_tokens
+        return keys, known, waiting, batches
+
+    def batch_prompt(
+            self,
+            prompter: Prompter,
+            batch: List[Tuple[str, Dict]]
+    ) -> str:
+        states = [state for _, state in batch]
+        if len(states) == 1:
+            return prompter.score_prompt(states)
+        return prompter.batched_score_prompt(states)
+
+    def parse_batch(
+            self,
+            batch: List[Tuple[str, Dict]],
+            parser: Parser,
+            responses: List[str]
+    ) -> Optional[List[float]]:
+        states = [state for _, state in batch]
+        if len(states) == 1:
+            return parser.parse_score_answer(states, responses)[:1]
+
+        try:
+            scores = parser.parse_batched_score_answer(states, responses)
+        except Exception as e:
+            self.logger.warning(f"Failed to parse batched score answer: {e}; scoring individually")
+            return None
+        if len(scores) != len(states):
+            # 解析失败时退回到逐个打分
+            self.logger.warning(
+                f"Expected {len(states)} scores from batched prompt, got {len(scores)}; scoring individually"
+            )
+            return None
+        return scores
+
+    def record_scores(
+            self,
+            previous_thoughts: List[Thought],
+            scores: List[float]
+    ) -> None:
+        for thought, score in zip(previous_thoughts, scores):
+            new_thought = Thought.from_thought(thought)
+            new_thought.score = score
+            self.thoughts.append(new_thought)
+
+        self.logger.info(
+            f"Score operation {self.id} scored {len(self.thoughts)} thoughts"
+        )
+
+    def function_scores(self, states: List[Dict]) -> List[float]:
+        self.logger.debug(
+            f"Using scoring function {self.scoring_function} to score states"
+        )
+        if self.combined_scoring:
+            return self.scoring_function(states)
+        return [self.scoring_function(state) for state in states]
+
+    def combined_score_steps(
+            self,
+            states: List[Dict],
+            prompter: Prompter,
+            parser: Parser
+    ) -> Steps:
+        responses = yield prompter.score_prompt(states), self.num_samples
+        self.lm_calls += 1
+        return parser.parse_score_answer(states, responses)
+
+    def batch_score_steps(
+            self,
+            batch: List[Tuple[str, Dict]],
+            prompter: Prompter,
+            parser: Parser
+    ) -> Steps:
+        responses = yield self.batch_prompt(prompter, batch), self.num_samples
+        self.lm_calls += 1
+
+        scores = self.parse_batch(batch, parser, responses)
+        if scores is None:
+            # 调用方会逐个重新打分, 撤销这一批预计的节省
+            self.lm_calls_saved -= len(batch)
+            self.prompt_tokens_saved -= sum(
+                estimate_tokens(prompter.score_prompt([state])) for _, state in batch
+            )
+        return scores
+
+    def score_batch(
+            self,
+            lm: AbstractLanguageModel,
+            prompter: Prompter,
+            parser: Parser,
+            batch: List[Tuple[str, Dict]]
+    ) -> List[float]:
+        scores = self.run_steps(lm, self.batch_score_steps(batch, prompter, parser))
+        if scores is None:
+            scores = [
+                score
+                for item in batch
+                for score in self.score_batch(lm, prompter, parser, [item])
+            ]
+        return scores
+
+    async def ascore_batch(
+            self,
+            lm: AbstractLanguageModel,
+            prompter: Prompter,
+            parser: Parser,
+            batch: List[Tuple[str, Dict]],
+            limiter: Optional[AsyncRateLimiter] = None
+    ) -> List[float]:
+        scores = await self.arun_steps(lm, self.batch_score_steps(batch, prompter, parser), limiter)
+        if scores is None:
+            results = await asyncio.gather(
+                *[self.ascore_batch(lm, prompter, parser, [item], limiter) for item in batch]
+            )
+            scores = [score for result in results for score in result]
+        return scores
+
+    def store_scores(
+            self,
+            batch: List[Tuple[str, Dict]],
+            scores: List[float],
+            known: Dict[str, float]
+    ) -> None:
+        for (key, _), score in zip(batch, scores):
+            known[key] = score
+            if self.memo is not None:
+                self.memo.put(key, score)
+
+    def score_states(
+            self,
+            states: List[Dict],
+            lm: AbstractLanguageModel,
+            prompter: Prompter,
+            parser: Parser
+    ) -> List[float]:
+        keys, known, _, batches = self.plan_scoring(states, prompter)
+        for batch in batches:
+            self.store_scores(batch, self.score_batch(lm, prompter, parser, batch), known)
+        return [known[key] for key in keys]
+
+    async def ascore_states(
+            self,
+            states: List[Dict],
+            lm: AbstractLanguageModel,
+            prompter: Prompter,
+            parser: Parser,
+            limiter: Optional[AsyncRateLimiter] = None
+    ) -> List[float]:
+        keys, known, waiting, batches = self.plan_scoring(states, prompter)
+        futures: Dict[str, asyncio.Future] = {}
+        if self.memo is not None:
+            loop = asyncio.get_running_loop()
+            for batch in batches:
+                for key, _ in batch:
+                    futures[key] = self.memo.in_flight[key] = loop.create_future()
+
+        try:
+            results = await asyncio.gather(
+                *[self.ascore_batch(lm, prompter, parser, batch, limiter) for batch in batches]
+            )
+            for batch, scores in zip(batches, results):
+                self.store_scores(batch, scores, known)
+                for key, _ in batch:
+                    if key in futures:
+                        futures[key].set_result(known[key])
+        finally:
+            for key, future in futures.items():
+                self.memo.in_flight.pop(key, None)
+                if not future.done():
+                    future.cancel()
+
+        for key, future in waiting.items():
+            known[key] = await future
+        return [known[key] for key in keys]
+
     def _execute(
             self,
             lm: AbstractLanguageModel,
@@ -126,54 +539,61 @@ class Score(Operation):
             len(self.predecessors) > 0
         ), "Score operation needs at least one predecessor"
 
-        if self.combined_scoring:
-            previous_thoughts_states = [thought.state for thought in previous_thoughts]
-            if self.scoring_function is not None:
-                self.logger.debug(
-                    f"Using scoring function {self.scoring_function} to score states"
-                )
-                scores = self.scoring_function(previous_thoughts_states)
-            else:
-                prompt = prompter.score_prompt(previous_thoughts_states)
-                self.logger.debug(f"Prompt for LM: {prompt}")
+        states = [thought.state for thought in previous_thoughts]
+        if self.scoring_function is not None:
+            scores = self.function_scores(states)
+        elif self.combined_scoring:
+            scores = self.run_steps(lm, self.combined_score_steps(states, prompter, parser))
+        else:
+            scores = self.score_states(states, lm, prompter, parser)
+        self.record_scores(previous_thoughts, scores)
 
-                responses = lm.get_response_texts(
-                    lm.query(prompt, num_responses=self.num_samples)
-                )
-                self.logger.debug(f"Responses from LM: {responses}")
-                scores = parser.parse_score_answer(previous_thoughts_states, responses)
-            for thought, score in zip(previous_thoughts, scores):
-                new_thought = Thought.from_thought(thought)
-                new_thought.score = score
-                self.thoughts.append(new_thought)
+    async def _aexecute(
+            self,
+            lm: AbstractLanguageModel,
+            prompter: Prompter,
+            parser: Parser,
+            limiter: Optional[AsyncRateLimiter] = None,
+            **kwargs
+    ) -> None:
+        previous_thoughts: List[Thought] = self.get_previous_thought()
+
+        assert (
+            len(self.predecessors) > 0
+        ), "Score operation needs at least one predecessor"
+
+        states = [thought.state for thought in previous_thoughts]
+        if self.scoring_function is not None:
+            scores = self.function_scores(states)
+        elif self.combined_scoring:
+            scores = await self.arun_steps(lm, self.combined_score_steps(states, prompter, parser), limiter)
         else:
-            for thought in previous_thoughts:
-                new_thought = Thought.from_thought(thought)
-                if self.scoring_function is not None:
-                    self.logger.debug(
-                        f"Using scoring function {self.scoring_function} to score state"
-                    )
-                    score = self.scoring_function(thought.state)
-                else:
-                    prompt = prompter.score_prompt([thought.state])
-                    self.logger.debug(f"Prompt for LM: {prompt}")
-
-                    responses = lm.get_response_texts(
-                        lm.query(prompt, num_responses=self.num_samples)
-                    )
-                    self.logger.debug(f"Response from LM: {responses}")
-                    score = parser.parse_score_answer([thought.state], responses)[0]
-
-                new_thought.score = score
-                self.thoughts.append(new_thought)
+            scores = await self.ascore_states(states, lm, prompter, parser, limiter)
+        self.record_scores(previous_thoughts, scores)
 
-        self.logger.info(
-            f"Score operation {self.id} scored {len(self.thoughts)} thoughts"
-        )
+    async def aprocess(
+            self,
+            thought: Thought,
+            lm: AbstractLanguageModel,
+            prompter: Prompter,
+            parser: Parser,
+            limiter: Optional[AsyncRateLimiter] = None,
+            **kwargs
+    ) -> List[Thought]:
+        new_thought = Thought.from_thought(thought)
+        if self.scoring_function is not None:
+            new_thought.score = self.scoring_function(thought.state)
+        else:
+            new_thought.score = (
+                await self.ascore_states([thought.state], lm, prompter, parser, limiter)
+            )[0]
+        self.thoughts.append(new_thought)
+        return [new_thought]
 
 
 class ValidateAndImprove(Operation):
     operation_type: OperationType = OperationType.validate_and_improve
+    streamable: bool = True
 
     def __init__(
             self,
@@ -181,17 +601,78 @@ class ValidateAndImprove(Operation):
             improve: bool = True,
             num_tries: int = 3,
             validate_function: Callable[[Dict], bool] = None,
+            max_valid: Optional[int] = None,
     ) -> None:
         super().__init__()
+        if max_valid is not None and max_valid < 1:
+            raise ValueError("max_valid must be at least 1")
+
         self.num_samples: int = num_samples
         self.improve: bool = improve
         self.num_tries: int = num_tries
         self.validate_function: Callable[[Dict], bool] = validate_function
+        # max_valid: 得到这么多有效思维后, 并行/流式执行时取消其余分支尚未完成的验证和改进
+        self.max_valid: Optional[int] = max_valid
         self.thoughts: List[List[Thought]] = []
 
     def get_thoughts(self) -> List[Thought]:
         return [thought_list[-1] for thought_list in self.thoughts]
 
+    def saturated(self) -> bool:
+        if self.max_valid is None:
+            return False
+        return sum(thought_list[-1].valid for thought_list in self.thoughts) >= self.max_valid
+
+    def validate_and_improve_steps(
+            self,
+            thought: Thought,
+            prompter: Prompter,
+            parser: Parser
+    ) -> Steps:
+        thought_list = []
+        current_thought = Thought.from_thought(thought)
+        current_try = 0
+        while True:
+            if self.validate_function is not None:
+                self.logger.debug(
+                    f"Using validate function {self.validate_function} to score states"
+                )
+                valid = self.validate_function(current_thought.state)
+            else:
+                responses = yield prompter.validation_prompt(**current_thought.state), self.num_samples
+                valid = parser.parse_validation_answer(
+                    current_thought.state, responses
+                )
+
+            current_thought.valid = valid
+            thought_list.append(current_thought)
+            if (
+                not self.improve
+                or current_thought.valid
+                or current_try >= self.num_tries
+            ):
+                return thought_list
+
+            responses = yield prompter.improve_prompt(**current_thought.state), 1
+            state_update = parser.parse_improve_answer(
+                current_thought.state, responses
+            )
+            current_thought = Thought({**current_thought.state, **state_update})
+            current_try += 1
+
+    def log_valid(self, previous_thoughts: List[Thought]) -> None:
+        valid_thoughts_num = len(
+            [
+                thought_list[-1]
+                for thought_list in self.thoughts
+                if thought_list[-1].valid
+            ]
+        )
+        self.logger.info(
+            f"Validate and improve operation {self.id} created {valid_thoughts_num}"
+            f"valid thoughts from {len(previous_thoughts)} previous thoughts"
+        )
+
     def _execute(
             self,
             lm: AbstractLanguageModel,
@@ -206,65 +687,67 @@ class ValidateAndImprove(Operation):
         ), "ValidateAndImprove operation needs at least one predecessor"
 
         for thought in previous_thoughts:
-            thought_list = []
-            current_thought = Thought.from_thought(thought)
-            current_try = 0
-            while True:
-                if self.validate_function is not None:
-                    self.logger.debug(
-                        f"Using validate function {self.validate_function} to score states"
-                    )
-                    valid = self.validate_function(current_thought.state)
-                else:
-                    prompt = prompter.validation_prompt(**current_thought.state)
-                    self.logger.debug(f"Prompt for LM: {prompt}")
-                    responses = lm.get_response_texts(
-                        lm.query(prompt, num_responses=self.num_samples)
-                    )
-                    self.logger.debug(f"Response from LM: {responses}")
-
-                    valid = parser.parse_validation_answer(
-                        current_thought.state, responses
-                    )
-
-                current_thought.valid = valid
-                thought_list.append(current_thought)
-                if (
-                    not self.improve
-                    or current_thought.valid
-                    or current_try >= self.num_tries
-                ):
-                    break
+            self.thoughts.append(
+                self.run_steps(lm, self.validate_and_improve_steps(thought, prompter, parser))
+            )
+        self.log_valid(previous_thoughts)
 
-                improve_prompt = prompter.improve_prompt(**current_thought.state)
-                self.logger.debug(f"Prompt for LM: {improve_prompt}")
-                responses = lm.get_response_texts(
-                    lm.query(improve_prompt, num_responses=1)
-                )
-                self.logger.debug("Responses from LM: %s", responses)
-                state_update = parser.parse_improve_answer(
-                    current_thought.state, responses
-                )
-                current_thought = Thought({**current_thought.state, **state_update})
-                current_try += 1
+    async def _aexecute(
+            self,
+            lm: AbstractLanguageModel,
+            prompter: Prompter,
+            parser: Parser,
+            limiter: Optional[AsyncRateLimiter] = None,
+            **kwargs
+    ) -> None:
+        previous_thoughts: List[Thought] = self.get_previous_thought()
 
-            self.thoughts.append(thought_list)
+        assert (
+            len(self.predecessors) > 0
+        ), "ValidateAndImprove operation needs at least one predecessor"
 
-        valid_thoughts_num = len(
-            [
-                thought_list[-1]
-                for thought_list in self.thoughts
-                if thought_list[-1].valid
-            ]
+        tasks = [
+            asyncio.ensure_future(
+                self.arun_steps(lm, self.validate_and_improve_steps(thought, prompter, parser), limiter)
+            )
+            for thought in previous_thoughts
+        ]
+        try:
+            valid = 0
+            for future in asyncio.as_completed(tasks):
+                valid += (await future)[-1].valid
+                if self.max_valid is not None and valid >= self.max_valid:
+                    break
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        # 保持与前驱思维相同的顺序, 被取消的分支不产生思维
+        self.thoughts.extend(
+            task.result() for task in tasks if not task.cancelled()
         )
-        self.logger.info(
-            f"Validate and improve operation {self.id} created {valid_thoughts_num}"
-            f"valid thoughts from {len(previous_thoughts)} previous thoughts"
+        self.log_valid(previous_thoughts)
+
+    async def aprocess(
+            self,
+            thought: Thought,
+            lm: AbstractLanguageModel,
+            prompter: Prompter,
+            parser: Parser,
+            limiter: Optional[AsyncRateLimiter] = None,
+            **kwargs
+    ) -> List[Thought]:
+        thought_list = await self.arun_steps(
+            lm, self.validate_and_improve_steps(thought, prompter, parser), limiter
         )
+        self.thoughts.append(thought_list)
+        return [thought_list[-1]]
 
 
 class Generate(Operation):
     operation_type: OperationType = OperationType.generate
+    streamable: bool = True
 
     def __init__(
             self,
@@ -279,36 +762,37 @@ class Generate(Operation):
     def get_thoughts(self) -> List[Thought]:
         return self.thoughts
 
-    def _execute(
-            self,
-            lm: AbstractLanguageModel,
-            prompter: Prompter,
-            parser: Parser,
-            **kwargs
-    ) -> None:
+    def generate_inputs(self, kwargs: Dict) -> List[Thought]:
+        # 前驱没有产生思维时不生成; 没有前驱时以传入的参数作为初始状态
         previous_thoughts: List[Thought] = self.get_previous_thought()
-
-        if len(previous_thoughts) == 0 and len(self.predecessors) > 0:
-            return
-
-        if len(previous_thoughts) == 0:
+        if len(previous_thoughts) == 0 and len(self.predecessors) == 0:
             previous_thoughts = [Thought(state=kwargs)]
+        return previous_thoughts
 
-        for thought in previous_thoughts:
-            base_state = thought.state
-            prompt = prompter.generate_prompt(self.num_branches_prompt, **base_state)
-            self.logger.debug(f"Prompt for LM: {prompt}")
-            responses = lm.get_response_texts(
-                lm.query(prompt, num_responses=self.num_branches_response)
+    def generate_steps(
+            self,
+            thought: Thought,
+            prompter: Prompter,
+            parser: Parser
+    ) -> Steps:
+        base_state = thought.state
+        prompt = prompter.generate_prompt(self.num_branches_prompt, **base_state)
+        responses = yield prompt, self.num_branches_response
+        return [
+            {**base_state, **new_state}
+            for new_state in parser.parse_generate_answer(base_state, responses)
+        ]
+
+    def add_thoughts(self, new_states: List[Dict]) -> List[Thought]:
+        new_thoughts = [Thought(new_state) for new_state in new_states]
+        for thought in new_thoughts:
+            self.logger.debug(
+                f"New thought {thought.id} created with state {thought.state}"
             )
-            self.logger.debug(f"Responses from LM: {responses}")
-            for new_state in parser.parse_generate_answer(base_state, responses):
-                new_state = {**base_state, **new_state}
-                self.thoughts.append(Thought(new_state))
-                self.logger.debug(
-                    f"New thought {self.thoughts[-1].id} created with state {self.thoughts[-1].state}"
-                )
+        self.thoughts.extend(new_thoughts)
+        return new_thoughts
 
+    def log_generated(self, previous_thoughts: List[Thought]) -> None:
         if (
             len(self.thoughts)
             > self.num_branches_prompt
@@ -323,9 +807,57 @@ class Generate(Operation):
             f"Generate operation {self.id} created {self.thoughts} new thoughts"
         )
 
+    def _execute(
+            self,
+            lm: AbstractLanguageModel,
+            prompter: Prompter,
+            parser: Parser,
+            **kwargs
+    ) -> None:
+        previous_thoughts = self.generate_inputs(kwargs)
+        if len(previous_thoughts) == 0:
+            return
+
+        for thought in previous_thoughts:
+            self.add_thoughts(self.run_steps(lm, self.generate_steps(thought, prompter, parser)))
+        self.log_generated(previous_thoughts)
+
+    async def _aexecute(
+            self,
+            lm: AbstractLanguageModel,
+            prompter: Prompter,
+            parser: Parser,
+            limiter: Optional[AsyncRateLimiter] = None,
+            **kwargs
+    ) -> None:
+        previous_thoughts = self.generate_inputs(kwargs)
+        if len(previous_thoughts) == 0:
+            return
+
+        for new_states in await asyncio.gather(
+                *[self.arun_steps(lm, self.generate_steps(thought, prompter, parser), limiter)
+                  for thought in previous_thoughts]
+        ):
+            self.add_thoughts(new_states)
+        self.log_generated(previous_thoughts)
+
+    async def aprocess(
+            self,
+            thought: Thought,
+            lm: AbstractLanguageModel,
+            prompter: Prompter,
+            parser: Parser,
+            limiter: Optional[AsyncRateLimiter] = None,
+            **kwargs
+    ) -> List[Thought]:
+        return self.add_thoughts(
+            await self.arun_steps(lm, self.generate_steps(thought, prompter, parser), limiter)
+        )
+
 
 class Improve(Operation):
     operation_type: OperationType = OperationType.improve
+    streamable: bool = True
 
     def __init__(self) -> None:
         super().__init__()
@@ -334,6 +866,16 @@ class Improve(Operation):
     def get_thoughts(self) -> List[Thought]:
         return self.thoughts
 
+    def improve_steps(
+            self,
+            thought: Thought,
+            prompter: Prompter,
+            parser: Parser
+    ) -> Steps:
+        responses = yield prompter.improve_prompt(**thought.state), 1
+        state_update = parser.parse_improve_answer(thought.state, responses)
+        return Thought({**thought.state, **state_update})
+
     def _execute(
             self,
             lm: AbstractLanguageModel,
@@ -346,19 +888,46 @@ class Improve(Operation):
         assert len(self.predecessors) > 0, "Needs at least one predecessor"
 
         for thought in previous_thoughts:
-            improve_prompt = prompter.improve_prompt(**thought.state)
-            self.logger.debug(f"Prompt for LM: {improve_prompt}")
-            responses = lm.get_response_texts(
-                lm.query(improve_prompt, num_responses=1)
-            )
-            self.logger.debug(f"Responses from LM: {responses}")
-            state_update = parser.parse_improve_answer(thought.state, responses)
-            self.thoughts.append(Thought({**thought.state, **state_update}))
+            self.thoughts.append(self.run_steps(lm, self.improve_steps(thought, prompter, parser)))
+
+        self.logger.info(
+            f"Improve operation {self.id} improved {len(self.thoughts)} thoughts"
+        )
+
+    async def _aexecute(
+            self,
+            lm: AbstractLanguageModel,
+            prompter: Prompter,
+            parser: Parser,
+            limiter: Optional[AsyncRateLimiter] = None,
+            **kwargs
+    ) -> None:
+        previous_thoughts: List[Thought] = self.get_previous_thought()
+
+        assert len(self.predecessors) > 0, "Needs at least one predecessor"
+
+        self.thoughts.extend(await asyncio.gather(
+            *[self.arun_steps(lm, self.improve_steps(thought, prompter, parser), limiter)
+              for thought in previous_thoughts]
+        ))
 
         self.logger.info(
             f"Improve operation {self.id} improved {len(self.thoughts)} thoughts"
         )
 
+    async def aprocess(
+            self,
+            thought: Thought,
+            lm: AbstractLanguageModel,
+            prompter: Prompter,
+            parser: Parser,
+            limiter: Optional[AsyncRateLimiter] = None,
+            **kwargs
+    ) -> List[Thought]:
+        new_thought = await self.arun_steps(lm, self.improve_steps(thought, prompter, parser), limiter)
+        self.thoughts.append(new_thought)
+        return [new_thought]
+
 
 class Aggregate(Operation):
     operation_type: OperationType = OperationType.aggregate
@@ -374,6 +943,26 @@ class Aggregate(Operation):
     def get_thoughts(self) -> List[Thought]:
         return self.thoughts
 
+    def aggregate_steps(
+            self,
+            previous_thoughts: List[Thought],
+            prompter: Prompter,
+            parser: Parser
+    ) -> Steps:
+        base_state: Dict = {}
+        for thought in sorted(previous_thoughts, key=lambda thought: thought.score):
+            base_state = {**base_state, **thought.state}
+
+        previous_thought_states = [thought.state for thought in previous_thoughts]
+        prompt = prompter.aggregation_prompt(previous_thought_states)
+        responses = yield prompt, self.num_responses
+        parsed = parser.parse_aggregation_answer(previous_thought_states, responses)
+
+        if isinstance(parsed, dict):
+            parsed = [parsed]
+
+        return [Thought({**base_state, **new_state}) for new_state in parsed]
+
     def _execute(
             self,
             lm: AbstractLanguageModel,
@@ -390,41 +979,50 @@ class Aggregate(Operation):
         if len(previous_thoughts) == 0:
             return
 
-        base_state: Dict = {}
-        for thought in sorted(previous_thoughts, key=lambda thought: thought.score):
-            base_state = {**base_state, **thought.state}
-
-        previous_thought_states = [thought.state for thought in previous_thoughts]
-        prompt = prompter.aggregation_prompt(previous_thought_states)
+        self.thoughts.extend(self.run_steps(lm, self.aggregate_steps(previous_thoughts, prompter, parser)))
 
-        self.logger.debug(f"Prompt for LM: {prompt}")
+    async def _aexecute(
+            self,
+            lm: AbstractLanguageModel,
+            prompter: Prompter,
+            parser: Parser,
+            limiter: Optional[AsyncRateLimiter] = None,
+            **kwargs
+    ) -> None:
+        assert (
+            len(self.predecessors) >= 1
+        ), "Aggregate operation must have at least one predecessor"
 
-        responses = lm.get_response_texts(
-            lm.query(prompt, num_responses=self.num_responses)
-        )
-        self.logger.debug(f"Responses from LM: {responses}")
-        parsed = parser.parse_aggregation_answer(previous_thought_states, responses)
+        previous_thoughts: List[Thought] = self.get_previous_thought()
 
-        if isinstance(parsed, dict):
-            parsed = [parsed]
+        if len(previous_thoughts) == 0:
+            return
 
-        for new_state in parsed:
-            self.thoughts.append(Thought({**base_state, **new_state}))
+        self.thoughts.extend(
+            await self.arun_steps(lm, self.aggregate_steps(previous_thoughts, prompter, parser), limiter)
+        )
 
 
 class KeepBestN(Operation):
     operation_type: OperationType = OperationType.keep_best_n
+    streamable: bool = True
 
     def __init__(
             self,
             n: int,
-            higher_is_better: bool = True
+            higher_is_better: bool = True,
+            score_bound: Optional[float] = None
     ) -> None:
         super().__init__()
         self.n: int = n
         assert self.n > 0, "KeepBestN operation must keep at least one thought"
         self.higher_is_better: bool = higher_is_better
+        # score_bound: 可能达到的最好分数, 流式执行时前N个都达到该分数后其余分支不可能再进入前N
+        self.score_bound: Optional[float] = score_bound
         self.thoughts: List[Thought] = []
+        # 流式执行时维护的前N个思维, 堆顶是其中最差的一个
+        self.heap: List = []
+        self.arrivals: int = 0
 
     def get_best_n(self) -> List[Thought]:
         previous_thoughts: List[Thought] = self.get_previous_thought()
@@ -479,9 +1077,49 @@ class KeepBestN(Operation):
             f"KeepBestN operation {self.id} kept {len(self.thoughts)} thoughts"
         )
 
+    async def aprocess(
+            self,
+            thought: Thought,
+            lm: AbstractLanguageModel,
+            prompter: Prompter,
+            parser: Parser,
+            limiter: Optional[AsyncRateLimiter] = None,
+            **kwargs
+    ) -> List[Thought]:
+        if not isinstance(thought.score, (int, float)):
+            self.logger.error(f"Thought {thought.id} has invalid score {thought.score}")
+            return []
+
+        # 分数相同时保留先到达的思维
+        score = thought.score if self.higher_is_better else -thought.score
+        entry = (score, -self.arrivals, thought)
+        self.arrivals += 1
+        if len(self.heap) < self.n:
+            heapq.heappush(self.heap, entry)
+        elif entry[:2] > self.heap[0][:2]:
+            heapq.heapreplace(self.heap, entry)
+        return []
+
+    def saturated(self) -> bool:
+        if self.score_bound is None or len(self.heap) < self.n:
+            return False
+        bound = self.score_bound if self.higher_is_better else -self.score_bound
+        return self.heap[0][0] >= bound
+
+    def finalize(self) -> List[Thought]:
+        self.thoughts = [
+            Thought.from_thought(thought)
+            for _, _, thought in sorted(self.heap, key=lambda entry: entry[:2], reverse=True)
+        ]
+        self.logger.info(
+            f"KeepBestN operation {self.id} kept {len(self.thoughts)} thoughts"
+        )
+        return self.thoughts
+
 
 class KeepValid(Operation):
     operation_type: OperationType = OperationType.keep_valid
+    streamable: bool = True
 
     def __init__(self) -> None:
         super().__init__()
@@ -521,9 +1159,25 @@ class KeepValid(Operation):
             f"KeepValid operation {self.id} kept {len(self.thoughts)} thoughts"
         )
 
+    async def aprocess(
+            self,
+            thought: Thought,
+            lm: AbstractLanguageModel,
+            prompter: Prompter,
+            parser: Parser,
+            limiter: Optional[AsyncRateLimiter] = None,
+            **kwargs
+    ) -> List[Thought]:
+        if thought.validated and not thought.valid:
+            return []
+        new_thought = Thought.from_thought(thought)
+        self.thoughts.append(new_thought)
+        return [new_thought]
+
 
 class GroundTruth(Operation):
     operation_type: OperationType = OperationType.ground_truth_evaluator
+    streamable: bool = True
 
     def __init__(
             self,
@@ -550,14 +1204,7 @@ class GroundTruth(Operation):
         previous_thoughts: List[Thought] = self.get_previous_thought()
 
         for thought in previous_thoughts:
-            new_thought = Thought.from_thought(thought)
-            try:
-                new_thought.solved = self.ground_truth_evaluator(new_thought.state)
-            except Exception as e:
-                self.logger.error(f"GroundTruth happens error: {e}")
-                new_thought.solved = False
-
-            self.thoughts.append(new_thought)
+            self.thoughts.append(self.evaluate(thought))
 
         self.logger.info(
             f"GroundTruth operation {self.id} evaluated {len(self.thoughts)}"
@@ -565,6 +1212,28 @@ class GroundTruth(Operation):
             "solved the problem"
         )
 
+    def evaluate(self, thought: Thought) -> Thought:
+        new_thought = Thought.from_thought(thought)
+        try:
+            new_thought.solved = self.ground_truth_evaluator(new_thought.state)
+        except Exception as e:
+            self.logger.error(f"GroundTruth happens error: {e}")
+            new_thought.solved = False
+        return new_thought
+
+    async def aprocess(
+            self,
+            thought: Thought,
+            lm: AbstractLanguageModel,
+            prompter: Prompter,
+            parser: Parser,
+            limiter: Optional[AsyncRateLimiter] = None,
+            **kwargs
+    ) -> List[Thought]:
+        new_thought = self.evaluate(thought)
+        self.thoughts.append(new_thought)
+        return [new_thought]
+
 
 class Selector(Operation):
     operation_type: OperationType = OperationType.selector
@@ -605,7 +1274,3 @@ class Selector(Operation):
         self.logger.info(
             f"Selector operation {self.id} selected {len(self.thoughts)}"
         )
-
-
-
-
@@ -42,3 +42,11 @@ class Parser(ABC):
             texts: List[str],
     ) -> List[float]:
         pass
+
+    def parse_batched_score_answer(
+            self,
+            states: List[Dict],
+            texts: List[str],
+    ) -> List[float]:
+        # 一个打分提示中包含多个状态时, 把回答拆分为每个状态的分数
+        return self.parse_score_answer(states, texts)
@@ -1,8 +1,15 @@
-from typing import Dict, List
+from typing import Dict, List, Optional
 from abc import ABC, abstractmethod
 
+from assistant.llm.prompt_cache import Prompt
+
 
 class Prompter(ABC):
+    # 提示可以返回 Prompt(prefix, suffix): 前缀放所有思维共用的说明和文档, 后缀放当前思维的内容
+    # 语言模型据此复用已经发送过的前缀(提供方的提示缓存), 返回普通字符串时按没有前缀处理
+    def assemble(self, prefix: str, suffix: str = '') -> Prompt:
+        return Prompt(prefix, suffix)
+
     @abstractmethod
     def aggregation_prompt(
             self,
@@ -38,3 +45,12 @@ class Prompter(ABC):
     ) -> str:
         pass
 
+    def batched_score_prompt(
+            self,
+            state_dicts: List[Dict],
+            **kwargs
+    ) -> Optional[str]:
+        # 把多个状态放进一个打分提示, 回答由 Parser.parse_batched_score_answer 拆分为每个状态的分数
+        # 返回None表示不支持批量打分, Score 操作会逐个状态调用 score_prompt
+        return None
+
@@ -1,9 +1,14 @@
 import os
 import json
+import asyncio
 import logging
 
 from abc import ABC, abstractmethod
-from typing import List, Dict, Union, Any
+from typing import List, Dict, Optional, Tuple, Union, Any
+
+from .response_cache import ResponseCache, cache_key, cache_namespace
+from .telemetry import record_usage
+from .prompt_cache import PrefixTracker
 
 
 class AbstractLanguageModel(ABC):
@@ -11,20 +16,38 @@ class AbstractLanguageModel(ABC):
             self,
             config_path: str = '',
             model_name: str = '',
-            cache: bool = False
+            cache: Union[bool, ResponseCache] = False
     ) -> None:
         self.logger = logging.getLogger(self.__class__.__name__)
         self.config: Dict | None = None
         self.model_name: str = model_name
-        self.cache = cache
-        if self.cache:
-            self.response_cache: Dict[str, List[Any]] = {}
 
         self.load_config(config_path)
         self.prompt_tokens: int = 0
         self.completion_tokens: int = 0
         self.cost: float = 0.0
 
+        # cache 可以是True(使用共享缓存, 大小和SQLite路径读取配置中的 cache_max_bytes/cache_path)
+        # 或者直接传入一个 ResponseCache 实例
+        self.cache = bool(cache)
+        self.response_cache: Optional[ResponseCache] = None
+        if isinstance(cache, ResponseCache):
+            self.response_cache = cache
+        elif cache:
+            model_config = self.config.get(model_name, {}) if self.config else {}
+            self.response_cache = ResponseCache.shared(
+                model_config.get('cache_max_bytes', 64 * 1024 * 1024),
+                model_config.get('cache_path'),
+            )
+        self.cache_hits: int = 0
+        self.cache_misses: int = 0
+        self.saved_prompt_tokens: int = 0
+        self.saved_completion_tokens: int = 0
+
+        # 提示前缀的发送记录, 以及提供方报告的命中提示缓存的输入token数
+        self.prefix_tracker = PrefixTracker()
+        self.cached_prompt_tokens: int = 0
+
     def load_config(
             self,
             path: str
@@ -39,7 +62,78 @@ class AbstractLanguageModel(ABC):
         self.logger.debug(f'Loaded config from {path} for {self.model_name}')
 
     def clear_cache(self) -> None:
-        self.response_cache.clear()
+        # 缓存可能由多个模型共享, 只清空当前模型的条目
+        if self.response_cache is not None:
+            self.response_cache.clear(cache_namespace(self.cache_model_id()))
+
+    def cache_params(self) -> Dict:
+        return {}
+
+    def response_usage(self, response: Any) -> Tuple[int, int]:
+        return 0, 0
+
+    def cache_model_id(self) -> str:
+        return getattr(self, 'model_id', self.model_name)
+
+    def response_cache_key(self, query: str, num_responses: int) -> str:
+        return cache_key(self.cache_model_id(), self.cache_params(), num_responses, query)
+
+    def get_cached_response(self, query: str, num_responses: int) -> Optional[Any]:
+        if not self.cache:
+            return None
+
+        result = self.response_cache.lookup(self.response_cache_key(query, num_responses))
+        # 空的或者回答数不足的条目(修复之前写入的失败结果)按未命中处理
+        if result is None or not self.complete_response(result[0], num_responses):
+            self.cache_misses += 1
+            return None
+
+        response, prompt_tokens, completion_tokens = result
+        self.cache_hits += 1
+        record_usage(cache_hits=1)
+        self.saved_prompt_tokens += prompt_tokens
+        self.saved_completion_tokens += completion_tokens
+        return response
+
+    def complete_response(self, response: Any, num_responses: int) -> bool:
+        return bool(response) and len(self.get_response_texts(response)) == num_responses
+
+    def cache_response(self, query: str, num_responses: int, response: Any) -> None:
+        if not self.cache:
+            return
+        # 请求失败或者只得到部分回答时不缓存, 否则一次临时故障会被持久缓存当作结果一直返回
+        if not self.complete_response(response, num_responses):
+            self.logger.warning(f"Not caching incomplete response for {num_responses} samples")
+            return
+
+        prompt_tokens, completion_tokens = self.response_usage(response)
+        self.response_cache.put(
+            self.response_cache_key(query, num_responses), response, prompt_tokens, completion_tokens
+        )
+
+    def cache_stats(self) -> Dict:
+        total = self.cache_hits + self.cache_misses
+        stats = {
+            'hits': self.cache_hits,
+            'misses': self.cache_misses,
+            'hit_rate': self.cache_hits / total if total else 0.0,
+            'saved_prompt_tokens': self.saved_prompt_tokens,
+            'saved_completion_tokens': self.saved_completion_tokens,
+        }
+        if self.response_cache is not None:
+            stats['shared'] = self.response_cache.stats()
+        return stats
+
+    def observe_prompt(self, query: str) -> None:
+        reused = self.prefix_tracker.observe(query)
+        if reused:
+            record_usage(reused_prefix_tokens=reused)
+
+    def prompt_cache_stats(self) -> Dict:
+        stats = self.prefix_tracker.stats()
+        stats['cached_prompt_tokens'] = self.cached_prompt_tokens
+        stats['cached_ratio'] = self.cached_prompt_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+        return stats
 
     @abstractmethod
     def query(
@@ -49,6 +143,13 @@ class AbstractLanguageModel(ABC):
     ) -> Any:
         pass
 
+    async def aquery(
+            self,
+            query: str,
+            num_responses: int = 1
+    ) -> Any:
+        return await asyncio.to_thread(self.query, query, num_responses)
+
     @abstractmethod
     def get_response_texts(
             self,
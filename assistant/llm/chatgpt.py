@@ -1,13 +1,18 @@
 import os
 import time
 import random
+import asyncio
 import backoff
 
-from typing import List, Dict, Union, Any
-from openai import OpenAI, OpenAIError
+from typing import List, Dict, Tuple, Union, Any
+from openai import AsyncOpenAI, OpenAIError
 from openai.types.chat.chat_completion import ChatCompletion
 
 from .abstract_language_model import AbstractLanguageModel
+from .rate_limiter import AsyncRateLimiter, TokenBucketLimiter
+from .openai_clients import get_client, get_async_client
+from .telemetry import record_usage, record_retry
+from .prompt_cache import Prompt, estimate_tokens
 
 
 class ChatGPT(AbstractLanguageModel):
@@ -24,6 +29,12 @@ class ChatGPT(AbstractLanguageModel):
 
         self.prompt_token_cost: float = self.config['prompt_token_cost']
         self.response_token_cost: float = self.config['response_token_cost']
+        # 命中提示缓存的输入token单价, 未配置时按普通输入token计费
+        self.cached_prompt_token_cost: float = self.config.get(
+            'cached_prompt_token_cost', self.prompt_token_cost
+        )
+        # 提示带有静态前缀时按前缀发送 prompt_cache_key, 使相同前缀的请求路由到同一缓存
+        self.prompt_caching: bool = self.config.get('prompt_caching', True)
 
         self.temperature: float = self.config['temperature']
 
@@ -38,21 +49,43 @@ class ChatGPT(AbstractLanguageModel):
         if self.api_key == '':
             raise ValueError('OPENAI_API_KEY is not set.')
 
-        self.client = OpenAI(
-            api_key=self.api_key,
-            organization=self.organization
+        self.max_concurrency: int = self.config.get('max_concurrency', 16)
+        self.base_url = self.config.get('base_url')
+        # 相同凭据的模型共用进程内的长连接客户端
+        self.client = get_client(
+            self.api_key, self.organization, self.base_url, max_connections=self.max_concurrency
+        )
+        self.concurrency_limiter = AsyncRateLimiter(self.max_concurrency)
+        self.token_limiter = TokenBucketLimiter(
+            self.config.get('requests_per_minute'),
+            self.config.get('tokens_per_minute'),
+        )
+
+    @property
+    def async_client(self) -> AsyncOpenAI:
+        return get_async_client(
+            self.api_key, self.organization, self.base_url, max_connections=self.max_concurrency
         )
 
+    def request_options(self, query: str) -> Dict:
+        if self.prompt_caching and isinstance(query, Prompt) and query.prefix:
+            return {'prompt_cache_key': query.prefix_key}
+        return {}
+
     def query(
             self,
             query: str,
             num_responses: int = 1
     ) -> Union[List[ChatCompletion], ChatCompletion]:
-        if self.cache and query in self.response_cache:
-            return self.response_cache[query]
+        cached = self.get_cached_response(query, num_responses)
+        if cached is not None:
+            return cached
 
+        self.observe_prompt(query)
+        options = self.request_options(query)
+        requested_responses = num_responses
         if num_responses == 1:
-            response = self.chat([{'role': 'user', 'content': query}], num_responses)
+            response = self.chat([{'role': 'user', 'content': str(query)}], num_responses, **options)
         else:
             response = []
             next_try = num_responses
@@ -60,27 +93,45 @@ class ChatGPT(AbstractLanguageModel):
             while num_responses > 0 and total_num_attempts > 0:
                 try:
                     assert next_try > 0
-                    res = self.chat([{'role': 'user', 'content': query}], next_try)
+                    res = self.chat([{'role': 'user', 'content': str(query)}], next_try, **options)
                     response.append(res)
                     num_responses -= next_try
                     next_try = min(num_responses, next_try)
                 except Exception as e:
                     next_try = (next_try + 1) // 2
+                    record_retry()
                     self.logger.warning(
                         f"Error in chatgpt: {e}, trying again with {next_try} samples"
                     )
                     time.sleep(random.randint(1, 3))
                     total_num_attempts -= 1
 
-        if self.cache:
-            self.response_cache[query] = response
+        self.cache_response(query, requested_responses, response)
         return response
 
-    @backoff.on_exception(backoff.expo, OpenAIError, max_time=10, max_tries=6)
+    def cache_params(self) -> Dict:
+        return {
+            'temperature': self.temperature,
+            'max_tokens': self.max_tokens,
+            'stop': self.stop,
+        }
+
+    def response_usage(
+            self,
+            response: Union[List[ChatCompletion], ChatCompletion]
+    ) -> Tuple[int, int]:
+        responses = response if isinstance(response, list) else [response]
+        return (
+            sum(res.usage.prompt_tokens for res in responses if res.usage),
+            sum(res.usage.completion_tokens for res in responses if res.usage),
+        )
+
+    @backoff.on_exception(backoff.expo, OpenAIError, max_time=10, max_tries=6, on_backoff=record_retry)
     def chat(
             self,
             messages: List[Dict],
-            num_responses: int = 1
+            num_responses: int = 1,
+            **options
     ) -> ChatCompletion:
         response = self.client.chat.completions.create(
             model=self.model_id,
@@ -89,14 +140,29 @@ class ChatGPT(AbstractLanguageModel):
             max_tokens=self.max_tokens,
             n=num_responses,
             stop=self.stop,
+            **options,
         )
 
+        return self.update_usage(response)
+
+    def update_usage(self, response: ChatCompletion) -> ChatCompletion:
+        details = getattr(response.usage, 'prompt_tokens_details', None)
+        cached_tokens = (getattr(details, 'cached_tokens', None) or 0) if details else 0
         self.prompt_tokens += response.usage.prompt_tokens
         self.completion_tokens += response.usage.completion_tokens
-        prompt_tokens_k = float(self.prompt_token_cost) / 1000.0
+        self.cached_prompt_tokens += cached_tokens
+        record_usage(
+            lm_calls=1,
+            prompt_tokens=response.usage.prompt_tokens,
+            completion_tokens=response.usage.completion_tokens,
+            cached_prompt_tokens=cached_tokens,
+        )
+        prompt_tokens_k = float(self.prompt_tokens - self.cached_prompt_tokens) / 1000.0
+        cached_tokens_k = float(self.cached_prompt_tokens) / 1000.0
         completion_tokens_k = float(self.completion_tokens) / 1000.0
         self.cost = (
             self.prompt_token_cost * prompt_tokens_k
+            + self.cached_prompt_token_cost * cached_tokens_k
             + self.response_token_cost * completion_tokens_k
         )
         self.logger.info(
@@ -105,6 +171,82 @@ class ChatGPT(AbstractLanguageModel):
         )
         return response
 
+    def estimate_tokens(self, messages: List[Dict], num_responses: int) -> int:
+        # 粗略估计: 按每4个字符一个token计算输入, 输出按最大长度计算
+        prompt_tokens = estimate_tokens(''.join(str(message.get('content', '')) for message in messages))
+        return prompt_tokens + self.max_tokens * num_responses
+
+    @backoff.on_exception(backoff.expo, OpenAIError, max_time=10, max_tries=6, on_backoff=record_retry)
+    async def achat(
+            self,
+            messages: List[Dict],
+            num_responses: int = 1,
+            **options
+    ) -> ChatCompletion:
+        start = time.monotonic()
+        await self.token_limiter.acquire(self.estimate_tokens(messages, num_responses))
+        async with self.concurrency_limiter:
+            record_usage(queue_wait=time.monotonic() - start)
+            response = await self.async_client.chat.completions.create(
+                model=self.model_id,
+                messages=messages,
+                temperature=self.temperature,
+                max_tokens=self.max_tokens,
+                n=num_responses,
+                stop=self.stop,
+                **options,
+            )
+
+        return self.update_usage(response)
+
+    async def achat_split(
+            self,
+            messages: List[Dict],
+            num_responses: int,
+            attempts: List[int],
+            **options
+    ) -> List[ChatCompletion]:
+        try:
+            return [await self.achat(messages, num_responses, **options)]
+        except Exception as e:
+            attempts[0] -= 1
+            record_retry()
+            if attempts[0] <= 0:
+                self.logger.warning(f"Error in chatgpt: {e}, giving up on {num_responses} samples")
+                return []
+
+            # 失败时把请求拆成两半并行重试
+            half = (num_responses + 1) // 2
+            self.logger.warning(
+                f"Error in chatgpt: {e}, trying again with {half} and {num_responses - half} samples"
+            )
+            await asyncio.sleep(random.uniform(1, 3))
+            parts = await asyncio.gather(*[
+                self.achat_split(messages, part, attempts, **options)
+                for part in [half, num_responses - half] if part > 0
+            ])
+            return [response for part in parts for response in part]
+
+    async def aquery(
+            self,
+            query: str,
+            num_responses: int = 1
+    ) -> Union[List[ChatCompletion], ChatCompletion]:
+        cached = self.get_cached_response(query, num_responses)
+        if cached is not None:
+            return cached
+
+        self.observe_prompt(query)
+        options = self.request_options(query)
+        messages = [{'role': 'user', 'content': str(query)}]
+        if num_responses == 1:
+            response = await self.achat(messages, num_responses, **options)
+        else:
+            response = await self.achat_split(messages, num_responses, [num_responses], **options)
+
+        self.cache_response(query, num_responses, response)
+        return response
+
     def get_response_texts(
             self,
             query_response: Union[List[ChatCompletion], ChatCompletion]
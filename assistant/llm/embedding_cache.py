@@ -0,0 +1,319 @@
+import os
+import json
+import atexit
+import hashlib
+import logging
+import threading
+import unicodedata
+
+import numpy as np
+
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from .embedding_models import BaseEmbeddingModel
+
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+# 按 (模型名, 归一化文本哈希) 缓存embedding, 向量存放在内存映射的float32矩阵中,
+# 索引文件记录每个键所在的行以及LRU顺序; 每行另存键的摘要, 读取时校验,
+# 避免索引尚未落盘时行被复用后, 旧键读到新向量
+class EmbeddingCache:
+    _instances: Dict[str, "EmbeddingCache"] = {}
+    _instances_lock = threading.Lock()
+
+    INDEX_FILE = "index.json"
+    DATA_FILE = "embeddings.f32"
+    KEYS_FILE = "keys.bin"
+    KEY_BYTES = 32
+
+    def __init__(
+            self,
+            cache_dir: str,
+            model_name: str,
+            max_entries: int = 100_000,
+            flush_every: int = 256,
+    ) -> None:
+        if max_entries < 1:
+            raise ValueError("max_entries must be at least 1")
+
+        self.model_name = model_name
+        self.directory = os.path.join(
+            cache_dir, hashlib.sha256(model_name.encode("utf-8")).hexdigest()[:16]
+        )
+        os.makedirs(self.directory, exist_ok=True)
+        self.index_path = os.path.join(self.directory, self.INDEX_FILE)
+        self.data_path = os.path.join(self.directory, self.DATA_FILE)
+        self.keys_path = os.path.join(self.directory, self.KEYS_FILE)
+
+        self.max_entries = max_entries
+        self.flush_every = flush_every
+        self.lock = threading.RLock()
+
+        self.dim: Optional[int] = None
+        self.capacity = 0
+        self.entries: OrderedDict[str, int] = OrderedDict()
+        self.free_rows: List[int] = []
+        self.next_row = 0
+        self.data: Optional[np.memmap] = None
+        self.row_keys: Optional[np.memmap] = None
+        self.dirty = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.load()
+        atexit.register(self.flush)
+
+    @classmethod
+    def open(
+            cls,
+            cache_dir: str,
+            model_name: str,
+            max_entries: int = 100_000,
+    ) -> "EmbeddingCache":
+        key = os.path.abspath(cache_dir) + "::" + model_name
+        with cls._instances_lock:
+            if key not in cls._instances:
+                cls._instances[key] = cls(cache_dir, model_name, max_entries)
+            return cls._instances[key]
+
+    def load(self) -> None:
+        if not os.path.exists(self.index_path):
+            return
+
+        with open(self.index_path, "r") as file:
+            index = json.load(file)
+
+        if index.get("model_name") != self.model_name:
+            logging.warning(
+                f"Embedding cache at {self.directory} belongs to {index.get('model_name')}, ignoring it"
+            )
+            return
+
+        self.dim = index["dim"]
+        self.capacity = index["capacity"]
+        self.next_row = index["next_row"]
+        self.free_rows = index["free_rows"]
+        self.entries = OrderedDict(index["entries"])
+        self.data = np.memmap(
+            self.data_path, dtype=np.float32, mode="r+", shape=(self.capacity, self.dim)
+        )
+        # 旧版本的缓存没有键摘要文件, 补一个全零的, 校验不通过的行按未命中处理
+        self.resize_file(self.keys_path, self.capacity * self.KEY_BYTES)
+        self.row_keys = np.memmap(
+            self.keys_path, dtype=np.uint8, mode="r+", shape=(self.capacity, self.KEY_BYTES)
+        )
+
+        while len(self.entries) > self.max_entries:
+            self.evict()
+            self.dirty += 1
+
+        logging.info(
+            f"Loaded embedding cache for {self.model_name} with {len(self.entries)} entries"
+        )
+
+    def flush(self) -> None:
+        with self.lock:
+            if self.dim is None or self.dirty == 0:
+                return
+
+            self.data.flush()
+            self.row_keys.flush()
+            index = {
+                "model_name": self.model_name,
+                "dim": self.dim,
+                "capacity": self.capacity,
+                "next_row": self.next_row,
+                "free_rows": self.free_rows,
+                "entries": list(self.entries.items()),
+            }
+            tmp_path = self.index_path + ".tmp"
+            with open(tmp_path, "w") as file:
+                json.dump(index, file)
+            os.replace(tmp_path, self.index_path)
+            self.dirty = 0
+
+    @staticmethod
+    def resize_file(path: str, size: int) -> None:
+        with open(path, "ab") as file:
+            if file.tell() != size:
+                file.truncate(size)
+
+    @classmethod
+    def key_digest(cls, key: str) -> np.ndarray:
+        return np.frombuffer(hashlib.sha256(key.encode("utf-8")).digest(), dtype=np.uint8)
+
+    def ensure_capacity(self, rows: int) -> None:
+        if rows <= self.capacity:
+            return
+
+        new_capacity = min(self.max_entries, max(rows, self.capacity * 2, 1024))
+        if self.data is not None:
+            self.data.flush()
+            self.row_keys.flush()
+            self.data = None
+            self.row_keys = None
+        self.resize_file(self.data_path, new_capacity * self.dim * np.dtype(np.float32).itemsize)
+        self.resize_file(self.keys_path, new_capacity * self.KEY_BYTES)
+        self.data = np.memmap(
+            self.data_path, dtype=np.float32, mode="r+", shape=(new_capacity, self.dim)
+        )
+        self.row_keys = np.memmap(
+            self.keys_path, dtype=np.uint8, mode="r+", shape=(new_capacity, self.KEY_BYTES)
+        )
+        self.capacity = new_capacity
+
+    def evict(self) -> None:
+        _, row = self.entries.popitem(last=False)
+        self.free_rows.append(row)
+        self.evictions += 1
+
+    def allocate_row(self) -> int:
+        if len(self.entries) >= self.max_entries:
+            self.evict()
+        if self.free_rows:
+            return self.free_rows.pop()
+
+        self.ensure_capacity(self.next_row + 1)
+        row = self.next_row
+        self.next_row += 1
+        return row
+
+    def get(self, key: str) -> Optional[List[float]]:
+        with self.lock:
+            row = self.entries.get(key)
+            if row is not None and not np.array_equal(self.row_keys[row], self.key_digest(key)):
+                # 索引还指向已被其他键复用的行(上次落盘后进程退出), 丢弃这条记录, 行可以重新分配
+                del self.entries[key]
+                self.free_rows.append(row)
+                self.dirty += 1
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.data[row].tolist()
+
+    def put(self, key: str, embedding) -> None:
+        embedding = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        with self.lock:
+            if self.dim is None:
+                self.dim = embedding.shape[0]
+            if embedding.shape[0] != self.dim:
+                raise ValueError(
+                    f"Embedding dimension {embedding.shape[0]} does not match cache dimension {self.dim}"
+                )
+
+            row = self.entries.get(key)
+            if row is None:
+                row = self.allocate_row()
+            # 先清掉行上的键摘要再写向量, 中途退出时这一行不会被任何键认领
+            self.row_keys[row] = 0
+            self.data[row] = embedding
+            self.row_keys[row] = self.key_digest(key)
+            self.entries[key] = row
+            self.entries.move_to_end(key)
+
+            self.dirty += 1
+            if self.dirty >= self.flush_every:
+                self.flush()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> Dict:
+        return {
+            "model_name": self.model_name,
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hit_rate,
+        }
+
+
+class CachedEmbeddingModel(BaseEmbeddingModel):
+    def __init__(
+            self,
+            embedding_model: BaseEmbeddingModel,
+            cache_dir: str,
+            model_name: Optional[str] = None,
+            max_entries: int = 100_000,
+    ):
+        if not isinstance(embedding_model, BaseEmbeddingModel):
+            raise ValueError("embedding_model must be an instance of BaseEmbeddingModel")
+
+        if model_name is None:
+            # 缓存按模型区分, 只有能确定具体模型(检查点)时才自动生成名字, 否则不同模型会读到彼此的向量
+            checkpoint = getattr(embedding_model, "model_name", None)
+            if checkpoint is None and isinstance(getattr(embedding_model, "model", None), str):
+                checkpoint = embedding_model.model
+            if not isinstance(checkpoint, str) or not checkpoint:
+                raise ValueError(
+                    f"model_name is required to cache embeddings of {type(embedding_model).__name__}"
+                )
+            model_name = f"{type(embedding_model).__name__}:{checkpoint}"
+
+        self.embedding_model = embedding_model
+        self.model_name = model_name
+        self.cache = EmbeddingCache.open(cache_dir, model_name, max_entries)
+
+    def create_embedding(self, text: str) -> List:
+        key = text_hash(text)
+        embedding = self.cache.get(key)
+        if embedding is None:
+            embedding = self.embedding_model.create_embedding(text)
+            self.cache.put(key, embedding)
+        return embedding
+
+    def split_cached(self, texts: List[str]):
+        keys = [text_hash(text) for text in texts]
+        embeddings = [self.cache.get(key) for key in keys]
+        missing = [position for position, embedding in enumerate(embeddings) if embedding is None]
+        return keys, embeddings, missing
+
+    def fill_missing(self, keys, embeddings, missing, new_embeddings) -> List[List]:
+        for position, embedding in zip(missing, new_embeddings):
+            self.cache.put(keys[position], embedding)
+            embeddings[position] = embedding
+        self.cache.flush()
+        return embeddings
+
+    def create_embeddings(self, texts: List[str]) -> List[List]:
+        keys, embeddings, missing = self.split_cached(texts)
+        if not missing:
+            return embeddings
+
+        new_embeddings = self.embedding_model.create_embeddings(
+            [texts[position] for position in missing]
+        )
+        return self.fill_missing(keys, embeddings, missing, new_embeddings)
+
+    async def acreate_embeddings(self, texts: List[str]) -> List[List]:
+        keys, embeddings, missing = self.split_cached(texts)
+        if not missing:
+            return embeddings
+
+        new_embeddings = await self.embedding_model.acreate_embeddings(
+            [texts[position] for position in missing]
+        )
+        return self.fill_missing(keys, embeddings, missing, new_embeddings)
+
+    def stats(self) -> Dict:
+        return self.cache.stats()
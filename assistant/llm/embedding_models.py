@@ -1,11 +1,14 @@
+import asyncio
 import logging
+import tiktoken
 
-from typing import List
-from openai import OpenAI
+from typing import List, Optional
 from abc import ABC, abstractmethod
 from sentence_transformers import SentenceTransformer
 from tenacity import retry, stop_after_attempt, wait_random_exponential
 
+from .openai_clients import get_client, get_async_client
+
 logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
 
 
@@ -14,11 +17,49 @@ class BaseEmbeddingModel(ABC):
     def create_embedding(self, text: str) -> List:
         pass
 
+    def create_embeddings(self, texts: List[str]) -> List[List]:
+        return [self.create_embedding(text) for text in texts]
+
+    async def acreate_embeddings(self, texts: List[str]) -> List[List]:
+        return await asyncio.to_thread(self.create_embeddings, texts)
+
 
 class OpenAIEmbeddingModel(BaseEmbeddingModel):
-    def __init__(self, model: str = "text-embedding-ada-002"):
-        self.client = OpenAI()
+    def __init__(
+            self,
+            model: str = "text-embedding-ada-002",
+            batch_size: int = 256,
+            batch_max_tokens: int = 100_000,
+            max_concurrency: int = 4,
+            api_key: Optional[str] = None,
+            base_url: Optional[str] = None,
+    ):
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+        if batch_max_tokens < 1:
+            raise ValueError("batch_max_tokens must be at least 1")
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+
+        self.api_key = api_key
+        self.base_url = base_url
         self.model = model
+        self.batch_size = batch_size
+        self.batch_max_tokens = batch_max_tokens
+        self.max_concurrency = max_concurrency
+        try:
+            self.tokenizer = tiktoken.encoding_for_model(model)
+        except KeyError:
+            self.tokenizer = tiktoken.get_encoding("cl100k_base")
+
+    @property
+    def client(self):
+        return get_client(self.api_key, base_url=self.base_url, max_connections=self.max_concurrency)
+
+    @property
+    def async_client(self):
+        # 异步客户端绑定在事件循环上, run_sync 每次新建的事件循环各自取得自己的客户端
+        return get_async_client(self.api_key, base_url=self.base_url, max_connections=self.max_concurrency)
 
     @retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(6))
     def create_embedding(self, text: str) -> List:
@@ -29,10 +70,78 @@ class OpenAIEmbeddingModel(BaseEmbeddingModel):
             .embedding
         )
 
+    def create_batches(self, texts: List[str]) -> List[List[str]]:
+        batches = []
+        current_batch = []
+        current_tokens = 0
+        for text, tokens in zip(texts, self.tokenizer.encode_batch(texts)):
+            n_tokens = len(tokens)
+            if current_batch and (
+                len(current_batch) >= self.batch_size
+                or current_tokens + n_tokens > self.batch_max_tokens
+            ):
+                batches.append(current_batch)
+                current_batch = []
+                current_tokens = 0
+
+            current_batch.append(text)
+            current_tokens += n_tokens
+
+        if current_batch:
+            batches.append(current_batch)
+
+        return batches
+
+    @retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(6))
+    def embed_batch(self, texts: List[str]) -> List[List]:
+        response = self.client.embeddings.create(input=texts, model=self.model)
+        return [data.embedding for data in sorted(response.data, key=lambda data: data.index)]
+
+    @retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(6))
+    async def aembed_batch(self, texts: List[str]) -> List[List]:
+        response = await self.async_client.embeddings.create(input=texts, model=self.model)
+        return [data.embedding for data in sorted(response.data, key=lambda data: data.index)]
+
+    def create_embeddings(self, texts: List[str]) -> List[List]:
+        texts = [text.replace("\n", " ") for text in texts]
+        batches = self.create_batches(texts)
+        logging.info(f"Embedding {len(texts)} texts in {len(batches)} batches")
+
+        embeddings = []
+        for batch in batches:
+            embeddings.extend(self.embed_batch(batch))
+
+        return embeddings
+
+    async def acreate_embeddings(self, texts: List[str]) -> List[List]:
+        texts = [text.replace("\n", " ") for text in texts]
+        batches = self.create_batches(texts)
+        logging.info(f"Embedding {len(texts)} texts in {len(batches)} batches")
+
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def embed(batch):
+            async with semaphore:
+                return await self.aembed_batch(batch)
+
+        results = await asyncio.gather(*[embed(batch) for batch in batches])
+        return [embedding for result in results for embedding in result]
+
 
 class SBertEmbeddingModel(BaseEmbeddingModel):
-    def __init__(self, model_name: str = "sentence-transformers/multi-qa-mpnet-base-cos-v1"):
+    def __init__(
+            self,
+            model_name: str = "sentence-transformers/multi-qa-mpnet-base-cos-v1",
+            batch_size: int = 32,
+    ):
+        self.model_name = model_name
         self.model = SentenceTransformer(model_name)
+        self.batch_size = batch_size
 
     def create_embedding(self, text: str) -> List:
         return self.model.encode(text)
+
+    def create_embeddings(self, texts: List[str]) -> List[List]:
+        if len(texts) == 0:
+            return []
+        return list(self.model.encode(texts, batch_size=self.batch_size))
@@ -1,12 +1,19 @@
 import os
+import copy
 import torch
 
-from typing import List, Dict, Union, Any
+from typing import List, Dict, Optional, Tuple, Union, Any
 
 from .abstract_language_model import AbstractLanguageModel
+from .telemetry import record_usage
 
 
 class Llama2HF(AbstractLanguageModel):
+    system_prompt: str = (
+        "<SYS>You are a helpful assistant. Always follow the instructions precisely and output "
+        "the response exactly in the requested format.<</SYS>>\n\n"
+    )
+
     def __init__(
             self,
             config_path: str = '',
@@ -27,70 +34,193 @@ class Llama2HF(AbstractLanguageModel):
 
         self.max_tokens: int = self.config['max_tokens']
 
-        os.environ["TRANSFORMERS_CACHE"] = self.config["cache_dir"]
+        # batch_size: 一次前向计算中填充在一起的提示数
+        # reuse_prefix_cache: 所有提示共享的系统提示只计算一次KV, 之后每个批次复制使用
+        self.batch_size: int = self.config.get('batch_size', 8)
+        self.reuse_prefix_cache: bool = self.config.get('reuse_prefix_cache', True)
+
+        device = self.config.get('device', 'auto')
+        if device == 'auto':
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(device)
+        # bitsandbytes量化只支持GPU, CPU上使用float32加载, 方便用小模型做基准测试
+        load_in_4bit = self.config.get('load_in_4bit', True) and self.device.type == 'cuda'
+        torch_dtype = getattr(
+            torch, self.config.get('torch_dtype', 'bfloat16' if self.device.type == 'cuda' else 'float32')
+        )
+
+        if 'cache_dir' in self.config:
+            os.environ["TRANSFORMERS_CACHE"] = self.config["cache_dir"]
         import transformers
 
-        hf_model_id = f"meta-llama/{self.model_id}"
+        hf_model_id = self.config.get('hf_model_id', f"meta-llama/{self.model_id}")
         model_config = transformers.AutoConfig.from_pretrained(hf_model_id)
-        bnb_config = transformers.BitsAndBytesConfig(
-            load_in_4bit=True,
-            bnb_4bit_quant_type='nf4',
-            bnb_4bit_use_double_quant=True,
-            bnb_4bit_compute_dtype=torch.bfloat16,
-        )
+        model_kwargs = {}
+        if load_in_4bit:
+            model_kwargs['quantization_config'] = transformers.BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type='nf4',
+                bnb_4bit_use_double_quant=True,
+                bnb_4bit_compute_dtype=torch_dtype,
+            )
+            model_kwargs['device_map'] = "auto"
 
         self.tokenizer = transformers.AutoTokenizer.from_pretrained(hf_model_id)
+        if self.tokenizer.pad_token_id is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
         self.model = transformers.AutoModelForCausalLM.from_pretrained(
             hf_model_id,
             trust_remote_code=True,
             config=model_config,
-            quantization_config=bnb_config,
-            device_map="auto",
+            dtype=torch_dtype,
+            **model_kwargs,
         )
+        if not load_in_4bit:
+            self.model.to(self.device)
         self.model.eval()
-        torch.no_grad()
 
-        self.generate_text = transformers.pipeline(
-            model=self.model,
-            tokenizer=self.tokenizer,
-            task="text-generation"
+        self.prefix_ids: List[int] = self.tokenizer(self.system_prompt)['input_ids']
+        self.prefix_cache: Optional[Any] = None
+
+    def format_prompt(self, query: str) -> str:
+        return f"[INST] {query} [/INST]"
+
+    def encode(self, queries: List[str]) -> Tuple[torch.Tensor, torch.Tensor]:
+        # 共享前缀放在最前面, 填充放在前缀和各自的问题之间, 由注意力掩码屏蔽
+        # 这样所有提示的前缀位置一致, 可以直接复用前缀的KV缓存
+        suffixes = [
+            self.tokenizer(self.format_prompt(query), add_special_tokens=False)['input_ids']
+            for query in queries
+        ]
+        width = max(len(suffix) for suffix in suffixes)
+        pad = self.tokenizer.pad_token_id
+        input_ids = [
+            self.prefix_ids + [pad] * (width - len(suffix)) + suffix
+            for suffix in suffixes
+        ]
+        attention_mask = [
+            [1] * len(self.prefix_ids) + [0] * (width - len(suffix)) + [1] * len(suffix)
+            for suffix in suffixes
+        ]
+        return (
+            torch.tensor(input_ids, device=self.device),
+            torch.tensor(attention_mask, device=self.device),
         )
 
-    def query(
+    def get_prefix_cache(self) -> Any:
+        if self.prefix_cache is None:
+            prefix = torch.tensor([self.prefix_ids], device=self.device)
+            self.prefix_cache = self.model(input_ids=prefix, use_cache=True).past_key_values
+        return self.prefix_cache
+
+    def prefill(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> Any:
+        # 对整个批次只做一次prefill, 最后一个token留给generate计算第一个输出的logits
+        from transformers import DynamicCache
+
+        start = 0
+        if self.reuse_prefix_cache:
+            cache = copy.deepcopy(self.get_prefix_cache())
+            cache.batch_repeat_interleave(input_ids.shape[0])
+            start = len(self.prefix_ids)
+        else:
+            cache = DynamicCache(config=self.model.config)
+
+        if input_ids.shape[1] - 1 > start:
+            position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+            self.model(
+                input_ids=input_ids[:, start:-1],
+                attention_mask=attention_mask[:, :-1],
+                position_ids=position_ids[:, start:-1],
+                past_key_values=cache,
+                use_cache=True,
+            )
+        return cache
+
+    def generate(
             self,
-            query: str,
+            queries: List[str],
             num_responses: int = 1
-    ) -> List[Dict]:
-        if self.cache and query in self.response_cache:
-            return self.response_cache[query]
-
-        sequences = []
-        query = f"<s><SYS>You are a helpful assistant. Always follow the instructions precisely and output"
-        f"the response exactly in the requested format.<</SYS>>\n\n[INST] {query} [/INST]"
-        for _ in range(num_responses):
-            sequences.extend(
-                self.generate_text(
-                    query,
-                    do_sample=True,
-                    top_k=self.top_k,
-                    num_return_sequences=1,
-                    eos_token_id=self.tokenizer.eos_token_id,
-                    max_length=self.max_tokens,
-                )
+    ) -> List[List[str]]:
+        texts = []
+        for start in range(0, len(queries), self.batch_size):
+            texts.extend(self.generate_batch(queries[start: start + self.batch_size], num_responses))
+        return texts
+
+    def generate_batch(
+            self,
+            queries: List[str],
+            num_responses: int = 1
+    ) -> List[List[str]]:
+        input_ids, attention_mask = self.encode(queries)
+        # max_tokens 是每个提示自身长度加上输出的上限, 按真实长度(不含填充)计算各自能生成的token数,
+        # 批次按最长的预算生成后再逐行截断, 输出与单独生成时一致
+        budgets = (self.max_tokens - attention_mask.sum(-1)).clamp(min=0).repeat_interleave(num_responses)
+        with torch.inference_mode():
+            # 每个提示只prefill一次, 然后把KV缓存复制 num_responses 份并行采样
+            cache = self.prefill(input_ids, attention_mask)
+            cache.batch_repeat_interleave(num_responses)
+            outputs = self.model.generate(
+                input_ids=input_ids.repeat_interleave(num_responses, dim=0),
+                attention_mask=attention_mask.repeat_interleave(num_responses, dim=0),
+                past_key_values=cache,
+                do_sample=True,
+                temperature=self.temperature,
+                top_k=self.top_k,
+                max_new_tokens=max(int(budgets.max()), 1),
+                eos_token_id=self.tokenizer.eos_token_id,
+                pad_token_id=self.tokenizer.pad_token_id,
             )
 
-        response = [
-            {'generated_text': sequences["generated_text"][len(query): ].strip()}
-            for sequence in sequences
+        generated = outputs[:, input_ids.shape[1]:].clone()
+        positions = torch.arange(generated.shape[1], device=generated.device)
+        generated[positions.unsqueeze(0) >= budgets.unsqueeze(1).to(generated.device)] = self.tokenizer.pad_token_id
+        prompt_tokens = int(attention_mask.sum())
+        completion_tokens = int((generated != self.tokenizer.pad_token_id).sum())
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        record_usage(lm_calls=1, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+
+        texts = self.tokenizer.batch_decode(generated, skip_special_tokens=True)
+        return [
+            [text.strip() for text in texts[i * num_responses: (i + 1) * num_responses]]
+            for i in range(len(queries))
         ]
 
-        if self.cache:
-            self.response_cache[query] = response
+    def query(
+            self,
+            query: str,
+            num_responses: int = 1
+    ) -> List[Dict]:
+        return self.query_batch([query], num_responses)[0]
 
-        return response
+    def query_batch(
+            self,
+            queries: List[str],
+            num_responses: int = 1
+    ) -> List[List[Dict]]:
+        responses: List[Optional[List[Dict]]] = [
+            self.get_cached_response(query, num_responses) for query in queries
+        ]
+        missing = [i for i, response in enumerate(responses) if response is None]
+        if missing:
+            texts = self.generate([queries[i] for i in missing], num_responses)
+            for i, sequences in zip(missing, texts):
+                responses[i] = [{'generated_text': text} for text in sequences]
+                self.cache_response(queries[i], num_responses, responses[i])
+
+        return responses
+
+    def cache_params(self) -> Dict:
+        return {
+            'temperature': self.temperature,
+            'top_k': self.top_k,
+            'max_tokens': self.max_tokens,
+        }
 
     def get_response_texts(
             self,
-            query_responses: List[Dict]
+            query_responses: Union[List[Dict], List[List[Dict]]]
     ) -> List[str]:
-        return [query_response["generate_text"] for query_response in query_responses]
+        if query_responses and isinstance(query_responses[0], list):
+            query_responses = [response for responses in query_responses for response in responses]
+        return [query_response["generated_text"] for query_response in query_responses]
@@ -0,0 +1,95 @@
+import os
+import httpx
+import asyncio
+import weakref
+import threading
+
+from typing import Dict, Optional, Tuple
+from openai import AsyncOpenAI, OpenAI
+
+from .rate_limiter import AsyncRateLimiter
+
+
+# 进程内共享的长连接OpenAI客户端, 避免每次调用都新建客户端和TCP/TLS连接
+# 相同的 api_key/organization/base_url 共用一个连接池, base_url 可以指向本地的模拟服务器
+_clients: Dict[Tuple, OpenAI] = {}
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple, AsyncOpenAI]]" = weakref.WeakKeyDictionary()
+_rate_limiters: Dict[str, AsyncRateLimiter] = {}
+_lock = threading.Lock()
+
+
+def client_key(
+        api_key: Optional[str] = None,
+        organization: Optional[str] = None,
+        base_url: Optional[str] = None,
+) -> Tuple:
+    return (
+        api_key or os.environ.get("OPENAI_API_KEY"),
+        organization or None,
+        base_url or os.environ.get("OPENAI_BASE_URL"),
+    )
+
+
+def http_limits(max_connections: int) -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_connections,
+        keepalive_expiry=60.0,
+    )
+
+
+def get_client(
+        api_key: Optional[str] = None,
+        organization: Optional[str] = None,
+        base_url: Optional[str] = None,
+        max_connections: int = 32,
+) -> OpenAI:
+    key = client_key(api_key, organization, base_url)
+    with _lock:
+        if key not in _clients:
+            _clients[key] = OpenAI(
+                api_key=key[0],
+                organization=key[1],
+                base_url=key[2],
+                http_client=httpx.Client(limits=http_limits(max_connections)),
+            )
+        return _clients[key]
+
+
+def get_async_client(
+        api_key: Optional[str] = None,
+        organization: Optional[str] = None,
+        base_url: Optional[str] = None,
+        max_connections: int = 32,
+) -> AsyncOpenAI:
+    # 异步客户端的连接池绑定在事件循环上, 每个事件循环各自缓存
+    key = client_key(api_key, organization, base_url)
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    if key not in clients:
+        clients[key] = AsyncOpenAI(
+            api_key=key[0],
+            organization=key[1],
+            base_url=key[2],
+            http_client=httpx.AsyncClient(limits=http_limits(max_connections)),
+        )
+    return clients[key]
+
+
+async def close_async_clients() -> None:
+    # 关闭当前事件循环上缓存的异步客户端, 在事件循环结束前调用
+    # 客户端引用着自己的事件循环, 不关闭的话弱引用的条目永远不会被回收
+    clients = _async_clients.pop(asyncio.get_running_loop(), {})
+    for client in clients.values():
+        await client.close()
+
+
+def get_rate_limiter(
+        name: str,
+        max_concurrency: int = 16,
+        requests_per_minute: Optional[float] = None,
+) -> AsyncRateLimiter:
+    # 同名的限流器在进程内只创建一次, 之后的参数以第一次创建时为准
+    with _lock:
+        if name not in _rate_limiters:
+            _rate_limiters[name] = AsyncRateLimiter(max_concurrency, requests_per_minute)
+        return _rate_limiters[name]
@@ -0,0 +1,76 @@
+import hashlib
+import threading
+
+from typing import Dict, Tuple
+
+
+class Prompt(str):
+    # 由静态前缀(说明和文档等, 同一问题的所有思维都相同)和每个思维各自的后缀组成的提示
+    # 本身仍是完整的字符串, 不支持前缀缓存的语言模型和响应缓存可以按普通字符串使用
+    def __new__(cls, prefix: str, suffix: str = '') -> 'Prompt':
+        prompt = super().__new__(cls, prefix + suffix)
+        prompt.prefix = prefix
+        prompt.suffix = suffix
+        return prompt
+
+    @property
+    def prefix_key(self) -> str:
+        return prefix_key(self.prefix)
+
+
+def prefix_key(prefix: str) -> str:
+    return hashlib.sha256(prefix.encode('utf-8')).hexdigest()[:32]
+
+
+def split_prompt(query: str) -> Tuple[str, str]:
+    if isinstance(query, Prompt):
+        return query.prefix, query.suffix
+    return '', query
+
+
+def estimate_tokens(text: str) -> int:
+    # 粗略估计: 按每4个字符一个token计算, 其他模块估计token数也用这个函数
+    return max(1, len(text) // 4)
+
+
+class PrefixTracker:
+    # 记录已经发送过的提示前缀, 再次发送同一前缀时提供方可以命中提示缓存
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.prefixes: Dict[str, int] = {}
+        self.prefix_sends: int = 0
+        self.prefix_reuses: int = 0
+        self.reused_prefix_tokens: int = 0
+
+    def observe(self, query: str) -> int:
+        # 返回本次请求中可以复用的前缀token数(估计值), 第一次发送的前缀返回0
+        prefix, _ = split_prompt(query)
+        if not prefix:
+            return 0
+
+        key = prefix_key(prefix)
+        with self.lock:
+            self.prefix_sends += 1
+            if key not in self.prefixes:
+                self.prefixes[key] = 1
+                return 0
+            self.prefixes[key] += 1
+            self.prefix_reuses += 1
+            tokens = estimate_tokens(prefix)
+            self.reused_prefix_tokens += tokens
+            return tokens
+
+    def clear(self) -> None:
+        with self.lock:
+            self.prefixes.clear()
+            self.prefix_sends = 0
+            self.prefix_reuses = 0
+            self.reused_prefix_tokens = 0
+
+    def stats(self) -> Dict:
+        return {
+            'prefixes': len(self.prefixes),
+            'prefix_sends': self.prefix_sends,
+            'prefix_reuses': self.prefix_reuses,
+            'reused_prefix_tokens': self.reused_prefix_tokens,
+        }
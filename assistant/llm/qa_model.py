@@ -1,66 +1,137 @@
 import os
 import torch
+import asyncio
 import logging
 import getpass
 
-from openai import OpenAI
 from abc import ABC, abstractmethod
+from contextlib import nullcontext
+from typing import List, Optional, Union
 from transformers import T5ForConditionalGeneration, T5Tokenizer
 from tenacity import retry, stop_after_attempt, wait_random_exponential
 
+from .rate_limiter import AsyncRateLimiter
+from .openai_clients import get_client, get_async_client, get_rate_limiter
+
 
 class BaseQAModel(ABC):
     @abstractmethod
     def answer_question(self, context: str, question: str):
         pass
 
+    async def aanswer_question(self, context: str, question: str):
+        return await asyncio.to_thread(self.answer_question, context, question)
+
+    async def aanswer_questions(
+            self,
+            contexts: List[str],
+            questions: List[str],
+            limiter: Optional[AsyncRateLimiter] = None,
+    ) -> List[Union[str, BaseException]]:
+        async def answer(context, question):
+            async with limiter if limiter is not None else nullcontext():
+                return await self.aanswer_question(context, question)
+
+        return await asyncio.gather(
+            *[answer(context, question) for context, question in zip(contexts, questions)],
+            return_exceptions=True,
+        )
+
 
-class GPT3QAModel(BaseQAModel):
-    def __init__(self, model="text-davinci-003"):
+class OpenAIQAModel(BaseQAModel):
+    # 共享进程内的长连接客户端和同一模型的限流器
+    def __init__(
+            self,
+            model: str,
+            api_key: Optional[str] = None,
+            base_url: Optional[str] = None,
+            max_concurrency: int = 16,
+            requests_per_minute: Optional[float] = None,
+    ):
         self.model = model
-        self.client = OpenAI(api_key=os.environ["OPENAI_API_KEY"])
+        self.api_key = api_key or os.environ["OPENAI_API_KEY"]
+        self.base_url = base_url
+        self.max_concurrency = max_concurrency
+        self.limiter = get_rate_limiter(f"qa:{model}", max_concurrency, requests_per_minute)
+
+    @property
+    def client(self):
+        return get_client(self.api_key, base_url=self.base_url, max_connections=self.max_concurrency)
+
+    @property
+    def async_client(self):
+        return get_async_client(self.api_key, base_url=self.base_url, max_connections=self.max_concurrency)
+
+
+class GPT3QAModel(OpenAIQAModel):
+    def __init__(self, model="text-davinci-003", **kwargs):
+        super().__init__(model, **kwargs)
+
+    def completion_params(self, context: str, question: str, max_tokens: int = 150, stop_sequence=None):
+        return dict(
+            prompt=f"using the following information {context}. Answer the following question in less than 5-7 words, if possible: {question}",
+            temperature=0,
+            max_tokens=max_tokens,
+            top_p=1,
+            frequency_penalty=0,
+            presence_penalty=0,
+            stop=stop_sequence,
+            model=self.model,
+        )
 
     @retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(6))
+    def _attempt_answer_question(self, context: str, question: str, max_tokens: int = 150, stop_sequence=None):
+        response = self.client.completions.create(
+            **self.completion_params(context, question, max_tokens, stop_sequence)
+        )
+        return response.choices[0].text.strip()
+
     def answer_question(self, context: str, question: str, max_tokens: int = 150, stop_sequence=None):
         try:
-            response = self.client.completions.create(
-                prompt=f"using the following information {context}. Answer the following question in less than 5-7 words, if possible: {question}",
-                temperature=0,
-                max_tokens=max_tokens,
-                top_p=1,
-                frequency_penalty=0,
-                presence_penalty=0,
-                stop=stop_sequence,
-                model=self.model,
+            return self._attempt_answer_question(context, question, max_tokens, stop_sequence)
+        except Exception as e:
+            print(e)
+            return ""
+
+    @retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(6))
+    async def _aattempt_answer_question(self, context: str, question: str, max_tokens: int = 150, stop_sequence=None):
+        async with self.limiter:
+            response = await self.async_client.completions.create(
+                **self.completion_params(context, question, max_tokens, stop_sequence)
             )
-            return response.choices[0].text.strip()
+        return response.choices[0].text.strip()
+
+    async def aanswer_question(self, context: str, question: str, max_tokens: int = 150, stop_sequence=None):
+        try:
+            return await self._aattempt_answer_question(context, question, max_tokens, stop_sequence)
         except Exception as e:
             print(e)
             return ""
 
 
-class GPT3TurboQAModel(BaseQAModel):
-    def __init__(self, model="gpt-3.5-turbo"):
-        self.model = model
-        self.client = OpenAI(api_key=os.environ["OPENAI_API_KEY"])
+class GPT3TurboQAModel(OpenAIQAModel):
+    system_prompt = "You are Question Answer Portal"
+    prompt_template = "Given Context: {context} Give the best full answer amongst the option to question {question}"
+
+    def __init__(self, model="gpt-3.5-turbo", **kwargs):
+        super().__init__(model, **kwargs)
+
+    def messages(self, context: str, question: str):
+        return [
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": self.prompt_template.format(context=context, question=question)},
+        ]
 
     @retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(6))
     def _attempt_answer_question(self, context: str, question: str, max_tokens: int = 150, stop_sequence=None):
         response = self.client.chat.completions.create(
             model=self.model,
-            messages=[
-                {"role": "system", "content": "You are Question Answer Portal"},
-                {
-                    "role": "user",
-                    "content": f"Given Context: {context} Give the best full answer amongst the option to question {question}",
-                },
-            ],
+            messages=self.messages(context, question),
             temperature=0,
         )
 
         return response.choices[0].message.content.strip()
 
-    @retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(6))
     def answer_question(self, context: str, question: str, max_tokens: int = 150, stop_sequence=None):
         try:
             return self._attempt_answer_question(
@@ -70,32 +141,20 @@ class GPT3TurboQAModel(BaseQAModel):
             print(e)
             return e
 
-
-class GPT4QAModel(BaseQAModel):
-    def __init__(self, model="gpt-4"):
-        self.model = model
-        self.client = OpenAI(api_key=os.environ["OPENAI_API_KEY"])
-
     @retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(6))
-    def _attempt_answer_question(self, context: str, question: str, max_tokens: int = 150, stop_sequence=None):
-        response = self.client.chat.completions.create(
-            model=self.model,
-            messages=[
-                {"role": "system", "content": "You are Question Answering Portal"},
-                {
-                    "role": "user",
-                    "content": f"Given Context: {context} Given the best full answer amongst the option to question {question}",
-                },
-            ],
-            temperature=0,
-        )
+    async def _aattempt_answer_question(self, context: str, question: str, max_tokens: int = 150, stop_sequence=None):
+        async with self.limiter:
+            response = await self.async_client.chat.completions.create(
+                model=self.model,
+                messages=self.messages(context, question),
+                temperature=0,
+            )
 
         return response.choices[0].message.content.strip()
 
-    @retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(6))
-    def answer_question(self, context: str, question: str, max_tokens: int = 150, stop_sequence=None):
+    async def aanswer_question(self, context: str, question: str, max_tokens: int = 150, stop_sequence=None):
         try:
-            return self._attempt_answer_question(
+            return await self._aattempt_answer_question(
                 context, question, max_tokens, stop_sequence
             )
         except Exception as e:
@@ -103,6 +162,14 @@ class GPT4QAModel(BaseQAModel):
             return e
 
 
+class GPT4QAModel(GPT3TurboQAModel):
+    system_prompt = "You are Question Answering Portal"
+    prompt_template = "Given Context: {context} Given the best full answer amongst the option to question {question}"
+
+    def __init__(self, model="gpt-4", **kwargs):
+        super().__init__(model, **kwargs)
+
+
 class UnifiedQAModel(BaseQAModel):
     def __init__(self, model_name: str = "allenai/unifiedqa-v2-t5-3b-1363200"):
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
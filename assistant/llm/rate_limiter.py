@@ -0,0 +1,120 @@
+import time
+import asyncio
+
+from typing import Optional
+
+
+# 限制同时进行的请求数, 并按每分钟请求数把请求的开始时间均匀错开
+class AsyncRateLimiter:
+    def __init__(self, max_concurrency: int = 8, requests_per_minute: Optional[float] = None) -> None:
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        if requests_per_minute is not None and requests_per_minute <= 0:
+            raise ValueError("requests_per_minute must be positive")
+
+        self.max_concurrency = max_concurrency
+        self.requests_per_minute = requests_per_minute
+        self.interval = 60.0 / requests_per_minute if requests_per_minute else 0.0
+        self.semaphore: Optional[asyncio.Semaphore] = None
+        self.pacing_lock: Optional[asyncio.Lock] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.next_start = 0.0
+
+    def bind(self) -> None:
+        # asyncio原语绑定在创建时的事件循环上, 每次asyncio.run都需要重新创建
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+            self.pacing_lock = asyncio.Lock()
+            self.next_start = 0.0
+
+    async def acquire(self) -> None:
+        self.bind()
+        await self.semaphore.acquire()
+        if self.interval:
+            async with self.pacing_lock:
+                now = time.monotonic()
+                wait = self.next_start - now
+                self.next_start = max(now, self.next_start) + self.interval
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+    def release(self) -> None:
+        self.semaphore.release()
+
+    async def __aenter__(self) -> "AsyncRateLimiter":
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        self.release()
+
+
+# 令牌桶限流: 同时限制每分钟请求数(RPM)和每分钟token数(TPM), 两个桶都按时间连续补充
+class TokenBucketLimiter:
+    def __init__(
+            self,
+            requests_per_minute: Optional[float] = None,
+            tokens_per_minute: Optional[float] = None,
+    ) -> None:
+        if requests_per_minute is not None and requests_per_minute <= 0:
+            raise ValueError("requests_per_minute must be positive")
+        if tokens_per_minute is not None and tokens_per_minute <= 0:
+            raise ValueError("tokens_per_minute must be positive")
+
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.available_requests = requests_per_minute or 0.0
+        self.available_tokens = tokens_per_minute or 0.0
+        self.updated = time.monotonic()
+        self.lock: Optional[asyncio.Lock] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        elapsed_minutes = (now - self.updated) / 60.0
+        self.updated = now
+        if self.requests_per_minute:
+            self.available_requests = min(
+                self.requests_per_minute,
+                self.available_requests + elapsed_minutes * self.requests_per_minute,
+            )
+        if self.tokens_per_minute:
+            self.available_tokens = min(
+                self.tokens_per_minute,
+                self.available_tokens + elapsed_minutes * self.tokens_per_minute,
+            )
+
+    def wait_time(self, tokens: int) -> float:
+        wait = 0.0
+        if self.requests_per_minute and self.available_requests < 1:
+            wait = max(wait, (1 - self.available_requests) * 60.0 / self.requests_per_minute)
+        if self.tokens_per_minute:
+            # 单次请求超过桶容量时只等到桶满, 避免永远等待
+            tokens = min(tokens, self.tokens_per_minute)
+            if self.available_tokens < tokens:
+                wait = max(wait, (tokens - self.available_tokens) * 60.0 / self.tokens_per_minute)
+        return wait
+
+    def consume(self, tokens: int) -> None:
+        if self.requests_per_minute:
+            self.available_requests -= 1
+        if self.tokens_per_minute:
+            self.available_tokens -= min(tokens, self.tokens_per_minute)
+
+    async def acquire(self, tokens: int = 0) -> None:
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            self.lock = asyncio.Lock()
+
+        # 持锁等待, 保证请求按到达顺序获得配额
+        async with self.lock:
+            while True:
+                self.refill()
+                wait = self.wait_time(tokens)
+                if wait <= 0:
+                    self.consume(tokens)
+                    return
+                await asyncio.sleep(wait)
@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import pickle
+import hashlib
+import logging
+import sqlite3
+import threading
+
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+
+def cache_namespace(model_id: str) -> str:
+    # 缓存键以模型的命名空间开头, 共享缓存中可以只清空一个模型的条目
+    return hashlib.sha256(model_id.encode("utf-8")).hexdigest()[:16]
+
+
+def cache_key(model_id: str, params: Dict, num_responses: int, prompt: str) -> str:
+    payload = json.dumps(
+        {"model_id": model_id, "params": params, "n": num_responses, "prompt": prompt},
+        sort_keys=True,
+        default=str,
+    )
+    return f"{cache_namespace(model_id)}-{hashlib.sha256(payload.encode('utf-8')).hexdigest()}"
+
+
+# 两级响应缓存: 内存中按序列化字节数限制大小的LRU, 以及可选的SQLite持久层
+class ResponseCache:
+    _instances: Dict[str, "ResponseCache"] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, sqlite_path: Optional[str] = None) -> None:
+        if max_bytes < 1:
+            raise ValueError("max_bytes must be at least 1")
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.entries: OrderedDict[str, Tuple[bytes, int, int]] = OrderedDict()
+        self.lock = threading.RLock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.sqlite_path = sqlite_path
+        self.connection: Optional[sqlite3.Connection] = None
+        if sqlite_path is not None:
+            directory = os.path.dirname(os.path.abspath(sqlite_path))
+            os.makedirs(directory, exist_ok=True)
+            self.connection = sqlite3.connect(sqlite_path, check_same_thread=False)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value BLOB, prompt_tokens INTEGER, "
+                "completion_tokens INTEGER, created REAL)"
+            )
+            self.connection.commit()
+
+    @classmethod
+    def shared(cls, max_bytes: int = 64 * 1024 * 1024, sqlite_path: Optional[str] = None) -> "ResponseCache":
+        key = os.path.abspath(sqlite_path) if sqlite_path is not None else ""
+        with cls._instances_lock:
+            if key not in cls._instances:
+                cls._instances[key] = cls(max_bytes, sqlite_path)
+            elif cls._instances[key].max_bytes != max_bytes:
+                logging.getLogger(cls.__name__).warning(
+                    f"Shared response cache already exists with max_bytes={cls._instances[key].max_bytes}, "
+                    f"ignoring max_bytes={max_bytes}"
+                )
+            return cls._instances[key]
+
+    def store_in_memory(self, key: str, entry: Tuple[bytes, int, int]) -> None:
+        if key in self.entries:
+            self.current_bytes -= len(self.entries.pop(key)[0])
+
+        if len(entry[0]) > self.max_bytes:
+            return
+
+        self.entries[key] = entry
+        self.current_bytes += len(entry[0])
+        while self.current_bytes > self.max_bytes:
+            _, (evicted, _, _) = self.entries.popitem(last=False)
+            self.current_bytes -= len(evicted)
+            self.evictions += 1
+
+    def lookup(self, key: str) -> Optional[Tuple[Any, int, int]]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+            elif self.connection is not None:
+                row = self.connection.execute(
+                    "SELECT value, prompt_tokens, completion_tokens FROM responses WHERE key = ?",
+                    (key,),
+                ).fetchone()
+                if row is not None:
+                    entry = (bytes(row[0]), row[1], row[2])
+                    self.store_in_memory(key, entry)
+                    self.hits += 1
+                    self.disk_hits += 1
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+        value, prompt_tokens, completion_tokens = entry
+        return pickle.loads(value), prompt_tokens, completion_tokens
+
+    def get(self, key: str) -> Optional[Any]:
+        result = self.lookup(key)
+        return None if result is None else result[0]
+
+    def put(self, key: str, value: Any, prompt_tokens: int = 0, completion_tokens: int = 0) -> None:
+        try:
+            data = pickle.dumps(value)
+        except Exception as e:
+            self.logger.warning(f"Response is not picklable and will not be cached: {e}")
+            return
+
+        entry = (data, prompt_tokens, completion_tokens)
+        with self.lock:
+            self.store_in_memory(key, entry)
+            if self.connection is not None:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                    (key, sqlite3.Binary(data), prompt_tokens, completion_tokens, time.time()),
+                )
+                self.connection.commit()
+
+    def clear(self, namespace: Optional[str] = None) -> None:
+        # 指定命名空间时只删除该模型的条目, 否则清空整个缓存
+        with self.lock:
+            if namespace is None:
+                self.entries.clear()
+                self.current_bytes = 0
+                if self.connection is not None:
+                    self.connection.execute("DELETE FROM responses")
+                    self.connection.commit()
+                return
+
+            prefix = f"{namespace}-"
+            for key in [key for key in self.entries if key.startswith(prefix)]:
+                self.current_bytes -= len(self.entries.pop(key)[0])
+            if self.connection is not None:
+                self.connection.execute(
+                    "DELETE FROM responses WHERE substr(key, 1, ?) = ?", (len(prefix), prefix)
+                )
+                self.connection.commit()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> Dict:
+        return {
+            "entries": len(self.entries),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hit_rate,
+        }
@@ -1,10 +1,15 @@
 import os
+import asyncio
 import logging
 
-from openai import OpenAI
 from abc import ABC, abstractmethod
+from contextlib import nullcontext
+from typing import List, Optional, Union
 from tenacity import retry, stop_after_attempt, wait_random_exponential
 
+from .rate_limiter import AsyncRateLimiter
+from .openai_clients import get_client, get_async_client, get_rate_limiter
+
 logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
 
 
@@ -13,57 +18,94 @@ class BaseSummarizationModel(ABC):
     def summarize(self, context: str, max_tokens: int = 150):
         pass
 
+    async def asummarize(self, context: str, max_tokens: int = 150):
+        return await asyncio.to_thread(self.summarize, context, max_tokens)
+
+    async def asummarize_batch(
+            self,
+            contexts: List[str],
+            max_tokens: int = 150,
+            limiter: Optional[AsyncRateLimiter] = None,
+    ) -> List[Union[str, BaseException]]:
+        # 并发摘要多个文本, 结果与输入顺序一致, 失败的位置返回异常
+        async def summarize(context):
+            async with limiter if limiter is not None else nullcontext():
+                return await self.asummarize(context, max_tokens)
+
+        return await asyncio.gather(
+            *[summarize(context) for context in contexts], return_exceptions=True
+        )
+
 
 class GPT3TurboSummarization(BaseSummarizationModel):
-    def __init__(self, model: str = "gpt-3.5-turbo"):
+    prompt_template = "Write a summary of the following, including as manny key details as possible: {context}:"
+
+    def __init__(
+            self,
+            model: str = "gpt-3.5-turbo",
+            api_key: Optional[str] = None,
+            base_url: Optional[str] = None,
+            max_concurrency: int = 16,
+            requests_per_minute: Optional[float] = None,
+    ):
         self.model = model
+        self.api_key = api_key
+        self.base_url = base_url
+        self.max_concurrency = max_concurrency
+        # 同一模型的所有实例共享进程级的并发和速率限制
+        self.limiter = get_rate_limiter(f"summarization:{model}", max_concurrency, requests_per_minute)
+
+    @property
+    def client(self):
+        return get_client(self.api_key, base_url=self.base_url, max_connections=self.max_concurrency)
+
+    def messages(self, context: str):
+        return [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": self.prompt_template.format(context=context)},
+        ]
 
     @retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(6))
-    def summarize(self, context: str, max_tokens: int = 500, stop_sequence=None):
-        try:
-            client = OpenAI()
+    def _attempt_summarize(self, context: str, max_tokens: int = 500, stop_sequence=None):
+        response = self.client.chat.completions.create(
+            model=self.model,
+            messages=self.messages(context),
+            max_tokens=max_tokens,
+        )
 
-            response = client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant."},
-                    {
-                        "role": "user",
-                        "content": f"Write a summary of the following, including as manny key details as possible: {context}:",
-                    },
-                ],
-                max_tokens=max_tokens,
-            )
+        return response.choices[0].message.content
 
-            return response.choices[0].message.content
+    def summarize(self, context: str, max_tokens: int = 500, stop_sequence=None):
+        try:
+            return self._attempt_summarize(context, max_tokens, stop_sequence)
         except Exception as e:
             print(e)
             return e
 
-
-class GPT3SummarizationModel(BaseSummarizationModel):
-    def __init__(self, model: str = "text-davinci-003"):
-        self.model = model
-
     @retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(6))
-    def summarize(self, context: str, max_tokens: int = 500, stop_sequence=None):
-        try:
-            client = OpenAI()
-
-            response = client.chat.completions.create(
+    async def _aattempt_summarize(self, context: str, max_tokens: int = 500, stop_sequence=None):
+        async with self.limiter:
+            client = get_async_client(
+                self.api_key, base_url=self.base_url, max_connections=self.max_concurrency
+            )
+            response = await client.chat.completions.create(
                 model=self.model,
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant."},
-                    {
-                        "role": "user",
-                        "content": f"Write a summary of the following, including as many key details as possible: {context}:",
-                    },
-                ],
+                messages=self.messages(context),
                 max_tokens=max_tokens,
             )
 
-            return response.choices[0].message.content
+        return response.choices[0].message.content
 
+    async def asummarize(self, context: str, max_tokens: int = 500, stop_sequence=None):
+        try:
+            return await self._aattempt_summarize(context, max_tokens, stop_sequence)
         except Exception as e:
             print(e)
             return e
+
+
+class GPT3SummarizationModel(GPT3TurboSummarization):
+    prompt_template = "Write a summary of the following, including as many key details as possible: {context}:"
+
+    def __init__(self, model: str = "text-davinci-003", **kwargs):
+        super().__init__(model, **kwargs)
@@ -0,0 +1,89 @@
+import json
+import threading
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional
+
+
+# 语言模型调用的用量统计, 通过contextvars归集到当前正在执行的操作上
+# asyncio任务和 asyncio.to_thread 都会复制上下文, 并发执行的操作各自统计互不干扰
+class CallMetrics:
+    fields = (
+        'lm_calls', 'prompt_tokens', 'completion_tokens', 'cache_hits', 'retries', 'queue_wait',
+        'reused_prefix_tokens', 'cached_prompt_tokens',
+    )
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.lm_calls: int = 0
+        self.prompt_tokens: int = 0
+        self.completion_tokens: int = 0
+        self.cache_hits: int = 0
+        self.retries: int = 0
+        self.queue_wait: float = 0.0
+        # reused_prefix_tokens: 重复发送的提示前缀token数(估计值)
+        # cached_prompt_tokens: 提供方实际报告的命中提示缓存的输入token数
+        self.reused_prefix_tokens: int = 0
+        self.cached_prompt_tokens: int = 0
+
+    def add(self, **counts) -> None:
+        with self.lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def as_dict(self) -> Dict:
+        return {name: getattr(self, name) for name in self.fields}
+
+
+current_metrics: ContextVar[Optional[CallMetrics]] = ContextVar('current_metrics', default=None)
+
+
+@contextmanager
+def track(metrics: CallMetrics) -> Iterator[CallMetrics]:
+    token = current_metrics.set(metrics)
+    try:
+        yield metrics
+    finally:
+        current_metrics.reset(token)
+
+
+def record_usage(**counts) -> None:
+    metrics = current_metrics.get()
+    if metrics is not None:
+        metrics.add(**counts)
+
+
+def record_retry(details: Optional[Dict] = None) -> None:
+    # 可以直接作为 backoff 的 on_backoff 回调
+    record_usage(retries=1)
+
+
+def write_chrome_trace(path: str, spans: List[Dict], process_name: str = '') -> None:
+    # spans: 每项包含 name, start, end(秒)和可选的 args, 导出为 chrome://tracing / Perfetto 可读的trace事件
+    # 时间上重叠的span分配到不同的线程行, 避免并行执行的操作互相遮挡
+    events = []
+    if process_name:
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': 0, 'tid': 0, 'args': {'name': process_name}})
+
+    origin = min((span['start'] for span in spans), default=0.0)
+    lanes: List[float] = []
+    for span in sorted(spans, key=lambda span: (span['start'], span['end'])):
+        lane = next((i for i, end in enumerate(lanes) if end <= span['start']), len(lanes))
+        if lane == len(lanes):
+            lanes.append(span['end'])
+        else:
+            lanes[lane] = span['end']
+        events.append({
+            'name': span['name'],
+            'cat': span.get('cat', 'operation'),
+            'ph': 'X',
+            'pid': 0,
+            'tid': lane,
+            'ts': (span['start'] - origin) * 1e6,
+            'dur': (span['end'] - span['start']) * 1e6,
+            'args': span.get('args', {}),
+        })
+
+    with open(path, 'w') as file:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
@@ -1,5 +1,7 @@
 from .retrievers import BaseRetriever
 from .tree_structures import Node, Tree
+from .embedding_matrix import EmbeddingMatrix
+from .tree_storage import StoredTree, load_tree, save_tree
 from .tree_builder import TreeBuilder, TreeBuilderConfig
 from .tree_retriever import TreeRetriever, TreeRetrieverConfig
 from .faiss_retriever import FaissRetriever, FaissRetrieverConfig
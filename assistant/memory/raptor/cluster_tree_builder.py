@@ -1,16 +1,20 @@
+import time
 import pickle
 import logging
 
-from threading import Lock
-from typing import Dict, List, Set
-from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from typing import Dict, List, Set, Tuple
 
 from .tree_structures import Node, Tree
 from .tree_builder import TreeBuilder, TreeBuilderConfig
-from .cluster_utils import ClusteringAlgorithm, RaptorClustering
+from .embedding_matrix import pairwise_distances
+from assistant.llm.rate_limiter import AsyncRateLimiter
+from .cluster_utils import ClusteringAlgorithm, RaptorClustering, supported_clustering_algorithms
 from .utils import (distances_from_embeddings, get_embeddings, get_children,
                     get_node_list, get_text,
-                    indices_of_nearest_neighbors_from_distances, split_text)
+                    indices_of_nearest_neighbors_from_distances, run_sync,
+                    split_text)
 
 logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
 
@@ -21,13 +25,30 @@ class ClusterTreeConfig(TreeBuilderConfig):
             reduction_dimension=10,
             clustering_algorithm=RaptorClustering,
             clustering_params={},
+            summarization_concurrency=8,
+            summarization_requests_per_minute=None,
             *args,
             **kwargs,
     ):
         super().__init__(*args, **kwargs)
+
+        if not isinstance(summarization_concurrency, int) or summarization_concurrency < 1:
+            raise ValueError("summarization_concurrency must be an integer and at least 1")
+        if summarization_requests_per_minute is not None and summarization_requests_per_minute <= 0:
+            raise ValueError("summarization_requests_per_minute must be positive")
+
+        if isinstance(clustering_algorithm, str):
+            if clustering_algorithm not in supported_clustering_algorithms:
+                raise ValueError(
+                    f"clustering_algorithm must be one of {list(supported_clustering_algorithms.keys())}"
+                )
+            clustering_algorithm = supported_clustering_algorithms[clustering_algorithm]
+
         self.reduction_dimension = reduction_dimension
         self.clustering_algorithm = clustering_algorithm
         self.clustering_params = clustering_params
+        self.summarization_concurrency = summarization_concurrency
+        self.summarization_requests_per_minute = summarization_requests_per_minute
 
     def log_config(self):
         base_summary = super().log_config()
@@ -35,6 +56,8 @@ class ClusterTreeConfig(TreeBuilderConfig):
         Reduction Dimension: {self.reduction_dimension}
         Clustering Algorithm: {self.clustering_algorithm.__name__}
         Clustering Parameters: {self.clustering_params}
+        Summarization Concurrency: {self.summarization_concurrency}
+        Summarization Requests Per Minute: {self.summarization_requests_per_minute}
         """
         return base_summary + cluster_tree_summary
 
@@ -48,6 +71,10 @@ class ClusterTreeBuilder(TreeBuilder):
         self.reduction_dimension = config.reduction_dimension
         self.clustering_algorithm = config.clustering_algorithm
         self.clustering_params = config.clustering_params
+        self.summarization_limiter = AsyncRateLimiter(
+            config.summarization_concurrency, config.summarization_requests_per_minute
+        )
+        self.layer_timings: List[Dict] = []
 
         logging.info(
             f"Successfully initialized ClusterTreeBuilder with Config {config.log_config()}"
@@ -59,36 +86,22 @@ class ClusterTreeBuilder(TreeBuilder):
             all_tree_nodes: Dict[int, Node],
             layer_to_nodes: Dict[int, List[Node]],
             use_multithreading: bool = False,
+    ) -> Dict[int, Node]:
+        return run_sync(
+            self.aconstruct_tree(current_level_nodes, all_tree_nodes, layer_to_nodes)
+        )
+
+    async def aconstruct_tree(
+            self,
+            current_level_nodes: Dict[int, Node],
+            all_tree_nodes: Dict[int, Node],
+            layer_to_nodes: Dict[int, List[Node]],
     ) -> Dict[int, Node]:
         logging.info("Using Cluster TreeBuilder")
         next_node_index = len(all_tree_nodes)
-
-        def process_cluster(
-                cluster_,
-                new_level_nodes_,
-                next_node_index_,
-                summarization_length_,
-                lock_
-        ):
-            node_texts = get_text(cluster_)
-            summarized_text = self.summarize(
-                context=node_texts,
-                max_tokens=summarization_length_
-            )
-
-            logging.info(
-                f"Node Texts Length: {len(self.tokenizer.encode(node_texts))}, "
-                f"Summarized Text Length: {len(self.tokenizer.encode(summarized_text))}"
-            )
-
-            _, new_parent_node = self.create_node(
-                next_node_index_, summarized_text, {node.index for node in cluster_}
-            )
-            with lock_:
-                new_level_nodes_[next_node_index_] = new_parent_node
+        self.layer_timings = []
 
         for layer in range(self.num_layers):
-            new_level_nodes = {}
             logging.info(f"Constructing Layer {layer}")
             node_list_current_layer = get_node_list(current_level_nodes)
 
@@ -99,52 +112,247 @@ class ClusterTreeBuilder(TreeBuilder):
                 )
                 break
 
+            start = time.perf_counter()
+            # 聚类直接在当前线程运行: 这里没有可以并行的工作, 而在工作线程中运行UMAP(numba)会让进程退出时卡住
             clusters = self.clustering_algorithm.perform_clustering(
                 node_list_current_layer,
                 self.cluster_embedding_model,
                 reduction_dimension=self.reduction_dimension,
                 **self.clustering_params,
             )
+            clustering_time = time.perf_counter() - start
 
-            lock = Lock()
-
-            summarization_length = self.summarization_length
-            logging.info(f"Summarization Length: {summarization_length}")
-
-            if use_multithreading:
-                with ThreadPoolExecutor() as executor:
-                    for cluster in clusters:
-                        executor.submit(
-                            process_cluster,
-                            cluster,
-                            new_level_nodes,
-                            next_node_index,
-                            summarization_length,
-                            lock
-                        )
-                        next_node_index += 1
-                    executor.shutdown(wait=True)
-            else:
-                for cluster in clusters:
-                    process_cluster(
-                        cluster,
-                        new_level_nodes,
-                        next_node_index,
-                        summarization_length,
-                        lock
-                    )
-                    next_node_index += 1
+            logging.info(f"Summarization Length: {self.summarization_length}")
+
+            start = time.perf_counter()
+            summaries = await self.asummarize_clusters(clusters, layer + 1)
+            summarization_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            indices = list(range(next_node_index, next_node_index + len(clusters)))
+            new_level_nodes = await self.acreate_nodes(
+                indices, summaries, [{node.index for node in cluster} for cluster in clusters]
+            )
+            embedding_time = time.perf_counter() - start
+            next_node_index += len(clusters)
+
+            timing = {
+                "layer": layer + 1,
+                "nodes": len(node_list_current_layer),
+                "clusters": len(clusters),
+                "clustering": clustering_time,
+                "summarization": summarization_time,
+                "embedding": embedding_time,
+            }
+            self.layer_timings.append(timing)
+            logging.info(
+                f"Layer {layer + 1}: {len(clusters)} clusters from {len(node_list_current_layer)} nodes, "
+                f"clustering {clustering_time:.2f}s, summarization {summarization_time:.2f}s, "
+                f"embedding {embedding_time:.2f}s"
+            )
 
             layer_to_nodes[layer + 1] = list(new_level_nodes.values())
             current_level_nodes = new_level_nodes
             all_tree_nodes.update(new_level_nodes)
 
-            tree = Tree(
-                all_tree_nodes,
-                layer_to_nodes[layer + 1],
-                layer_to_nodes[0],
+        return current_level_nodes
+
+    async def asummarize_clusters(self, clusters: List[List[Node]], layer: int) -> List[str]:
+        contexts = [get_text(cluster) for cluster in clusters]
+        results = await self.summarization_model.asummarize_batch(
+            contexts, self.summarization_length, self.summarization_limiter
+        )
+
+        for position, (node_texts, summarized_text) in enumerate(zip(contexts, results)):
+            if isinstance(summarized_text, str):
+                logging.info(
+                    f"Node Texts Length: {len(self.tokenizer.encode(node_texts))}, "
+                    f"Summarized Text Length: {len(self.tokenizer.encode(summarized_text))}"
+                )
+            # 摘要模型在重试耗尽后会把异常作为返回值, 这里统一当作失败处理
+            elif not isinstance(summarized_text, BaseException):
+                results[position] = TypeError(
+                    f"Summarization model returned {type(summarized_text).__name__}, expected str"
+                )
+
+        failures = [
+            (position, result) for position, result in enumerate(results)
+            if isinstance(result, BaseException)
+        ]
+        if failures:
+            for position, error in failures:
+                logging.error(
+                    f"Failed to summarize cluster {position} of layer {layer} "
+                    f"({len(clusters[position])} nodes): {error!r}"
+                )
+            raise RuntimeError(
+                f"Failed to summarize {len(failures)} of {len(clusters)} clusters in layer {layer}"
+            ) from failures[0][1]
+
+        return results
+
+    def assign_to_parents(
+            self,
+            nodes: List[Node],
+            parents: List[Node],
+            all_tree_nodes: Dict[int, Node],
+    ) -> Tuple[Dict[int, List[Node]], List[Node]]:
+        if not nodes or not parents:
+            return {}, list(nodes)
+
+        centroids = []
+        radii = []
+        for parent in parents:
+            if parent.children:
+                child_embeddings = np.array(
+                    [
+                        all_tree_nodes[index].embeddings[self.cluster_embedding_model]
+                        for index in sorted(parent.children)
+                    ],
+                    dtype=np.float32,
+                )
+            else:
+                child_embeddings = np.array(
+                    [parent.embeddings[self.cluster_embedding_model]], dtype=np.float32
+                )
+            norms = np.linalg.norm(child_embeddings, axis=1, keepdims=True)
+            child_embeddings = child_embeddings / np.where(norms > 0, norms, 1.0)
+            centroid = child_embeddings.mean(axis=0)
+            centroids.append(centroid)
+            radii.append(float(pairwise_distances(centroid, child_embeddings)[0].max()))
+
+        radii = np.array(radii, dtype=np.float32)
+        fallback_radius = float(np.median(radii))
+
+        distances = pairwise_distances(
+            np.array([node.embeddings[self.cluster_embedding_model] for node in nodes]),
+            np.array(centroids),
+        )
+        nearest = distances.argmin(axis=1)
+
+        assigned = {}
+        unassigned = []
+        for node, parent_position, node_distances in zip(nodes, nearest, distances):
+            if node_distances[parent_position] <= max(radii[parent_position], fallback_radius):
+                assigned.setdefault(parents[parent_position].index, []).append(node)
+            else:
+                unassigned.append(node)
+
+        return assigned, unassigned
+
+    def cluster_nodes(self, nodes: List[Node]) -> List[List[Node]]:
+        if len(nodes) <= self.reduction_dimension + 1:
+            return [list(nodes)] if nodes else []
+
+        clusters = self.clustering_algorithm.perform_clustering(
+            nodes,
+            self.cluster_embedding_model,
+            reduction_dimension=self.reduction_dimension,
+            **self.clustering_params,
+        )
+        clusters = [cluster for cluster in clusters if cluster]
+
+        covered = {node.index for cluster in clusters for node in cluster}
+        missing = [node for node in nodes if node.index not in covered]
+        if missing:
+            if clusters:
+                clusters[0].extend(missing)
+            else:
+                clusters = [missing]
+
+        return clusters
+
+    def split_oversized_cluster(
+            self,
+            parent: Node,
+            all_tree_nodes: Dict[int, Node]
+    ) -> List[List[Node]]:
+        children = [all_tree_nodes[index] for index in sorted(parent.children)]
+        max_length_in_cluster = self.clustering_params.get("max_length_in_cluster", 3500)
+        total_length = sum(len(self.tokenizer.encode(node.text)) for node in children)
+        if total_length <= max_length_in_cluster:
+            return [children]
+
+        logging.info(
+            f"Re-clustering node {parent.index} with {len(children)} children and {total_length} tokens"
+        )
+        return self.cluster_nodes(children)
+
+    def add_to_existing(self, tree: Tree, text: str) -> Tree:
+        chunks = split_text(text, self.tokenizer, self.max_tokens)
+        if not chunks:
+            return tree
+
+        next_node_index = max(tree.all_nodes.keys(), default=-1) + 1
+        new_leaf_nodes = self.create_nodes(
+            list(range(next_node_index, next_node_index + len(chunks))), chunks
+        )
+        next_node_index += len(chunks)
+
+        tree.leaf_nodes.update(new_leaf_nodes)
+        tree.all_nodes.update(new_leaf_nodes)
+        tree.layer_to_nodes.setdefault(0, []).extend(new_leaf_nodes.values())
+        logging.info(f"Added {len(new_leaf_nodes)} Leaf Nodes to existing tree")
+
+        new_nodes = list(new_leaf_nodes.values())
+        changed_indices: Set[int] = set()
+        for layer in range(tree.num_layers):
+            parents = tree.layer_to_nodes.get(layer + 1, [])
+            if not parents:
+                break
+
+            dirty_parents = {
+                parent.index: parent for parent in parents if parent.children & changed_indices
+            }
+
+            assigned, unassigned = self.assign_to_parents(new_nodes, parents, tree.all_nodes)
+            for parent_index, nodes in assigned.items():
+                parent = tree.all_nodes[parent_index]
+                parent.children.update(node.index for node in nodes)
+                dirty_parents[parent_index] = parent
+
+            new_clusters = self.cluster_nodes(unassigned)
+
+            regenerated_children = {}
+            for parent_index, parent in dirty_parents.items():
+                clusters = self.split_oversized_cluster(parent, tree.all_nodes)
+                regenerated_children[parent_index] = {node.index for node in clusters[0]}
+                new_clusters.extend(clusters[1:])
+
+            new_parent_children = {}
+            for cluster in new_clusters:
+                new_parent_children[next_node_index] = {node.index for node in cluster}
+                next_node_index += 1
+
+            logging.info(
+                f"Layer {layer + 1}: regenerating {len(regenerated_children)} nodes "
+                f"and creating {len(new_parent_children)} new nodes"
+            )
+
+            node_children = {**regenerated_children, **new_parent_children}
+            indices = list(node_children.keys())
+            summaries = run_sync(self.asummarize_clusters(
+                [
+                    [tree.all_nodes[index] for index in sorted(node_children[node_index])]
+                    for node_index in indices
+                ],
                 layer + 1,
-                layer_to_nodes,
+            ))
+            nodes = self.create_nodes(
+                indices, summaries, [node_children[index] for index in indices]
             )
 
-        return current_level_nodes
+            tree.all_nodes.update(nodes)
+            tree.layer_to_nodes[layer + 1] = [
+                nodes.get(node.index, node) for node in tree.layer_to_nodes[layer + 1]
+            ] + [nodes[index] for index in new_parent_children]
+
+            changed_indices = set(regenerated_children.keys())
+            new_nodes = [nodes[index] for index in new_parent_children]
+
+        tree.root_nodes = {
+            node.index: node for node in tree.layer_to_nodes[tree.num_layers]
+        }
+        tree.invalidate_embedding_matrices()
+
+        return tree
@@ -1,12 +1,20 @@
+import os
 import umap
+import atexit
 import random
 import logging
 import tiktoken
+import multiprocessing
+import threading
 import numpy as np
 
-from typing import List, Optional
+from scipy import sparse
+from itertools import repeat
 from abc import ABC, abstractmethod
+from typing import Dict, List, Optional
 from sklearn.mixture import GaussianMixture
+from sklearn.cluster import HDBSCAN, MiniBatchKMeans
+from concurrent.futures import ProcessPoolExecutor
 
 from .utils import get_embeddings
 from .tree_structures import Node
@@ -47,18 +55,75 @@ def local_cluster_embeddings(
     return reduced_embeddings
 
 
+_process_pools: Dict[int, ProcessPoolExecutor] = {}
+_process_pools_lock = threading.Lock()
+
+
+def get_process_pool(n_jobs: int) -> ProcessPoolExecutor:
+    with _process_pools_lock:
+        if n_jobs not in _process_pools:
+            # UMAP(numba)会启动线程池, fork出的子进程可能死锁, 改用forkserver启动
+            _process_pools[n_jobs] = ProcessPoolExecutor(
+                max_workers=n_jobs, mp_context=multiprocessing.get_context("forkserver")
+            )
+        return _process_pools[n_jobs]
+
+
+@atexit.register
+def shutdown_process_pools() -> None:
+    with _process_pools_lock:
+        for pool in _process_pools.values():
+            pool.shutdown(cancel_futures=True)
+        _process_pools.clear()
+
+
+def gmm_bic(embeddings: np.ndarray, n_components: int, random_state: int) -> float:
+    gm = GaussianMixture(n_components=n_components, random_state=random_state)
+    gm.fit(embeddings)
+    return gm.bic(embeddings)
+
+
 def get_optimal_clusters(
         embeddings: np.ndarray,
         max_clusters: int = 50,
-        random_state: int = RANDOM_SEED
+        random_state: int = RANDOM_SEED,
+        n_jobs: int = 1,
+        early_stopping_patience: Optional[int] = None,
 ) -> np.ndarray:
     max_clusters = min(max_clusters, len(embeddings))
     n_clusters = np.arange(1, max_clusters)
+    if n_jobs < 0:
+        n_jobs = os.cpu_count() or 1
+
+    # 每轮并行评估 n_jobs 个候选, 连续 early_stopping_patience 个候选没有改善BIC时停止
+    # n_jobs > 1 时子进程由forkserver启动, 会重新导入 __main__: 入口脚本必须把建树等代码放在
+    # if __name__ == "__main__": 之下, 否则脚本会在子进程中再执行一遍
     bics = []
-    for n in n_clusters:
-        gm = GaussianMixture(n_components=n, random_state=random_state)
-        gm.fit(embeddings)
-        bics.append(gm.bic(embeddings))
+    best_bic = np.inf
+    since_best = 0
+    for start in range(0, len(n_clusters), max(1, n_jobs)):
+        candidates = n_clusters[start:start + max(1, n_jobs)]
+        if n_jobs > 1 and len(candidates) > 1:
+            wave_bics = list(get_process_pool(n_jobs).map(
+                gmm_bic, repeat(embeddings), candidates.tolist(), repeat(random_state)
+            ))
+        else:
+            wave_bics = [gmm_bic(embeddings, n, random_state) for n in candidates]
+
+        stop = False
+        for bic in wave_bics:
+            bics.append(bic)
+            if bic < best_bic:
+                best_bic = bic
+                since_best = 0
+            else:
+                since_best += 1
+                if early_stopping_patience is not None and since_best >= early_stopping_patience:
+                    stop = True
+                    break
+        if stop:
+            break
+
     optimal_clusters = n_clusters[np.argmin(bics)]
     return optimal_clusters
 
@@ -66,9 +131,13 @@ def get_optimal_clusters(
 def gmm_cluster(
         embeddings: np.ndarray,
         threshold: float,
-        random_state: int = 0
+        random_state: int = 0,
+        n_jobs: int = 1,
+        early_stopping_patience: Optional[int] = None,
 ):
-    n_clusters = get_optimal_clusters(embeddings)
+    n_clusters = get_optimal_clusters(
+        embeddings, n_jobs=n_jobs, early_stopping_patience=early_stopping_patience
+    )
     gm = GaussianMixture(n_components=n_clusters, random_state=random_state)
     gm.fit(embeddings)
     probs = gm.predict_proba(embeddings)
@@ -76,67 +145,88 @@ def gmm_cluster(
     return labels, n_clusters
 
 
+def labels_to_membership(
+        labels: List[np.ndarray],
+        n_clusters: int
+) -> sparse.csc_matrix:
+    rows = np.repeat(np.arange(len(labels)), [len(label) for label in labels])
+    cols = np.concatenate(labels).astype(np.int64) if len(labels) else np.empty(0, dtype=np.int64)
+    return sparse.csc_matrix(
+        (np.ones(len(rows), dtype=bool), (rows, cols)),
+        shape=(len(labels), n_clusters),
+    )
+
+
+def cluster_members(membership: sparse.csc_matrix, cluster: int) -> np.ndarray:
+    return membership.indices[membership.indptr[cluster]:membership.indptr[cluster + 1]]
+
+
 def perform_clustering(
         embeddings: np.ndarray,
         dim: int,
         threshold: float,
-        verbose: bool = False
-) -> List[np.ndarray]:
+        verbose: bool = False,
+        n_jobs: int = 1,
+        early_stopping_patience: Optional[int] = None,
+) -> sparse.csc_matrix:
     reduced_embeddings_global = global_cluster_embeddings(embeddings, min(dim, len(embeddings) - 2))
     global_clusters, n_global_clusters = gmm_cluster(
-        reduced_embeddings_global, threshold
+        reduced_embeddings_global,
+        threshold,
+        n_jobs=n_jobs,
+        early_stopping_patience=early_stopping_patience,
     )
+    global_membership = labels_to_membership(global_clusters, n_global_clusters)
 
     if verbose:
         logging.info(f"Global Clusters: {n_global_clusters}")
 
-    all_local_clusters = [np.array([]) for _ in range(len(embeddings))]
+    member_rows = []
+    member_cols = []
     total_clusters = 0
 
     for i in range(n_global_clusters):
-        global_cluster_embeddings_ = embeddings[
-            np.array([i in gc for gc in global_clusters])
-        ]
+        global_indices = cluster_members(global_membership, i)
         if verbose:
             logging.info(
-                f"Nodes in Global Cluster {i}, {len(global_cluster_embeddings_)}"
+                f"Nodes in Global Cluster {i}, {len(global_indices)}"
             )
 
-        if len(global_cluster_embeddings_) == 0:
+        if len(global_indices) == 0:
             continue
 
-        if len(global_cluster_embeddings_) <= dim + 1:
-            local_clusters = [np.array([0]) for _ in global_cluster_embeddings_]
+        if len(global_indices) <= dim + 1:
+            local_clusters = [np.array([0]) for _ in global_indices]
             n_local_clusters = 1
         else:
             reduced_embeddings_local = local_cluster_embeddings(
-                global_cluster_embeddings_, dim
+                embeddings[global_indices], dim
             )
             local_clusters, n_local_clusters = gmm_cluster(
-                reduced_embeddings_local, threshold
+                reduced_embeddings_local,
+                threshold,
+                n_jobs=n_jobs,
+                early_stopping_patience=early_stopping_patience,
             )
 
         if verbose:
             logging.info(f"Local Clusters in Global Cluster {i}: {n_local_clusters}")
 
-        for j in range(n_local_clusters):
-            local_cluster_embeddings_ = global_cluster_embeddings_[
-                np.array([j in lc for lc in local_clusters])
-            ]
-            indices = np.where(
-                (embeddings == local_cluster_embeddings_[:, None]).all(-1)
-            )[1]
-            for idx in indices:
-                all_local_clusters[idx] = np.append(
-                    all_local_clusters[idx], j + total_clusters
-                )
+        local_membership = labels_to_membership(local_clusters, n_local_clusters).tocoo()
+        member_rows.append(global_indices[local_membership.row])
+        member_cols.append(local_membership.col + total_clusters)
 
         total_clusters += n_local_clusters
 
     if verbose:
         logging.info(f"Total Clusters: {total_clusters}")
 
-    return all_local_clusters
+    rows = np.concatenate(member_rows) if member_rows else np.empty(0, dtype=np.int64)
+    cols = np.concatenate(member_cols) if member_cols else np.empty(0, dtype=np.int64)
+    return sparse.csc_matrix(
+        (np.ones(len(rows), dtype=bool), (rows, cols)),
+        shape=(len(embeddings), total_clusters),
+    )
 
 
 class ClusteringAlgorithm(ABC):
@@ -164,17 +254,26 @@ class RaptorClustering(ClusteringAlgorithm):
             reduction_dimension: int = 10,
             threshold: float = 0.1,
             verbose: bool = False,
+            n_jobs: int = 1,
+            early_stopping_patience: Optional[int] = None,
     ) -> List[List[Node]]:
         embeddings = np.array([node.embeddings[embedding_model_name] for node in nodes])
 
-        clusters = perform_clustering(
-            embeddings, dim=reduction_dimension, threshold=threshold
+        membership = perform_clustering(
+            embeddings,
+            dim=reduction_dimension,
+            threshold=threshold,
+            n_jobs=n_jobs,
+            early_stopping_patience=early_stopping_patience,
         )
+        token_counts = np.array([len(tokenizer.encode(node.text)) for node in nodes])
 
         node_clusters = []
 
-        for label in np.unique(np.concatenate(clusters)):
-            indices = [i for i, cluster in enumerate(clusters) if label in cluster]
+        for label in range(membership.shape[1]):
+            indices = cluster_members(membership, label)
+            if len(indices) == 0:
+                continue
 
             cluster_nodes = [nodes[i] for i in indices]
 
@@ -182,9 +281,7 @@ class RaptorClustering(ClusteringAlgorithm):
                 node_clusters.append(cluster_nodes)
                 continue
 
-            total_length = sum(
-                [len(tokenizer.encode(node.text)) for node in cluster_nodes]
-            )
+            total_length = int(token_counts[indices].sum())
 
             if total_length > max_length_in_cluster:
                 if verbose:
@@ -194,10 +291,161 @@ class RaptorClustering(ClusteringAlgorithm):
 
                 node_clusters.extend(
                     RaptorClustering.perform_clustering(
-                        cluster_nodes, embedding_model_name, max_length_in_cluster
+                        cluster_nodes,
+                        embedding_model_name,
+                        max_length_in_cluster,
+                        tokenizer,
+                        reduction_dimension,
+                        threshold,
+                        verbose,
+                        n_jobs,
+                        early_stopping_patience,
                     )
                 )
             else:
                 node_clusters.append(cluster_nodes)
 
         return node_clusters
+
+
+def group_by_labels(labels: np.ndarray) -> List[np.ndarray]:
+    order = np.argsort(labels, kind="stable")
+    boundaries = np.flatnonzero(np.diff(labels[order])) + 1
+    return np.split(order, boundaries)
+
+
+def split_by_token_budget(
+        indices: np.ndarray,
+        embeddings: np.ndarray,
+        token_counts: np.ndarray,
+        max_length_in_cluster: int,
+        batch_size: int = 1024,
+        random_state: int = RANDOM_SEED,
+) -> List[np.ndarray]:
+    clusters = []
+    pending = [indices]
+    while pending:
+        cluster = pending.pop()
+        total_length = int(token_counts[cluster].sum())
+        if len(cluster) <= 1 or total_length <= max_length_in_cluster:
+            clusters.append(cluster)
+            continue
+
+        n_clusters = min(len(cluster), int(np.ceil(total_length / max_length_in_cluster)) + 1)
+        labels = MiniBatchKMeans(
+            n_clusters=n_clusters, batch_size=batch_size, random_state=random_state, n_init=3
+        ).fit_predict(embeddings[cluster])
+        parts = [cluster[part] for part in group_by_labels(labels)]
+        if len(parts) == 1:
+            # 嵌入完全相同时k-means无法拆分, 直接对半切分
+            parts = np.array_split(cluster, 2)
+        pending.extend(parts)
+
+    return clusters
+
+
+def normalized_embeddings(nodes: List[Node], embedding_model_name: str) -> np.ndarray:
+    embeddings = np.array(
+        [node.embeddings[embedding_model_name] for node in nodes], dtype=np.float32
+    )
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.where(norms > 0, norms, 1.0)
+
+
+# 大规模语料使用的快速聚类: 单次硬划分, 超出token上限的簇用k-means继续拆分
+class MiniBatchKMeansClustering(ClusteringAlgorithm):
+    @staticmethod
+    def perform_clustering(
+            nodes: List[Node],
+            embedding_model_name: str,
+            max_length_in_cluster: int = 3500,
+            tokenizer=tiktoken.get_encoding("cl100k_base"),
+            reduction_dimension: int = 10,
+            threshold: float = 0.1,
+            verbose: bool = False,
+            nodes_per_cluster: int = 8,
+            batch_size: int = 1024,
+            random_state: int = RANDOM_SEED,
+    ) -> List[List[Node]]:
+        embeddings = normalized_embeddings(nodes, embedding_model_name)
+        token_counts = np.array([len(tokenizer.encode(node.text)) for node in nodes])
+
+        n_clusters = max(1, min(len(nodes), int(np.ceil(len(nodes) / nodes_per_cluster))))
+        labels = MiniBatchKMeans(
+            n_clusters=n_clusters, batch_size=batch_size, random_state=random_state, n_init=3
+        ).fit_predict(embeddings)
+
+        clusters = []
+        for cluster in group_by_labels(labels):
+            clusters.extend(split_by_token_budget(
+                cluster, embeddings, token_counts, max_length_in_cluster, batch_size, random_state
+            ))
+
+        if verbose:
+            logging.info(f"MiniBatchKMeans: {len(nodes)} nodes into {len(clusters)} clusters")
+
+        return [[nodes[i] for i in cluster] for cluster in clusters]
+
+
+class HDBSCANClustering(ClusteringAlgorithm):
+    @staticmethod
+    def perform_clustering(
+            nodes: List[Node],
+            embedding_model_name: str,
+            max_length_in_cluster: int = 3500,
+            tokenizer=tiktoken.get_encoding("cl100k_base"),
+            reduction_dimension: int = 10,
+            threshold: float = 0.1,
+            verbose: bool = False,
+            min_cluster_size: int = 5,
+            min_samples: Optional[int] = None,
+            random_state: int = RANDOM_SEED,
+    ) -> List[List[Node]]:
+        embeddings = normalized_embeddings(nodes, embedding_model_name)
+        token_counts = np.array([len(tokenizer.encode(node.text)) for node in nodes])
+
+        if len(nodes) > reduction_dimension + 2:
+            reduced_embeddings = global_cluster_embeddings(embeddings, reduction_dimension)
+        else:
+            reduced_embeddings = embeddings
+
+        labels = HDBSCAN(
+            min_cluster_size=max(2, min(min_cluster_size, len(nodes))),
+            min_samples=min_samples,
+            copy=True,
+        ).fit_predict(reduced_embeddings)
+
+        # 噪声点分配到最近的簇中心, 全部为噪声时视为一个簇
+        noise = labels < 0
+        if noise.all():
+            labels = np.zeros(len(nodes), dtype=np.int64)
+        elif noise.any():
+            cluster_ids = np.unique(labels[~noise])
+            centroids = np.stack(
+                [reduced_embeddings[labels == cluster_id].mean(axis=0) for cluster_id in cluster_ids]
+            )
+            distances = np.linalg.norm(
+                reduced_embeddings[noise][:, None, :] - centroids[None, :, :], axis=-1
+            )
+            labels[noise] = cluster_ids[np.argmin(distances, axis=1)]
+
+        clusters = []
+        for cluster in group_by_labels(labels):
+            clusters.extend(split_by_token_budget(
+                cluster, reduced_embeddings, token_counts, max_length_in_cluster,
+                random_state=random_state,
+            ))
+
+        if verbose:
+            logging.info(
+                f"HDBSCAN: {len(nodes)} nodes into {len(clusters)} clusters, {int(noise.sum())} noise points"
+            )
+
+        return [[nodes[i] for i in cluster] for cluster in clusters]
+
+
+supported_clustering_algorithms = {
+    "raptor": RaptorClustering,
+    "minibatch_kmeans": MiniBatchKMeansClustering,
+    "hdbscan": HDBSCANClustering,
+}
@@ -0,0 +1,189 @@
+import logging
+
+import numpy as np
+
+from typing import Dict, Iterable, List, Optional
+
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+
+DISTANCE_METRICS = ["cosine", "L1", "L2", "Linf"]
+
+# 逐块计算L1/Linf距离时临时张量的元素上限, 避免一次性分配 Q x N x D 的大数组
+MAX_BLOCK_ELEMENTS = 1 << 22
+
+
+def _safe_norms(norms: np.ndarray) -> np.ndarray:
+    return np.where(norms > 0, norms, 1.0).astype(np.float32)
+
+
+def pairwise_distances(
+        query_embeddings: np.ndarray,
+        embeddings: np.ndarray,
+        distance_metric: str = "cosine",
+        embedding_norms: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    if distance_metric not in DISTANCE_METRICS:
+        raise ValueError(
+            f"Unsupported distance metric '{distance_metric}'. Supported metrics are: {DISTANCE_METRICS}"
+        )
+
+    query_embeddings = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+    embeddings = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+
+    # embedding_norms 不为空时, embeddings 视为已经归一化的单位向量
+    if embedding_norms is None:
+        embedding_norms = np.linalg.norm(embeddings, axis=1)
+        unit_embeddings = embeddings / _safe_norms(embedding_norms)[:, None]
+        raw_embeddings = embeddings
+    else:
+        embedding_norms = np.asarray(embedding_norms, dtype=np.float32)
+        unit_embeddings = embeddings
+        raw_embeddings = None
+
+    if distance_metric == "cosine":
+        query_norms = np.linalg.norm(query_embeddings, axis=1)
+        unit_queries = query_embeddings / _safe_norms(query_norms)[:, None]
+        return 1.0 - unit_queries @ unit_embeddings.T
+
+    if distance_metric == "L2":
+        dots = (query_embeddings @ unit_embeddings.T) * embedding_norms[None, :]
+        squared = (
+            np.square(query_embeddings).sum(axis=1)[:, None]
+            + np.square(embedding_norms)[None, :]
+            - 2.0 * dots
+        )
+        return np.sqrt(np.maximum(squared, 0.0))
+
+    reduce = np.sum if distance_metric == "L1" else np.max
+    num_queries, dim = query_embeddings.shape
+    block_size = max(1, MAX_BLOCK_ELEMENTS // max(1, num_queries * dim))
+    distances = np.empty((num_queries, len(unit_embeddings)), dtype=np.float32)
+    for start in range(0, len(unit_embeddings), block_size):
+        stop = start + block_size
+        if raw_embeddings is not None:
+            block = raw_embeddings[start:stop]
+        else:
+            block = unit_embeddings[start:stop] * embedding_norms[start:stop, None]
+        distances[:, start:stop] = reduce(
+            np.abs(query_embeddings[:, None, :] - block[None, :, :]), axis=-1
+        )
+
+    return distances
+
+
+def top_k_indices(distances: np.ndarray, k: int) -> np.ndarray:
+    distances = np.asarray(distances)
+    num_candidates = distances.shape[-1]
+    if k <= 0:
+        return np.empty(distances.shape[:-1] + (0,), dtype=np.int64)
+    if k >= num_candidates:
+        return np.argsort(distances, axis=-1, kind="stable")
+
+    partitioned = np.argpartition(distances, k - 1, axis=-1)[..., :k]
+    order = np.argsort(
+        np.take_along_axis(distances, partitioned, axis=-1), axis=-1, kind="stable"
+    )
+    return np.take_along_axis(partitioned, order, axis=-1)
+
+
+class EmbeddingMatrix:
+    def __init__(
+            self,
+            all_nodes: Dict,
+            layer_to_nodes: Dict[int, List],
+            embedding_model: str,
+    ) -> None:
+        self.embedding_model = embedding_model
+
+        # 按层排列节点, 使每一层在矩阵中都是连续的行
+        ordered_nodes = []
+        seen = set()
+        self.layer_slices: Dict[int, slice] = {}
+        for layer in sorted(layer_to_nodes.keys()):
+            start = len(ordered_nodes)
+            for node in layer_to_nodes[layer]:
+                if node.index not in seen:
+                    seen.add(node.index)
+                    ordered_nodes.append(node)
+            self.layer_slices[layer] = slice(start, len(ordered_nodes))
+
+        for index in sorted(all_nodes.keys()):
+            if index not in seen:
+                seen.add(index)
+                ordered_nodes.append(all_nodes[index])
+
+        self.node_indices = np.array([node.index for node in ordered_nodes], dtype=np.int64)
+        self.node_to_row: Dict[int, int] = {
+            int(index): row for row, index in enumerate(self.node_indices)
+        }
+
+        if ordered_nodes:
+            embeddings = np.ascontiguousarray(
+                [node.embeddings[embedding_model] for node in ordered_nodes],
+                dtype=np.float32,
+            )
+        else:
+            embeddings = np.empty((0, 0), dtype=np.float32)
+
+        self.norms = np.linalg.norm(embeddings, axis=1).astype(np.float32)
+        self.normalized = np.ascontiguousarray(
+            embeddings / _safe_norms(self.norms)[:, None], dtype=np.float32
+        )
+
+        logging.info(
+            f"Built embedding matrix for '{embedding_model}' with shape {self.normalized.shape}"
+        )
+
+    @classmethod
+    def from_arrays(
+            cls,
+            node_indices: np.ndarray,
+            normalized: np.ndarray,
+            norms: np.ndarray,
+            layer_slices: Dict[int, slice],
+            embedding_model: str,
+    ) -> "EmbeddingMatrix":
+        # 直接使用已经归一化好的矩阵(可以是内存映射数组), 不复制数据
+        matrix = cls.__new__(cls)
+        matrix.embedding_model = embedding_model
+        matrix.layer_slices = dict(layer_slices)
+        matrix.node_indices = np.asarray(node_indices, dtype=np.int64)
+        matrix.node_to_row = {
+            int(index): row for row, index in enumerate(matrix.node_indices)
+        }
+        matrix.norms = norms
+        matrix.normalized = normalized
+        return matrix
+
+    def __len__(self) -> int:
+        return len(self.node_indices)
+
+    @property
+    def dim(self) -> int:
+        return self.normalized.shape[1]
+
+    def rows_for(self, node_indices: Iterable[int]) -> np.ndarray:
+        return np.array([self.node_to_row[index] for index in node_indices], dtype=np.int64)
+
+    def layer_rows(self, layer: int) -> np.ndarray:
+        layer_slice = self.layer_slices[layer]
+        return np.arange(layer_slice.start, layer_slice.stop, dtype=np.int64)
+
+    def distances(
+            self,
+            query_embeddings,
+            rows: Optional[np.ndarray] = None,
+            distance_metric: str = "cosine",
+    ) -> np.ndarray:
+        single_query = np.ndim(query_embeddings) == 1
+
+        if rows is None:
+            embeddings, norms = self.normalized, self.norms
+        else:
+            embeddings, norms = self.normalized[rows], self.norms[rows]
+
+        distances = pairwise_distances(
+            query_embeddings, embeddings, distance_metric, embedding_norms=norms
+        )
+
+        return distances[0] if single_query else distances
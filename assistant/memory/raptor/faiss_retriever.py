@@ -1,16 +1,94 @@
+import os
+import json
 import faiss
 import random
+import logging
 import tiktoken
 
 import numpy as np
 
-from tqdm import tqdm
-from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
 
 from .utils import split_text
 from .retrievers import BaseRetriever
 from assistant.llm.embedding_models import BaseEmbeddingModel, OpenAIEmbeddingModel
 
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+
+INDEX_TYPES = ["flat", "ivf_flat", "ivf_pq", "hnsw"]
+
+INDEX_FILE = "index.faiss"
+CHUNKS_FILE = "chunks.json"
+META_FILE = "meta.json"
+
+
+def create_index(
+        dim: int,
+        num_vectors: int,
+        index_type: str = "flat",
+        nlist: Optional[int] = None,
+        pq_m: int = 16,
+        pq_nbits: int = 8,
+        hnsw_m: int = 32,
+        ef_construction: int = 40,
+) -> faiss.Index:
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"index_type must be one of {INDEX_TYPES}")
+
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = ef_construction
+        return index
+
+    if nlist is None:
+        nlist = int(4 * np.sqrt(num_vectors))
+    nlist = max(1, min(nlist, num_vectors))
+
+    # IVF需要足够的训练样本, 数据量太小时退回精确检索
+    min_training_vectors = nlist if index_type == "ivf_flat" else max(nlist, 1 << pq_nbits)
+    if index_type == "flat" or num_vectors < min_training_vectors:
+        if index_type != "flat":
+            logging.warning(
+                f"Only {num_vectors} vectors, not enough to train {index_type}; using a flat index"
+            )
+        return faiss.IndexFlatIP(dim)
+
+    quantizer = faiss.IndexFlatIP(dim)
+    if index_type == "ivf_flat":
+        return faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+
+    if dim % pq_m != 0:
+        raise ValueError(f"pq_m ({pq_m}) must divide the embedding dimension ({dim})")
+    return faiss.IndexIVFPQ(quantizer, dim, nlist, pq_m, pq_nbits, faiss.METRIC_INNER_PRODUCT)
+
+
+def train_index(
+        index: faiss.Index,
+        embeddings: np.ndarray,
+        train_sample_size: int = 50_000,
+        seed: int = 224,
+) -> None:
+    if index.is_trained:
+        return
+
+    if len(embeddings) > train_sample_size:
+        rng = np.random.default_rng(seed)
+        sample = embeddings[rng.choice(len(embeddings), train_sample_size, replace=False)]
+    else:
+        sample = embeddings
+    index.train(np.ascontiguousarray(sample, dtype=np.float32))
+
+
+def set_search_params(index: faiss.Index, nprobe: int = 8, ef_search: int = 64) -> None:
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = ef_search
+        return
+
+    try:
+        faiss.extract_index_ivf(index).nprobe = nprobe
+    except RuntimeError:
+        pass
+
 
 class FaissRetrieverConfig:
     def __init__(
@@ -23,6 +101,15 @@ class FaissRetrieverConfig:
             top_k: int = 5,
             tokenizer=tiktoken.get_encoding("cl100k_base"),
             embedding_model_string=None,
+            index_type: str = "flat",
+            nlist: Optional[int] = None,
+            nprobe: int = 8,
+            pq_m: int = 16,
+            pq_nbits: int = 8,
+            hnsw_m: int = 32,
+            ef_construction: int = 40,
+            ef_search: int = 64,
+            train_sample_size: int = 50_000,
     ):
         if max_tokens < 1:
             raise ValueError("max_tokens must be at least 1")
@@ -43,6 +130,18 @@ class FaissRetrieverConfig:
                 "question_embedding_model must be an instance of BaseEmbeddingModel or None"
             )
 
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"index_type must be one of {INDEX_TYPES}")
+
+        if nlist is not None and nlist < 1:
+            raise ValueError("nlist must be at least 1 or None")
+
+        if nprobe < 1 or ef_search < 1:
+            raise ValueError("nprobe and ef_search must be at least 1")
+
+        if train_sample_size < 1:
+            raise ValueError("train_sample_size must be at least 1")
+
         self.top_k = top_k
         self.max_tokens = max_tokens
         self.max_content_tokens = max_content_tokens
@@ -51,6 +150,15 @@ class FaissRetrieverConfig:
         self.question_embedding_model = question_embedding_model or self.embedding_model
         self.tokenizer = tokenizer
         self.embedding_model_string = embedding_model_string or "OpenAI"
+        self.index_type = index_type
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.pq_m = pq_m
+        self.pq_nbits = pq_nbits
+        self.hnsw_m = hnsw_m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.train_sample_size = train_sample_size
 
     def log_config(self):
         config_summary = """
@@ -63,6 +171,7 @@ class FaissRetrieverConfig:
                     Top K: {top_k}
                     Tokenizer: {tokenizer}
                     Embedding Model String: {embedding_model_string}
+                    Index Type: {index_type}
         """.format(
             max_tokens=self.max_tokens,
             max_context_tokens=self.max_content_tokens,
@@ -72,6 +181,7 @@ class FaissRetrieverConfig:
             top_k=self.top_k,
             tokenizer=self.tokenizer,
             embedding_model_string=self.embedding_model_string,
+            index_type=self.index_type,
         )
 
         return config_summary
@@ -79,49 +189,121 @@ class FaissRetrieverConfig:
 
 class FaissRetriever(BaseRetriever):
     def __init__(self, config):
+        self.config = config
         self.embedding_model = config.embedding_model
         self.question_embedding_model = config.question_embedding_model
         self.index = None
-        self.context_chunks = None
+        self.index_path = None
+        self.context_chunks = []
         self.max_tokens = config.max_tokens
-        self.max_context_tokens = config.max_context_tokens
+        self.max_context_tokens = config.max_content_tokens
         self.use_top_k = config.use_top_k
         self.tokenizer = config.tokenizer
         self.top_k = config.top_k
         self.embedding_model_string = config.embedding_model_string
-        self.embeddings = []
+        self.embeddings = np.empty((0, 0), dtype=np.float32)
 
-    def build_from_text(self, doc_text):
-        self.context_chunks = np.array(
-            split_text(doc_text, self.tokenizer, self.max_tokens)
+    def build_index(self, embeddings: np.ndarray) -> None:
+        config = self.config
+        self.index = create_index(
+            embeddings.shape[1],
+            len(embeddings),
+            config.index_type,
+            config.nlist,
+            config.pq_m,
+            config.pq_nbits,
+            config.hnsw_m,
+            config.ef_construction,
         )
+        train_index(self.index, embeddings, config.train_sample_size)
+        self.index.add(embeddings)
+        set_search_params(self.index, config.nprobe, config.ef_search)
+        self.index_path = None
 
-        with ProcessPoolExecutor() as executor:
-            futures = [
-                executor.submit(self.embedding_model.create_embedding, context_chunk)
-                for context_chunk in self.context_chunks
-            ]
-
-            for future in tqdm(futures, total=len(futures), desc="Building embedding"):
-                self.embeddings.append(future.result())
+        logging.info(f"Built {type(self.index).__name__} with {self.index.ntotal} vectors")
 
-            self.embeddings = np.array(self.embeddings, dtype=np.float32)
+    def build_from_embeddings(self, context_chunks: List[str], embeddings) -> None:
+        self.context_chunks = list(context_chunks)
+        self.embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        self.build_index(self.embeddings)
 
-            self.index = faiss.IndexFlatIP(self.embeddings.shape[1])
-            self.index.add(self.embeddings)
+    def build_from_text(self, doc_text):
+        context_chunks = split_text(doc_text, self.tokenizer, self.max_tokens)
+        self.build_from_embeddings(
+            context_chunks, self.embedding_model.create_embeddings(context_chunks)
+        )
 
     def build_from_leaf_nodes(self, leaf_nodes):
-        self.context_chunks = [node.text for node in leaf_nodes]
-
-        self.embeddings = np.array(
+        self.build_from_embeddings(
+            [node.text for node in leaf_nodes],
             [node.embeddings[self.embedding_model_string] for node in leaf_nodes],
-            dtype=np.float32,
         )
 
-        self.index = faiss.IndexFlatIP(self.embeddings.shape[1])
-        self.index.add(self.embeddings)
+    def add(self, context_chunks: List[str], embeddings=None) -> None:
+        if embeddings is None:
+            embeddings = self.embedding_model.create_embeddings(list(context_chunks))
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+
+        if self.index is None:
+            self.build_from_embeddings(context_chunks, embeddings)
+            return
+
+        if self.index_path is not None:
+            # 内存映射加载的IVF倒排表是只读的, 插入前整体读入内存
+            self.index = faiss.read_index(os.path.join(self.index_path, INDEX_FILE))
+            set_search_params(self.index, self.config.nprobe, self.config.ef_search)
+            self.index_path = None
+
+        self.index.add(embeddings)
+        self.context_chunks.extend(context_chunks)
+        if len(self.embeddings):
+            self.embeddings = np.concatenate([self.embeddings, embeddings])
+
+    def save(self, path: str) -> None:
+        if self.index is None:
+            raise ValueError("The index has not been built. Call 'build_from_text' first.")
+
+        os.makedirs(path, exist_ok=True)
+        faiss.write_index(self.index, os.path.join(path, INDEX_FILE))
+        with open(os.path.join(path, CHUNKS_FILE), "w") as file:
+            json.dump(self.context_chunks, file)
+        with open(os.path.join(path, META_FILE), "w") as file:
+            json.dump(
+                {
+                    "index_type": self.config.index_type,
+                    "embedding_model_string": self.embedding_model_string,
+                    "ntotal": self.index.ntotal,
+                },
+                file,
+            )
+
+        logging.info(f"Faiss index with {self.index.ntotal} vectors saved to {path}")
+
+    def load(self, path: str, mmap: bool = True) -> None:
+        index_file = os.path.join(path, INDEX_FILE)
+        if mmap:
+            self.index = faiss.read_index(index_file, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            self.index_path = path
+        else:
+            self.index = faiss.read_index(index_file)
+            self.index_path = None
+        set_search_params(self.index, self.config.nprobe, self.config.ef_search)
+
+        with open(os.path.join(path, CHUNKS_FILE), "r") as file:
+            self.context_chunks = json.load(file)
+        self.embeddings = np.empty((0, 0), dtype=np.float32)
+
+        if len(self.context_chunks) != self.index.ntotal:
+            raise ValueError(
+                f"Index at {path} has {self.index.ntotal} vectors but {len(self.context_chunks)} chunks"
+            )
+
+        logging.info(f"Faiss index with {self.index.ntotal} vectors loaded from {path}")
 
     def sanity_check(self, num_samples=4):
+        if len(self.embeddings) != len(self.context_chunks):
+            raise ValueError("Embeddings are not kept in memory for a loaded index")
+
         indices = random.sample(range(len(self.context_chunks)), num_samples)
 
         for i in indices:
@@ -135,6 +317,34 @@ class FaissRetriever(BaseRetriever):
 
         print(f"Sanity check passed for {num_samples} random samples.")
 
+    def build_context(self, indices: np.ndarray) -> str:
+        context = ""
+
+        if self.use_top_k:
+            for i in indices[: self.top_k]:
+                if i < 0:
+                    continue
+                context += self.context_chunks[i]
+
+        else:
+            total_tokens = 0
+            for i in indices:
+                if i < 0:
+                    continue
+                tokens = len(self.tokenizer.encode(self.context_chunks[i]))
+                context += self.context_chunks[i]
+                if total_tokens + tokens > self.max_context_tokens:
+                    break
+
+                total_tokens += tokens
+
+        return context
+
+    def search_size(self) -> int:
+        if self.use_top_k:
+            return self.top_k
+        return int(self.max_context_tokens / self.max_tokens)
+
     def retrieve(self, query: str) -> str:
         query_embedding = np.array(
             [
@@ -145,23 +355,18 @@ class FaissRetriever(BaseRetriever):
             ]
         )
 
-        context = ""
+        _, indices = self.index.search(query_embedding, self.search_size())
 
-        if self.use_top_k:
-            _, indices = self.index.search(query_embedding, self.top_k)
-            for i in range(self.top_k):
-                context += self.context_chunks[indices[0][i]]
+        return self.build_context(indices[0])
 
-        else:
-            range_ = int(self.max_context_tokens / self.max_tokens)
-            _, indices = self.index.search(query_embedding, range_)
-            total_tokens = 0
-            for i in range(range_):
-                tokens = len(self.tokenizer.encode(self.context_chunks[indices[0][i]]))
-                context += self.context_chunks[indices[0][i]]
-                if total_tokens + tokens > self.max_context_tokens:
-                    break
+    def retrieve_many(self, queries: List[str]) -> List[str]:
+        if not queries:
+            return []
 
-                total_tokens += tokens
+        query_embeddings = np.ascontiguousarray(
+            self.question_embedding_model.create_embeddings(list(queries)), dtype=np.float32
+        )
 
-        return context
+        _, indices = self.index.search(query_embeddings, self.search_size())
+
+        return [self.build_context(row) for row in indices]
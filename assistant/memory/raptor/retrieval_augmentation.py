@@ -1,9 +1,14 @@
+import os
 import pickle
 import logging
 
+from .utils import run_sync
 from .tree_structures import Tree
-from assistant.llm.embedding_models import BaseEmbeddingModel
+from .tree_storage import StoredTree, load_tree, save_tree
+from assistant.llm.embedding_cache import CachedEmbeddingModel
+from assistant.llm.embedding_models import BaseEmbeddingModel, OpenAIEmbeddingModel
 from assistant.llm.qa_model import BaseQAModel, GPT3TurboQAModel
+from assistant.llm.rate_limiter import AsyncRateLimiter
 from assistant.llm.summarization_models import BaseSummarizationModel
 from .tree_retriever import TreeRetriever, TreeRetrieverConfig
 from .cluster_tree_builder import ClusterTreeBuilder, ClusterTreeConfig
@@ -13,6 +18,12 @@ supported_tree_builders = {"cluster": (ClusterTreeBuilder, ClusterTreeConfig)}
 logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
 
 
+def cache_embedding_model(embedding_model, cache_dir):
+    if isinstance(embedding_model, CachedEmbeddingModel):
+        return embedding_model
+    return CachedEmbeddingModel(embedding_model, cache_dir)
+
+
 class RetrievalAugmentationConfig:
     def __init__(
             self,
@@ -40,6 +51,7 @@ class RetrievalAugmentationConfig:
             tb_summarization_model=None,
             tb_embedding_models=None,
             tb_cluster_embedding_model="OpenAI",
+            embedding_cache_dir=None,
     ):
         if tree_builder_type not in supported_tree_builders:
             raise ValueError(
@@ -63,6 +75,19 @@ class RetrievalAugmentationConfig:
             tb_cluster_embedding_model = "EMB"
             tr_context_embedding_model = "EMB"
 
+        if embedding_cache_dir is not None:
+            if tb_embedding_models is None:
+                tb_embedding_models = {"OpenAI": OpenAIEmbeddingModel()}
+            if tr_embedding_model is None:
+                tr_embedding_model = tb_embedding_models.get(
+                    tr_context_embedding_model, OpenAIEmbeddingModel()
+                )
+            tb_embedding_models = {
+                model_name: cache_embedding_model(model, embedding_cache_dir)
+                for model_name, model in tb_embedding_models.items()
+            }
+            tr_embedding_model = cache_embedding_model(tr_embedding_model, embedding_cache_dir)
+
         if summarization_model is not None and not isinstance(
             summarization_model, BaseSummarizationModel
         ):
@@ -149,8 +174,11 @@ class RetrievalAugmentation:
 
         if isinstance(tree, str):
             try:
-                with open(tree, "rb") as file:
-                    self.tree = pickle.load(file)
+                if os.path.isdir(tree):
+                    self.tree = load_tree(tree)
+                else:
+                    with open(tree, "rb") as file:
+                        self.tree = pickle.load(file)
                 if not isinstance(self.tree, Tree):
                     raise ValueError("The loaded object is not an instance of Tree")
             except Exception as e:
@@ -189,6 +217,17 @@ class RetrievalAugmentation:
         self.tree = self.tree_builder.build_from_text(text=docs)
         self.retriever = TreeRetriever(self.tree_retriever_config, self.tree)
 
+    def add_to_existing(self, docs):
+        if self.tree is None:
+            self.add_documents(docs)
+            return
+
+        if isinstance(self.tree, StoredTree):
+            self.tree = self.tree.materialize()
+
+        self.tree = self.tree_builder.add_to_existing(self.tree, docs)
+        self.retriever = TreeRetriever(self.tree_retriever_config, self.tree)
+
     def retrieve(
             self,
             question,
@@ -241,9 +280,78 @@ class RetrievalAugmentation:
 
         return answer
 
-    def save(self, path):
+    def retrieve_many(
+            self,
+            questions,
+            start_layer: int = None,
+            num_layers: int = None,
+            top_k: int = 10,
+            max_tokens: int = 3500,
+            collapse_tree: bool = True,
+            return_layer_information: bool = True,
+    ):
+        if self.retriever is None:
+            raise ValueError(
+                "The TreeRetriever instance has not been initialized. Call 'add_documents' first."
+            )
+
+        return self.retriever.retrieve_many(
+            questions,
+            start_layer,
+            num_layers,
+            top_k,
+            max_tokens,
+            collapse_tree,
+            return_layer_information,
+        )
+
+    def answer_many(
+            self,
+            questions,
+            top_k: int = 10,
+            start_layer: int = None,
+            num_layers: int = None,
+            max_tokens: int = 3500,
+            collapse_tree: bool = True,
+            return_layer_information: bool = False,
+            max_workers: int = 8,
+    ):
+        if not isinstance(max_workers, int) or max_workers < 1:
+            raise ValueError("max_workers must be an integer and at least 1")
+
+        retrieved = self.retrieve_many(
+            questions,
+            start_layer,
+            num_layers,
+            top_k,
+            max_tokens,
+            collapse_tree,
+            True
+        )
+        contexts = [context for context, _ in retrieved]
+
+        # 按问题顺序返回结果, 和 answer_question 一样, 失败的问题对应异常对象, 不影响其他问题的答案
+        answers = run_sync(self.qa_model.aanswer_questions(
+            contexts, questions, AsyncRateLimiter(max_workers)
+        ))
+
+        if return_layer_information:
+            return [
+                (answer, layer_information)
+                for answer, (_, layer_information) in zip(answers, retrieved)
+            ]
+
+        return answers
+
+    def save(self, path, storage_format: str = "pickle"):
         if self.tree is None:
             raise ValueError("There is no tree to save.")
-        with open(path, "wb") as file:
-            pickle.dump(self.tree, file)
+        if storage_format == "pickle":
+            tree = self.tree.materialize() if isinstance(self.tree, StoredTree) else self.tree
+            with open(path, "wb") as file:
+                pickle.dump(tree, file)
+        elif storage_format == "columnar":
+            save_tree(self.tree, path)
+        else:
+            raise ValueError("storage_format must be either 'pickle' or 'columnar'")
         logging.info(f"Tree successfully saved to {path}")
@@ -1,15 +1,18 @@
 import copy
+import asyncio
 import logging
 import tiktoken
 
 from abc import abstractmethod
-from typing import Dict, List, Optional, Set, Tuple
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from .tree_structures import Node, Tree
 from assistant.llm.embedding_models import BaseEmbeddingModel, OpenAIEmbeddingModel
 from assistant.llm.summarization_models import BaseSummarizationModel, GPT3TurboSummarization
-from .utils import (distances_from_embeddings, get_embeddings, indices_of_nearest_neighbors_from_distances, split_text)
+from .utils import (batched, distances_from_embeddings, get_embeddings, indices_of_nearest_neighbors_from_distances,
+                    iter_split_text, read_text_file)
 
 logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
 
@@ -155,12 +158,64 @@ class TreeBuilder:
         }
         return index, Node(text, index, children_indices, embeddings)
 
+    def create_nodes(
+            self,
+            indices: List[int],
+            texts: List[str],
+            children_indices: Optional[List[Set[int]]] = None
+    ) -> Dict[int, Node]:
+        if children_indices is None:
+            children_indices = [set() for _ in texts]
+
+        embeddings = {
+            model_name: model.create_embeddings(texts)
+            for model_name, model in self.embedding_models.items()
+        }
+
+        nodes = {}
+        for position, (index, text, children) in enumerate(zip(indices, texts, children_indices)):
+            node_embeddings = {
+                model_name: model_embeddings[position]
+                for model_name, model_embeddings in embeddings.items()
+            }
+            nodes[index] = Node(text, index, children, node_embeddings)
+
+        return nodes
+
+    async def acreate_nodes(
+            self,
+            indices: List[int],
+            texts: List[str],
+            children_indices: Optional[List[Set[int]]] = None
+    ) -> Dict[int, Node]:
+        if children_indices is None:
+            children_indices = [set() for _ in texts]
+
+        model_names = list(self.embedding_models.keys())
+        model_embeddings = await asyncio.gather(
+            *[self.embedding_models[model_name].acreate_embeddings(texts) for model_name in model_names]
+        )
+        embeddings = dict(zip(model_names, model_embeddings))
+
+        nodes = {}
+        for position, (index, text, children) in enumerate(zip(indices, texts, children_indices)):
+            node_embeddings = {
+                model_name: model_embeddings[position]
+                for model_name, model_embeddings in embeddings.items()
+            }
+            nodes[index] = Node(text, index, children, node_embeddings)
+
+        return nodes
+
     def create_embedding(self, text: str) -> List[float]:
         return self.embedding_models[self.cluster_embedding_model].create_embedding(text)
 
     def summarize(self, context, max_tokens=150) -> str:
         return self.summarization_model.summarize(context, max_tokens)
 
+    async def asummarize(self, context, max_tokens=150) -> str:
+        return await self.summarization_model.asummarize(context, max_tokens)
+
     def get_relevant_nodes(self, current_node, list_nodes):
         embeddings = get_embeddings(list_nodes, self.cluster_embedding_model)
         distances = distances_from_embeddings(
@@ -182,32 +237,43 @@ class TreeBuilder:
 
         return nodes_to_add
 
-    def multithreaded_create_leaf_nodes(self, chunks: List[str]) -> Dict[int, Node]:
-        with ThreadPoolExecutor() as executor:
-            future_nodes = {
-                executor.submit(self.create_node, index, text, None): (index, text)
-                for index, text in enumerate(chunks)
-            }
-
-            leaf_nodes = {}
-            for future in as_completed(future_nodes):
-                index, node = future.result()
-                leaf_nodes[index] = node
+    def create_leaf_nodes(
+            self,
+            chunks: Iterable[str],
+            batch_size: int = 512,
+            max_pending: int = 2,
+    ) -> Dict[int, Node]:
+        # 一边切分文本一边embedding, 最多同时有 max_pending 个批次在等待结果
+        # max_pending 为1时每批提交后立即等待结果, 切分和embedding不会重叠
+        if max_pending < 1:
+            raise ValueError("max_pending must be at least 1")
+        leaf_nodes = {}
+        pending = deque()
+        next_index = 0
+        with ThreadPoolExecutor(max_workers=max_pending) as executor:
+            for batch in batched(chunks, batch_size):
+                pending.append(executor.submit(
+                    self.create_nodes, list(range(next_index, next_index + len(batch))), batch
+                ))
+                next_index += len(batch)
+                if len(pending) >= max_pending:
+                    leaf_nodes.update(pending.popleft().result())
+
+            while pending:
+                leaf_nodes.update(pending.popleft().result())
 
         return leaf_nodes
 
-    def build_from_text(self, text: str, use_multithreading: bool = False) -> Tree:
-        chunks = split_text(text, self.tokenizer, self.max_tokens)
+    def build_from_text(
+            self,
+            text: Union[str, Iterable],
+            use_multithreading: bool = False
+    ) -> Tree:
+        chunks = iter_split_text(text, self.tokenizer, self.max_tokens)
 
         logging.info("Creating Leaf Nodes")
 
-        if use_multithreading:
-            leaf_nodes = self.multithreaded_create_leaf_nodes(chunks)
-        else:
-            leaf_nodes = {}
-            for index, text in enumerate(chunks):
-                _, node = self.create_node(index, text)
-                leaf_nodes[index] = node
+        leaf_nodes = self.create_leaf_nodes(chunks, max_pending=4 if use_multithreading else 2)
 
         layer_to_nodes = {0: list(leaf_nodes.values())}
 
@@ -223,6 +289,9 @@ class TreeBuilder:
 
         return tree
 
+    def build_from_file(self, path: str, use_multithreading: bool = False) -> Tree:
+        return self.build_from_text([read_text_file(path)], use_multithreading)
+
     @abstractmethod
     def construct_tree(
             self,
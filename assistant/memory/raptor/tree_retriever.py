@@ -1,14 +1,14 @@
 import logging
 import tiktoken
 
-from typing import List, Tuple
+import numpy as np
+
+from typing import List, Optional, Tuple
 
 from .retrievers import BaseRetriever
 from .tree_structures import Node, Tree
 from assistant.llm.embedding_models import BaseEmbeddingModel, OpenAIEmbeddingModel
-from .utils import (distances_from_embeddings, get_embeddings,
-                    get_node_list, get_text,
-                    indices_of_nearest_neighbors_from_distances, reverse_mapping)
+from .utils import get_text, indices_of_top_k_from_distances
 
 
 logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
@@ -132,7 +132,8 @@ class TreeRetriever(BaseRetriever):
         self.embedding_model = config.embedding_model
         self.context_embedding_model = config.context_embedding_model
 
-        self.tree_node_index_to_layer = reverse_mapping(self.tree.layer_to_nodes)
+        self.tree_node_index_to_layer = self.tree.get_node_to_layer()
+        self.embedding_matrix = self.tree.get_embedding_matrix(self.context_embedding_model)
 
         logging.info(
             f"Successfully initialized TreeRetriever with Config {config.log_config()}"
@@ -141,21 +142,18 @@ class TreeRetriever(BaseRetriever):
     def create_embedding(self, text: str) -> List[float]:
         return self.embedding_model.create_embedding(text)
 
-    def retrieve_information_collapse_tree(
+    def create_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self.embedding_model.create_embeddings(texts)
+
+    def select_collapse_tree_nodes(
             self,
-            query: str,
-            top_k: int,
-            max_tokens: int) -> Tuple[List, str]:
-        query_embedding = self.create_embedding(query)
+            indices: np.ndarray,
+            max_tokens: int
+    ) -> Tuple[List, str]:
         selected_nodes = []
-        node_list = get_node_list(self.tree.all_nodes)
-        embeddings = get_embeddings(node_list, self.context_embedding_model)
-        distances = distances_from_embeddings(query_embedding, embeddings)
-        indices = indices_of_nearest_neighbors_from_distances(distances)
-
         total_tokens = 0
-        for idx in indices[:top_k]:
-            node = node_list[idx]
+        for idx in indices:
+            node = self.tree.all_nodes[int(self.embedding_matrix.node_indices[idx])]
             node_tokens = len(self.tokenizer.encode(node.text))
 
             if total_tokens + node_tokens > max_tokens:
@@ -167,29 +165,41 @@ class TreeRetriever(BaseRetriever):
         context = get_text(selected_nodes)
         return selected_nodes, context
 
-    def retrieve_information(
+    def retrieve_information_collapse_tree(
             self,
-            current_nodes: List[Node],
             query: str,
-            num_layers: int
-    ) -> Tuple[List, str]:
+            top_k: int,
+            max_tokens: int) -> Tuple[List, str]:
         query_embedding = self.create_embedding(query)
+        distances = self.embedding_matrix.distances(query_embedding)
+        indices = indices_of_top_k_from_distances(distances, top_k)
+
+        return self.select_collapse_tree_nodes(indices, max_tokens)
+
+    def select_best_indices(self, distances: np.ndarray) -> np.ndarray:
+        if self.selection_mode == "threshold":
+            candidates = np.nonzero(distances > self.threshold)[0]
+            return candidates[np.argsort(distances[candidates], kind="stable")]
+
+        elif self.selection_mode == "top_k":
+            return indices_of_top_k_from_distances(distances, self.top_k)
+        else:
+            raise ValueError(f"{self.selection_mode} must be either 'threshold' or 'top_k'")
+
+    def retrieve_information_from_embedding(
+            self,
+            current_nodes: List[Node],
+            query_embedding,
+            num_layers: int,
+            distances: Optional[np.ndarray] = None,
+    ) -> Tuple[List, str]:
         selected_nodes = []
         node_list = current_nodes
         for layer in range(num_layers):
-            embeddings = get_embeddings(node_list, self.context_embedding_model)
-            distances = distances_from_embeddings(query_embedding, embeddings)
-            indices = indices_of_nearest_neighbors_from_distances(distances)
-
-            if self.selection_mode == "threshold":
-                best_indices = [
-                    index for index in indices if distances[index] > self.threshold
-                ]
-
-            elif self.selection_mode == "top_k":
-                best_indices = indices[: self.top_k]
-            else:
-                raise ValueError(f"{self.selection_mode} must be either 'threshold' or 'top_k'")
+            if layer > 0 or distances is None:
+                rows = self.embedding_matrix.rows_for(node.index for node in node_list)
+                distances = self.embedding_matrix.distances(query_embedding, rows)
+            best_indices = self.select_best_indices(distances)
 
             nodes_to_add = [node_list[idx] for idx in best_indices]
             selected_nodes.extend(nodes_to_add)
@@ -205,19 +215,24 @@ class TreeRetriever(BaseRetriever):
         context = get_text(selected_nodes)
         return selected_nodes, context
 
-    def retrieve(
+    def retrieve_information(
             self,
+            current_nodes: List[Node],
             query: str,
-            start_layer: int = None,
-            num_layers: int = None,
-            top_k: int = 10,
-            max_tokens: int = 3500,
-            collapse_tree: bool = True,
-            return_layer_information: bool = False
-    ) -> Tuple[str, List] | str:
-        if not isinstance(query, str):
-            raise ValueError("query must be a string")
+            num_layers: int
+    ) -> Tuple[List, str]:
+        query_embedding = self.create_embedding(query)
+        return self.retrieve_information_from_embedding(
+            current_nodes, query_embedding, num_layers
+        )
 
+    def check_retrieve_parameters(
+            self,
+            start_layer: Optional[int],
+            num_layers: Optional[int],
+            max_tokens: int,
+            collapse_tree: bool,
+    ) -> Tuple[int, int]:
         if not isinstance(max_tokens, int) or max_tokens < 1:
             raise ValueError("max_tokens must be an integer and at least 1")
 
@@ -240,17 +255,14 @@ class TreeRetriever(BaseRetriever):
         if num_layers > (start_layer + 1):
             raise ValueError("num_layers must be less than or equal to start_layer + 1")
 
-        if collapse_tree:
-            logging.info(f"Using collapsed_tree")
-            selected_nodes, context = self.retrieve_information_collapse_tree(
-                query, top_k, max_tokens
-            )
-        else:
-            layer_nodes = self.tree.layer_to_nodes[start_layer]
-            selected_nodes, context = self.retrieve_information(
-                layer_nodes, query, num_layers
-            )
+        return start_layer, num_layers
 
+    def format_retrieve_result(
+            self,
+            selected_nodes: List[Node],
+            context: str,
+            return_layer_information: bool
+    ) -> Tuple[str, List] | str:
         if return_layer_information:
             layer_information = []
             for node in selected_nodes:
@@ -265,8 +277,88 @@ class TreeRetriever(BaseRetriever):
 
         return context
 
+    def retrieve(
+            self,
+            query: str,
+            start_layer: int = None,
+            num_layers: int = None,
+            top_k: int = 10,
+            max_tokens: int = 3500,
+            collapse_tree: bool = True,
+            return_layer_information: bool = False
+    ) -> Tuple[str, List] | str:
+        if not isinstance(query, str):
+            raise ValueError("query must be a string")
 
+        start_layer, num_layers = self.check_retrieve_parameters(
+            start_layer, num_layers, max_tokens, collapse_tree
+        )
 
+        if collapse_tree:
+            logging.info(f"Using collapsed_tree")
+            selected_nodes, context = self.retrieve_information_collapse_tree(
+                query, top_k, max_tokens
+            )
+        else:
+            layer_nodes = self.tree.layer_to_nodes[start_layer]
+            selected_nodes, context = self.retrieve_information(
+                layer_nodes, query, num_layers
+            )
+
+        return self.format_retrieve_result(
+            selected_nodes, context, return_layer_information
+        )
+
+    def retrieve_many(
+            self,
+            queries: List[str],
+            start_layer: int = None,
+            num_layers: int = None,
+            top_k: int = 10,
+            max_tokens: int = 3500,
+            collapse_tree: bool = True,
+            return_layer_information: bool = False
+    ) -> List[Tuple[str, List] | str]:
+        if not isinstance(queries, (list, tuple)) or not all(
+            isinstance(query, str) for query in queries
+        ):
+            raise ValueError("queries must be a list of strings")
+
+        start_layer, num_layers = self.check_retrieve_parameters(
+            start_layer, num_layers, max_tokens, collapse_tree
+        )
+
+        if len(queries) == 0:
+            return []
 
+        query_embeddings = np.asarray(self.create_embeddings(list(queries)), dtype=np.float32)
 
+        results = []
+        if collapse_tree:
+            logging.info(f"Using collapsed_tree for {len(queries)} queries")
+            distances = self.embedding_matrix.distances(query_embeddings)
+            indices = indices_of_top_k_from_distances(distances, top_k)
+            for query_indices in indices:
+                selected_nodes, context = self.select_collapse_tree_nodes(
+                    query_indices, max_tokens
+                )
+                results.append(
+                    self.format_retrieve_result(
+                        selected_nodes, context, return_layer_information
+                    )
+                )
+        else:
+            layer_nodes = self.tree.layer_to_nodes[start_layer]
+            rows = self.embedding_matrix.rows_for(node.index for node in layer_nodes)
+            distances = self.embedding_matrix.distances(query_embeddings, rows)
+            for query_embedding, query_distances in zip(query_embeddings, distances):
+                selected_nodes, context = self.retrieve_information_from_embedding(
+                    layer_nodes, query_embedding, num_layers, query_distances
+                )
+                results.append(
+                    self.format_retrieve_result(
+                        selected_nodes, context, return_layer_information
+                    )
+                )
 
+        return results
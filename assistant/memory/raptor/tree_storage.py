@@ -0,0 +1,314 @@
+import os
+import json
+import logging
+
+import numpy as np
+
+from collections.abc import Mapping, Sequence
+from typing import Dict, Iterator, List, Set
+
+from .tree_structures import Node, Tree
+from .embedding_matrix import EmbeddingMatrix
+
+logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+
+FORMAT_VERSION = 1
+
+# 目录中的文件
+META_FILE = "meta.json"
+TEXTS_FILE = "texts.bin"
+TEXT_OFFSETS_FILE = "text_offsets.npy"
+NODE_INDICES_FILE = "node_indices.npy"
+NODE_LAYERS_FILE = "node_layers.npy"
+CHILDREN_INDPTR_FILE = "children_indptr.npy"
+CHILDREN_INDICES_FILE = "children_indices.npy"
+
+
+def embeddings_file(position: int) -> str:
+    return f"embeddings_{position}.npy"
+
+
+def norms_file(position: int) -> str:
+    return f"norms_{position}.npy"
+
+
+def save_tree(tree: Tree, path: str) -> None:
+    os.makedirs(path, exist_ok=True)
+
+    # 按层排列节点, 与EmbeddingMatrix的行顺序一致, 加载后可直接复用
+    ordered_nodes: List[Node] = []
+    node_layers: List[int] = []
+    seen = set()
+    for layer in sorted(tree.layer_to_nodes.keys()):
+        for node in tree.layer_to_nodes[layer]:
+            if node.index not in seen:
+                seen.add(node.index)
+                ordered_nodes.append(node)
+                node_layers.append(layer)
+    for index in sorted(tree.all_nodes.keys()):
+        if index not in seen:
+            seen.add(index)
+            ordered_nodes.append(tree.all_nodes[index])
+            node_layers.append(-1)
+
+    encoded_texts = [node.text.encode("utf-8") for node in ordered_nodes]
+    text_offsets = np.zeros(len(encoded_texts) + 1, dtype=np.int64)
+    np.cumsum([len(text) for text in encoded_texts], out=text_offsets[1:])
+    with open(os.path.join(path, TEXTS_FILE), "wb") as file:
+        for text in encoded_texts:
+            file.write(text)
+    np.save(os.path.join(path, TEXT_OFFSETS_FILE), text_offsets)
+
+    np.save(
+        os.path.join(path, NODE_INDICES_FILE),
+        np.array([node.index for node in ordered_nodes], dtype=np.int64),
+    )
+    np.save(os.path.join(path, NODE_LAYERS_FILE), np.array(node_layers, dtype=np.int32))
+
+    children = [sorted(node.children) for node in ordered_nodes]
+    children_indptr = np.zeros(len(children) + 1, dtype=np.int64)
+    np.cumsum([len(node_children) for node_children in children], out=children_indptr[1:])
+    children_indices = np.array(
+        [index for node_children in children for index in node_children], dtype=np.int64
+    )
+    np.save(os.path.join(path, CHILDREN_INDPTR_FILE), children_indptr)
+    np.save(os.path.join(path, CHILDREN_INDICES_FILE), children_indices)
+
+    embedding_models = sorted(ordered_nodes[0].embeddings.keys()) if ordered_nodes else []
+    for position, model_name in enumerate(embedding_models):
+        embeddings = np.array(
+            [node.embeddings[model_name] for node in ordered_nodes], dtype=np.float32
+        )
+        norms = np.linalg.norm(embeddings, axis=1).astype(np.float32)
+        embeddings /= np.where(norms > 0, norms, 1.0)[:, None]
+        np.save(os.path.join(path, embeddings_file(position)), embeddings)
+        np.save(os.path.join(path, norms_file(position)), norms)
+
+    meta = {
+        "format_version": FORMAT_VERSION,
+        "num_nodes": len(ordered_nodes),
+        "num_layers": tree.num_layers,
+        "root_nodes": sorted(node.index for node in _node_values(tree.root_nodes)),
+        "leaf_nodes": sorted(node.index for node in _node_values(tree.leaf_nodes)),
+        "embedding_models": embedding_models,
+    }
+    with open(os.path.join(path, META_FILE), "w") as file:
+        json.dump(meta, file)
+
+    logging.info(f"Tree with {len(ordered_nodes)} nodes saved to {path}")
+
+
+def _node_values(nodes) -> List[Node]:
+    if isinstance(nodes, dict):
+        return list(nodes.values())
+    return list(nodes)
+
+
+class TreeStore:
+    def __init__(self, path: str) -> None:
+        with open(os.path.join(path, META_FILE), "r") as file:
+            self.meta = json.load(file)
+
+        if self.meta["format_version"] != FORMAT_VERSION:
+            raise ValueError(
+                f"Unsupported tree format version {self.meta['format_version']}"
+            )
+
+        self.path = path
+        self.embedding_models: List[str] = self.meta["embedding_models"]
+
+        self.node_indices = np.load(os.path.join(path, NODE_INDICES_FILE), mmap_mode="r")
+        self.node_layers = np.load(os.path.join(path, NODE_LAYERS_FILE), mmap_mode="r")
+        self.text_offsets = np.load(os.path.join(path, TEXT_OFFSETS_FILE), mmap_mode="r")
+        self.children_indptr = np.load(os.path.join(path, CHILDREN_INDPTR_FILE), mmap_mode="r")
+        self.children_indices = np.load(os.path.join(path, CHILDREN_INDICES_FILE), mmap_mode="r")
+
+        texts_path = os.path.join(path, TEXTS_FILE)
+        if os.path.getsize(texts_path) > 0:
+            self.texts = np.memmap(texts_path, dtype=np.uint8, mode="r")
+        else:
+            self.texts = np.empty(0, dtype=np.uint8)
+
+        self.embeddings = {}
+        self.norms = {}
+        for position, model_name in enumerate(self.embedding_models):
+            self.embeddings[model_name] = np.load(
+                os.path.join(path, embeddings_file(position)), mmap_mode="r"
+            )
+            self.norms[model_name] = np.load(
+                os.path.join(path, norms_file(position)), mmap_mode="r"
+            )
+
+        self.node_to_row: Dict[int, int] = {
+            index: row for row, index in enumerate(self.node_indices.tolist())
+        }
+
+    def __len__(self) -> int:
+        return len(self.node_indices)
+
+    def text(self, row: int) -> str:
+        start, stop = self.text_offsets[row], self.text_offsets[row + 1]
+        return self.texts[start:stop].tobytes().decode("utf-8")
+
+    def children(self, row: int) -> Set[int]:
+        start, stop = self.children_indptr[row], self.children_indptr[row + 1]
+        return set(self.children_indices[start:stop].tolist())
+
+    def embedding(self, row: int, model_name: str) -> List[float]:
+        return (self.embeddings[model_name][row] * self.norms[model_name][row]).tolist()
+
+    def layer_rows(self, layer: int) -> np.ndarray:
+        return np.flatnonzero(np.asarray(self.node_layers) == layer)
+
+    def layer_slices(self) -> Dict[int, slice]:
+        layer_slices = {}
+        node_layers = np.asarray(self.node_layers)
+        for layer in np.unique(node_layers):
+            if layer < 0:
+                continue
+            rows = np.flatnonzero(node_layers == layer)
+            layer_slices[int(layer)] = slice(int(rows[0]), int(rows[-1]) + 1)
+        return layer_slices
+
+
+class NodeEmbeddings(Mapping):
+    def __init__(self, store: TreeStore, row: int) -> None:
+        self.store = store
+        self.row = row
+
+    def __getitem__(self, model_name: str) -> List[float]:
+        if model_name not in self.store.embeddings:
+            raise KeyError(model_name)
+        return self.store.embedding(self.row, model_name)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.store.embedding_models)
+
+    def __len__(self) -> int:
+        return len(self.store.embedding_models)
+
+
+class NodeView(Node):
+    def __init__(self, store: TreeStore, row: int) -> None:
+        self.store = store
+        self.row = row
+
+    @property
+    def text(self) -> str:
+        return self.store.text(self.row)
+
+    @property
+    def index(self) -> int:
+        return int(self.store.node_indices[self.row])
+
+    @property
+    def children(self) -> Set[int]:
+        return self.store.children(self.row)
+
+    @property
+    def embeddings(self) -> NodeEmbeddings:
+        return NodeEmbeddings(self.store, self.row)
+
+    def materialize(self) -> Node:
+        return Node(
+            self.text,
+            self.index,
+            self.children,
+            {model_name: self.embeddings[model_name] for model_name in self.store.embedding_models},
+        )
+
+
+class NodeViewMapping(Mapping):
+    def __init__(self, store: TreeStore, node_indices: List[int]) -> None:
+        self.store = store
+        self.node_indices = node_indices
+        self.members = set(node_indices)
+
+    def __getitem__(self, index: int) -> NodeView:
+        if index not in self.members:
+            raise KeyError(index)
+        return NodeView(self.store, self.store.node_to_row[index])
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.node_indices)
+
+    def __len__(self) -> int:
+        return len(self.node_indices)
+
+
+class NodeViewList(Sequence):
+    def __init__(self, store: TreeStore, rows: np.ndarray) -> None:
+        self.store = store
+        self.rows = rows
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return NodeViewList(self.store, self.rows[position])
+        return NodeView(self.store, int(self.rows[position]))
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+
+class StoredTree(Tree):
+    def __init__(self, path: str) -> None:
+        self.store = TreeStore(path)
+        meta = self.store.meta
+
+        all_indices = self.store.node_indices.tolist()
+        layer_to_nodes = {
+            layer: NodeViewList(self.store, self.store.layer_rows(layer))
+            for layer in range(meta["num_layers"] + 1)
+        }
+
+        super().__init__(
+            NodeViewMapping(self.store, all_indices),
+            NodeViewMapping(self.store, meta["root_nodes"]),
+            NodeViewMapping(self.store, meta["leaf_nodes"]),
+            meta["num_layers"],
+            layer_to_nodes,
+        )
+
+    def get_node_to_layer(self) -> Dict[int, int]:
+        return {
+            index: layer
+            for index, layer in zip(self.store.node_indices.tolist(), self.store.node_layers.tolist())
+            if layer >= 0
+        }
+
+    def get_embedding_matrix(self, embedding_model: str) -> EmbeddingMatrix:
+        if embedding_model not in self.embedding_matrices:
+            self.embedding_matrices[embedding_model] = EmbeddingMatrix.from_arrays(
+                np.asarray(self.store.node_indices),
+                self.store.embeddings[embedding_model],
+                self.store.norms[embedding_model],
+                self.store.layer_slices(),
+                embedding_model,
+            )
+        return self.embedding_matrices[embedding_model]
+
+    def materialize(self) -> Tree:
+        all_nodes = {
+            index: NodeView(self.store, row).materialize()
+            for index, row in self.store.node_to_row.items()
+        }
+        layer_to_nodes = {
+            layer: [all_nodes[node.index] for node in nodes]
+            for layer, nodes in self.layer_to_nodes.items()
+        }
+        return Tree(
+            all_nodes,
+            {index: all_nodes[index] for index in self.root_nodes},
+            {index: all_nodes[index] for index in self.leaf_nodes},
+            self.num_layers,
+            layer_to_nodes,
+        )
+
+    def __getstate__(self) -> Dict:
+        raise TypeError("StoredTree cannot be pickled, call materialize() first")
+
+
+def load_tree(path: str) -> StoredTree:
+    tree = StoredTree(path)
+    logging.info(f"Tree with {len(tree.store)} nodes loaded from {path}")
+    return tree
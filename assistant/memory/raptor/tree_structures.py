@@ -1,5 +1,7 @@
 from typing import Dict, List, Set
 
+from .embedding_matrix import EmbeddingMatrix
+
 
 class Node:
     def __init__(self, text: str, index: int, children: Set[int], embeddings) -> None:
@@ -16,3 +18,31 @@ class Tree:
         self.leaf_nodes = leaf_nodes
         self.num_layers = num_layers
         self.layer_to_nodes = layer_to_nodes
+        self.embedding_matrices: Dict[str, EmbeddingMatrix] = {}
+
+    def get_embedding_matrix(self, embedding_model: str) -> EmbeddingMatrix:
+        if embedding_model not in self.embedding_matrices:
+            self.embedding_matrices[embedding_model] = EmbeddingMatrix(
+                self.all_nodes, self.layer_to_nodes, embedding_model
+            )
+        return self.embedding_matrices[embedding_model]
+
+    def get_node_to_layer(self) -> Dict[int, int]:
+        node_to_layer = {}
+        for layer, nodes in self.layer_to_nodes.items():
+            for node in nodes:
+                node_to_layer[node.index] = layer
+
+        return node_to_layer
+
+    def invalidate_embedding_matrices(self) -> None:
+        self.embedding_matrices = {}
+
+    def __getstate__(self) -> Dict:
+        state = self.__dict__.copy()
+        state.pop("embedding_matrices", None)
+        return state
+
+    def __setstate__(self, state: Dict) -> None:
+        self.__dict__.update(state)
+        self.embedding_matrices = {}
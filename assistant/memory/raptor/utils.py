@@ -1,13 +1,16 @@
 import re
+import asyncio
 import logging
 
 import tiktoken
 import numpy as np
 
-from scipy import spatial
-from typing import Dict, List, Set
+from typing import Dict, Iterable, Iterator, List, Set, Union
+from concurrent.futures import ThreadPoolExecutor
 
 from .tree_structures import Node
+from assistant.llm.openai_clients import close_async_clients
+from .embedding_matrix import pairwise_distances, top_k_indices
 
 logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
 
@@ -21,86 +24,163 @@ def reverse_mapping(layer_to_node: Dict[int, List[Node]]) -> Dict[int, int]:
     return node_to_layer
 
 
-def split_text(
-        text: str,
-        tokenizer: tiktoken.get_encoding("cl100k_base"),
-        max_tokens: int,
-        overlap: int = 0
-):
-    delimiters = [".", "!", "?", "\n"]
-    regex_pattern = "|".join(map(re.escape, delimiters))
-    sentences = re.split(regex_pattern, text)
+async def run_and_close_clients(coroutine):
+    # 每次 run_sync 都新建事件循环, 结束前关闭该循环上的OpenAI异步客户端和它们的长连接
+    try:
+        return await coroutine
+    finally:
+        await close_async_clients()
 
-    n_tokens = [len(tokenizer.encode(" " + sentence)) for sentence in sentences]
 
-    chunks = []
-    current_chunk = []
-    current_length = 0
+def run_sync(coroutine):
+    # 已经处在事件循环中时(例如被异步服务调用), 在独立线程中运行协程
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(run_and_close_clients(coroutine))
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, run_and_close_clients(coroutine)).result()
 
-    for sentence, token_count in zip(sentences, n_tokens):
-        if not sentence.strip():
-            continue
 
-        if token_count > max_tokens:
-            sub_sentences = re.split(r"[,;:]", sentence)
-            sub_token_counts = [len(tokenizer.encode(" " + sub_sentence)) for sub_sentence in sub_sentences]
+SENTENCE_DELIMITERS = re.compile("|".join(map(re.escape, [".", "!", "?", "\n"])))
+CLAUSE_DELIMITERS = re.compile(r"[,;:]")
 
-            sub_chunk = []
-            sub_length = 0
 
-            for sub_sentence, sub_token_count in zip(sub_sentences, sub_token_counts):
-                if sub_length + sub_token_count > max_tokens:
-                    chunks.append(" ".join(sub_chunk))
-                    sub_chunk = sub_chunk[-overlap:] if overlap > 0 else []
-                    sub_length = sum(sub_token_counts[max(0, len(sub_chunk) - overlap):len(sub_chunk)])
+def batched(iterable: Iterable, batch_size: int) -> Iterator[List]:
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
-                sub_chunk.append(sub_sentence)
-                sub_length += sub_token_count
 
-            if sub_chunk:
-                chunks.append(" ".join(sub_chunk))
+def count_tokens(tokenizer, texts: List[str]) -> List[int]:
+    if hasattr(tokenizer, "encode_batch"):
+        return [len(tokens) for tokens in tokenizer.encode_batch(texts)]
+    return [len(tokenizer.encode(text)) for text in texts]
 
-        elif current_length + token_count > max_tokens:
-            chunks.append(" ".join(current_chunk))
-            current_chunk = current_chunk[-overlap:] if overlap > 0 else []
-            current_length = sum(n_tokens[max(0, len(current_chunk) - overlap):len(current_chunk)])
-            current_chunk.append(sentence)
-            current_length += token_count
 
-        else:
-            current_chunk.append(sentence)
-            current_length += token_count
+def read_text_file(path: str, block_size: int = 1 << 20, encoding: str = "utf-8") -> Iterator[str]:
+    with open(path, "r", encoding=encoding) as file:
+        while True:
+            block = file.read(block_size)
+            if not block:
+                break
+            yield block
+
+
+def iter_sentences(blocks: Iterable[str]) -> Iterator[str]:
+    # 与对整段文本调用re.split等价, 块末尾未结束的句子留到下一块继续拼接
+    remainder = ""
+    for block in blocks:
+        text = remainder + block
+        position = 0
+        for match in SENTENCE_DELIMITERS.finditer(text):
+            yield text[position:match.start()]
+            position = match.end()
+        remainder = text[position:]
+    yield remainder
+
+
+def iter_split_text(
+        documents: Union[str, Iterable],
+        tokenizer,
+        max_tokens: int,
+        overlap: int = 0,
+        batch_size: int = 1024,
+) -> Iterator[str]:
+    # documents 可以是一段文本, 也可以是文档的迭代器; 每个文档本身也可以是文本块的迭代器(例如read_text_file)
+    if isinstance(documents, str):
+        documents = [documents]
+
+    for document in documents:
+        blocks = [document] if isinstance(document, str) else document
+        yield from split_sentences(iter_sentences(blocks), tokenizer, max_tokens, overlap, batch_size)
+
+
+def split_sentences(
+        sentences: Iterable[str],
+        tokenizer,
+        max_tokens: int,
+        overlap: int = 0,
+        batch_size: int = 1024,
+) -> Iterator[str]:
+    current_chunk = []
+    current_counts = []
+    current_length = 0
+
+    for batch in batched(sentences, batch_size):
+        n_tokens = count_tokens(tokenizer, [" " + sentence for sentence in batch])
+
+        for sentence, token_count in zip(batch, n_tokens):
+            if not sentence.strip():
+                continue
+
+            if token_count > max_tokens:
+                sub_sentences = CLAUSE_DELIMITERS.split(sentence)
+                sub_token_counts = count_tokens(
+                    tokenizer, [" " + sub_sentence for sub_sentence in sub_sentences]
+                )
+
+                sub_chunk = []
+                sub_counts = []
+                sub_length = 0
+
+                for sub_sentence, sub_token_count in zip(sub_sentences, sub_token_counts):
+                    if sub_length + sub_token_count > max_tokens and sub_chunk:
+                        yield " ".join(sub_chunk)
+                        sub_chunk = sub_chunk[-overlap:] if overlap > 0 else []
+                        sub_counts = sub_counts[-overlap:] if overlap > 0 else []
+                        sub_length = sum(sub_counts)
+
+                    sub_chunk.append(sub_sentence)
+                    sub_counts.append(sub_token_count)
+                    sub_length += sub_token_count
+
+                if sub_chunk:
+                    yield " ".join(sub_chunk)
+
+            elif current_length + token_count > max_tokens:
+                if current_chunk:
+                    yield " ".join(current_chunk)
+                current_chunk = current_chunk[-overlap:] if overlap > 0 else []
+                current_counts = current_counts[-overlap:] if overlap > 0 else []
+                current_length = sum(current_counts)
+                current_chunk.append(sentence)
+                current_counts.append(token_count)
+                current_length += token_count
+
+            else:
+                current_chunk.append(sentence)
+                current_counts.append(token_count)
+                current_length += token_count
 
     if current_chunk:
-        chunks.append(" ".join(current_chunk))
+        yield " ".join(current_chunk)
 
-    return chunks
+
+def split_text(
+        text: str,
+        tokenizer: tiktoken.get_encoding("cl100k_base"),
+        max_tokens: int,
+        overlap: int = 0
+):
+    return list(iter_split_text(text, tokenizer, max_tokens, overlap))
 
 
 def distances_from_embeddings(
         query_embedding: List[float],
         embeddings: List[List[float]],
         distance_metric: str = "cosine",
-) -> List[float]:
-    distance_metrics = {
-        "cosine": spatial.distance.cosine,
-        "L1": spatial.distance.cityblock,
-        "L2": spatial.distance.euclidean,
-        "Linf": spatial.distance.chebyshev,
-    }
-
-    if distance_metric not in distance_metrics:
-        raise ValueError(
-            f"Unsupported distance metric '{distance_metric}'. Supported metrics are: {list(distance_metrics.keys())}"
+) -> np.ndarray:
+    if len(embeddings) == 0:
+        return np.empty(0, dtype=np.float32)
 
-        )
-
-    distances = [
-        distance_metrics[distance_metric](query_embedding, embedding)
-        for embedding in embeddings
-    ]
-
-    return distances
+    return pairwise_distances(query_embedding, embeddings, distance_metric)[0]
 
 
 def get_node_list(node_dict: Dict[int, Node]) -> List[Node]:
@@ -128,3 +208,7 @@ def get_text(node_list: List[Node]) -> str:
 
 def indices_of_nearest_neighbors_from_distances(distances: List[float]) -> np.ndarray:
     return np.argsort(distances)
+
+
+def indices_of_top_k_from_distances(distances: np.ndarray, k: int) -> np.ndarray:
+    return top_k_indices(distances, k)
@@ -0,0 +1,202 @@
+import json
+import random
+import struct
+
+from enum import IntEnum
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, NamedTuple, Optional, Tuple, Union
+
+
+# 二进制websocket帧: 固定长度的帧头 + 可选的JSON元数据 + 原始负载字节
+# 帧头: 魔数, 版本, 标志位, 内容类型, 发送方, 接收方, 请求id, 负载长度, 元数据长度
+# 服务器只解析帧头做路由, 元数据和负载原样转发, 不需要base64编码和JSON解析
+HEADER = struct.Struct('!2sBBB16s16sQIH')
+MAGIC = b'AS'
+VERSION = 1
+NAME_SIZE = 16
+
+# 负载超过分块大小时拆成多帧发送, 除最后一帧外都带有 FLAG_MORE
+FLAG_MORE = 0x01
+
+# 中间结果: 同一请求之后还会有回复, 最后一条回复不带该标志
+FLAG_PARTIAL = 0x02
+
+# 取消请求: 发起请求的客户端断开后, 服务器通知worker丢弃该请求已经收到的分块和状态
+FLAG_ABORT = 0x04
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+
+class ContentType(IntEnum):
+    text = 0
+    json = 1
+    bytes = 2
+    audio = 3
+    image = 4
+    video = 5
+    error = 6
+
+
+class FrameHeader(NamedTuple):
+    flags: int
+    content_type: ContentType
+    sender: str
+    receiver: str
+    request_id: int
+    length: int
+    meta_length: int
+
+
+@dataclass
+class Message:
+    sender: str
+    receiver: str
+    request_id: int
+    content_type: ContentType
+    payload: bytes = b''
+    meta: Dict = field(default_factory=dict)
+    partial: bool = False
+
+    def text(self) -> str:
+        return bytes(self.payload).decode('utf-8')
+
+    def json(self):
+        return json.loads(bytes(self.payload).decode('utf-8'))
+
+    def describe(self) -> str:
+        # 日志中只记录帧头信息, 不打印负载
+        return (f"{self.sender} -> {self.receiver} #{self.request_id} "
+                f"{self.content_type.name} {len(self.payload)} bytes")
+
+
+def next_request_id() -> int:
+    # 服务器按请求id把回复送回发起请求的连接, 多个客户端可能同名, 因此使用随机的63位id避免冲突
+    return random.getrandbits(63) or 1
+
+
+def encode_name(name: str) -> bytes:
+    encoded = name.encode('utf-8')
+    if len(encoded) > NAME_SIZE:
+        raise ValueError(f"Name {name} is longer than {NAME_SIZE} bytes")
+    return encoded
+
+
+def encode_frame(
+        sender: str,
+        receiver: str,
+        request_id: int,
+        content_type: ContentType,
+        payload: Union[bytes, memoryview] = b'',
+        meta: Optional[Dict] = None,
+        flags: int = 0
+) -> bytes:
+    meta_bytes = json.dumps(meta).encode('utf-8') if meta else b''
+    header = HEADER.pack(
+        MAGIC, VERSION, flags, int(content_type),
+        encode_name(sender), encode_name(receiver),
+        request_id, len(payload), len(meta_bytes),
+    )
+    return b''.join([header, meta_bytes, payload])
+
+
+def decode_header(frame: bytes) -> FrameHeader:
+    if len(frame) < HEADER.size:
+        raise ValueError(f"Frame of {len(frame)} bytes is shorter than the header")
+    magic, version, flags, content_type, sender, receiver, request_id, length, meta_length = (
+        HEADER.unpack_from(frame)
+    )
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"Unsupported frame magic {magic!r} or version {version}")
+    if HEADER.size + meta_length + length != len(frame):
+        raise ValueError("Frame length does not match its header")
+    return FrameHeader(
+        flags,
+        ContentType(content_type),
+        sender.rstrip(b'\0').decode('utf-8'),
+        receiver.rstrip(b'\0').decode('utf-8'),
+        request_id,
+        length,
+        meta_length,
+    )
+
+
+def decode_frame(frame: bytes) -> Tuple[FrameHeader, Dict, memoryview]:
+    header = decode_header(frame)
+    view = memoryview(frame)
+    meta_end = HEADER.size + header.meta_length
+    meta = json.loads(bytes(view[HEADER.size:meta_end])) if header.meta_length else {}
+    return header, meta, view[meta_end:]
+
+
+def iter_frames(message: Message, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[bytes]:
+    # 元数据只放在第一帧, 每帧的负载不超过 chunk_size
+    payload = memoryview(message.payload)
+    if chunk_size <= 0:
+        raise ValueError("chunk_size must be positive")
+    partial = FLAG_PARTIAL if message.partial else 0
+    offsets = range(0, len(payload), chunk_size) if len(payload) > 0 else [0]
+    for i, offset in enumerate(offsets):
+        last = offset + chunk_size >= len(payload)
+        yield encode_frame(
+            message.sender,
+            message.receiver,
+            message.request_id,
+            message.content_type,
+            payload[offset: offset + chunk_size],
+            message.meta if i == 0 else None,
+            partial | (0 if last else FLAG_MORE),
+        )
+
+
+class MessageAssembler:
+    # 按 (发送方, 请求id) 拼接分块帧, 不同请求的分块可以交错到达
+    def __init__(self) -> None:
+        self.pending: Dict[Tuple[str, int], Message] = {}
+
+    def feed(self, frame: bytes) -> Optional[Message]:
+        header, meta, payload = decode_frame(frame)
+        key = (header.sender, header.request_id)
+        if header.flags & FLAG_ABORT:
+            self.pending.pop(key, None)
+            return None
+        message = self.pending.get(key)
+        if message is None:
+            if not header.flags & FLAG_MORE:
+                return Message(header.sender, header.receiver, header.request_id,
+                               header.content_type, bytes(payload), meta, bool(header.flags & FLAG_PARTIAL))
+            message = Message(header.sender, header.receiver, header.request_id,
+                              header.content_type, bytearray(), meta)
+            self.pending[key] = message
+        message.payload.extend(payload)
+        if header.flags & FLAG_MORE:
+            return None
+
+        del self.pending[key]
+        message.payload = bytes(message.payload)
+        message.partial = bool(header.flags & FLAG_PARTIAL)
+        return message
+
+    def discard(self, sender: str) -> None:
+        for key in [key for key in self.pending if key[0] == sender]:
+            del self.pending[key]
+
+
+def legacy_message(data: str) -> Message:
+    # 兼容旧的JSON文本消息, 内容原样放在负载中
+    message = json.loads(data)
+    return Message(message['from'], message['to'], 0, ContentType.json, data.encode('utf-8'))
+
+
+async def send_message(websocket, message: Message, chunk_size: int = DEFAULT_CHUNK_SIZE) -> None:
+    for frame in iter_frames(message, chunk_size):
+        await websocket.send(frame)
+
+
+async def recv_message(websocket, assembler: MessageAssembler) -> Message:
+    while True:
+        data = await websocket.recv()
+        if isinstance(data, str):
+            return legacy_message(data)
+        message = assembler.feed(data)
+        if message is not None:
+            return message
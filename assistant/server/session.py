@@ -0,0 +1,243 @@
+import asyncio
+import weakref
+import websockets
+
+from typing import AsyncIterable, AsyncIterator, Dict, List, Optional
+
+from websockets.exceptions import ConnectionClosed
+
+import global_var
+
+from assistant.utils import socket_no_proxy
+from assistant.server.protocol import (ContentType, FLAG_MORE, Message, MessageAssembler, encode_frame,
+                                       next_request_id, send_message)
+
+
+class ServerException(Exception):
+    pass
+
+
+class ConnectionLost(Exception):
+    # 请求发出后连接断开, 可以在新的连接上重试
+    pass
+
+
+class PooledConnection:
+    # 连接池中的一条长连接, 后台任务读取回复并按请求id交给等待中的请求
+    def __init__(self, session: 'SwitcherSession') -> None:
+        self.session = session
+        self.websocket = None
+        self.reader: Optional[asyncio.Task] = None
+        self.pending: Dict[int, asyncio.Future] = {}
+        # 流式请求会收到多条回复, 按请求id放入各自的队列
+        self.streams: Dict[int, asyncio.Queue] = {}
+        self.lock = asyncio.Lock()
+
+    async def open(self):
+        if global_var.run_local_mode:
+            with socket_no_proxy():
+                return await websockets.connect(self.session.uri, max_size=global_var.ws_max_size,
+                                                compression=None)
+        return await websockets.connect(self.session.uri, max_size=global_var.ws_max_size,
+                                        compression=None)
+
+    async def connect(self):
+        async with self.lock:
+            if self.websocket is not None:
+                return self.websocket
+
+            # 连接失败时按指数退避重试
+            delay = self.session.backoff_base
+            for attempt in range(self.session.max_retries + 1):
+                try:
+                    websocket = await self.open()
+                    break
+                except OSError as e:
+                    if attempt == self.session.max_retries:
+                        raise
+                    global_var.logger.warning(f"连接服务器失败: {e}, {delay:.1f}秒后重试")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, self.session.backoff_max)
+
+            self.websocket = websocket
+            self.reader = asyncio.create_task(self.read(websocket))
+            return websocket
+
+    async def read(self, websocket) -> None:
+        assembler = MessageAssembler()
+        try:
+            async for data in websocket:
+                if isinstance(data, str):
+                    continue
+                message = assembler.feed(data)
+                if message is None:
+                    continue
+                replies = self.streams.get(message.request_id)
+                if replies is not None:
+                    if message.content_type == ContentType.error:
+                        global_var.logger.error(f'服务器后端出错：\n{message.text()}')
+                        replies.put_nowait(ServerException(message.text()))
+                    else:
+                        replies.put_nowait(message)
+                    continue
+                future = self.pending.pop(message.request_id, None)
+                if future is None or future.done():
+                    continue
+                if message.content_type == ContentType.error:
+                    global_var.logger.error(f'服务器后端出错：\n{message.text()}')
+                    future.set_exception(ServerException(message.text()))
+                else:
+                    future.set_result(message)
+        except ConnectionClosed:
+            pass
+        finally:
+            if self.websocket is websocket:
+                self.websocket = None
+            for request_id, future in list(self.pending.items()):
+                if not future.done():
+                    future.set_exception(ConnectionLost("与服务器的连接已断开"))
+                del self.pending[request_id]
+            for replies in self.streams.values():
+                replies.put_nowait(ConnectionLost("与服务器的连接已断开"))
+
+    async def request(self, message: Message, timeout: Optional[float] = None) -> Message:
+        websocket = await self.connect()
+        future = asyncio.get_running_loop().create_future()
+        self.pending[message.request_id] = future
+        try:
+            await send_message(websocket, message, global_var.ws_chunk_size)
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.pop(message.request_id, None)
+
+    async def stream(
+            self,
+            message: Message,
+            chunks: AsyncIterable[bytes],
+            timeout: Optional[float] = None
+    ) -> AsyncIterator[Message]:
+        # 边上传边接收回复: 上传的每块都带 FLAG_MORE, 最后发送一个空的结束帧, 元数据只放在第一帧
+        websocket = await self.connect()
+        replies: asyncio.Queue = asyncio.Queue()
+        self.streams[message.request_id] = replies
+
+        async def upload():
+            meta = message.meta
+            async for chunk in chunks:
+                chunk = memoryview(chunk)
+                for offset in range(0, len(chunk), global_var.ws_chunk_size):
+                    await websocket.send(encode_frame(message.sender, message.receiver, message.request_id,
+                                                      message.content_type,
+                                                      chunk[offset: offset + global_var.ws_chunk_size],
+                                                      meta, FLAG_MORE))
+                    meta = None
+            await websocket.send(encode_frame(message.sender, message.receiver, message.request_id,
+                                              message.content_type, b'', meta))
+
+        def upload_done(task: asyncio.Task) -> None:
+            if not task.cancelled() and task.exception() is not None:
+                replies.put_nowait(task.exception())
+
+        uploader = asyncio.create_task(upload())
+        uploader.add_done_callback(upload_done)
+        try:
+            while True:
+                reply = await asyncio.wait_for(replies.get(), timeout)
+                if isinstance(reply, Exception):
+                    raise reply
+                yield reply
+                if not reply.partial:
+                    break
+        finally:
+            uploader.cancel()
+            self.streams.pop(message.request_id, None)
+
+    async def close(self) -> None:
+        if self.websocket is not None:
+            await self.websocket.close()
+        if self.reader is not None:
+            await asyncio.gather(self.reader, return_exceptions=True)
+
+
+class SwitcherSession:
+    # 与服务器之间的长连接池, 多个请求可以在同一连接上流水线发送, 回复按请求id匹配
+    def __init__(
+            self,
+            uri: Optional[str] = None,
+            pool_size: int = 2,
+            max_retries: int = 3,
+            backoff_base: float = 0.5,
+            backoff_max: float = 8.0,
+            timeout: Optional[float] = None
+    ) -> None:
+        if pool_size < 1:
+            raise ValueError("pool_size must be at least 1")
+        self.uri = uri or f'ws://{global_var.ip}:{global_var.port}/'
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.connections: List[PooledConnection] = [PooledConnection(self) for _ in range(pool_size)]
+
+    def least_loaded(self) -> PooledConnection:
+        # 选择未完成请求最少的连接
+        return min(self.connections, key=lambda connection: len(connection.pending) + len(connection.streams))
+
+    async def request(
+            self,
+            service: str,
+            content_type: ContentType,
+            payload: bytes = b'',
+            meta: Optional[Dict] = None
+    ) -> Message:
+        delay = self.backoff_base
+        for attempt in range(self.max_retries + 1):
+            connection = self.least_loaded()
+            message = Message(f'CLIENT.{service}', service, next_request_id(), content_type, payload, meta or {})
+            try:
+                return await connection.request(message, self.timeout)
+            except (ConnectionClosed, ConnectionLost) as e:
+                if attempt == self.max_retries:
+                    raise
+                global_var.logger.warning(f"请求{service}时连接断开: {e}, {delay:.1f}秒后重连")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.backoff_max)
+
+    async def request_many(
+            self,
+            service: str,
+            content_type: ContentType,
+            payloads: List[bytes],
+            meta: Optional[Dict] = None
+    ) -> List[Message]:
+        # 先把所有请求发出去, 再按请求id收集回复, 结果与输入顺序一致
+        return await asyncio.gather(*[
+            self.request(service, content_type, payload, meta) for payload in payloads
+        ])
+
+    async def stream(
+            self,
+            service: str,
+            content_type: ContentType,
+            chunks: AsyncIterable[bytes],
+            meta: Optional[Dict] = None
+    ) -> AsyncIterator[Message]:
+        # 流式请求: 边上传边返回中间结果, 最后一条回复的 partial 为False
+        # 上传的数据已经被消费, 连接断开时不重试
+        message = Message(f'CLIENT.{service}', service, next_request_id(), content_type, b'', meta or {})
+        async for reply in self.least_loaded().stream(message, chunks, self.timeout):
+            yield reply
+
+    async def close(self) -> None:
+        await asyncio.gather(*[connection.close() for connection in self.connections])
+
+
+_sessions: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, SwitcherSession]" = weakref.WeakKeyDictionary()
+
+
+def get_session() -> SwitcherSession:
+    # 连接绑定在事件循环上, 每个事件循环共用一个会话
+    loop = asyncio.get_running_loop()
+    if loop not in _sessions:
+        _sessions[loop] = SwitcherSession()
+    return _sessions[loop]
@@ -1,46 +1,332 @@
 import json
+import time
 import asyncio
 import websockets
 
-from websockets.exceptions import ConnectionClosedError
+from typing import Dict, List, Optional
+
+from websockets.exceptions import ConnectionClosed, ConnectionClosedError
 
 import global_var
 
-connections = {}
-
-
-async def handler(websocket):
-    message_json = {}
-    try:
-        async for message in websocket:
-            global_var.logger.info(message[:200])
-
-            message_json = json.loads(message)
-            connections[message_json['from']] = websocket
-            if message_json['to'] == 'SERVER' and message_json['content'] == 'hello':
-                connection_resp = {
-                    'from': 'SERVER',
-                    'to': message_json['from'],
-                    'content': 'ok'
-                }
-                connection_resp = json.dumps(connection_resp)
-                await connections[message_json['from']].send(connection_resp)
+from assistant.server.protocol import (ContentType, FrameHeader, FLAG_ABORT, FLAG_MORE, FLAG_PARTIAL,
+                                       decode_frame, decode_header, encode_frame)
+
+
+class Request:
+    # 一个正在排队或处理中的二进制请求, 回复按请求id送回发起请求的连接
+    def __init__(self, request_id: int, sender: str, service: str, client, first_frame: bytes) -> None:
+        self.request_id = request_id
+        self.sender = sender
+        self.service = service
+        self.client = client
+        # 排队期间到达的分块暂存在这里, 发给worker时按顺序发送
+        self.frames: List[bytes] = [first_frame]
+        self.buffered = len(first_frame)
+        self.worker: Optional['WorkerConnection'] = None
+        self.ready = asyncio.Event()
+        self.rejected = False
+        self.created_at = time.monotonic()
+
+
+class WorkerConnection:
+    # 同一服务可以有多个worker实例, 每个实例有自己的有界请求队列和并发上限
+    def __init__(self, name: str, websocket, max_in_flight: int = 1, max_queue: int = 32) -> None:
+        self.name = name
+        self.websocket = websocket
+        self.max_in_flight = max(1, max_in_flight)
+        self.queue: asyncio.Queue = asyncio.Queue(max_queue)
+        self.in_flight: Dict[int, Request] = {}
+        self.credits = asyncio.Semaphore(self.max_in_flight)
+        self.completed = 0
+        self.latency = 0.0
+        self.max_queue_depth = 0
+        # 已经出队但还在等待并发额度的请求
+        self.waiting: Optional[Request] = None
+        self.task = asyncio.create_task(self.dispatch())
+
+    @property
+    def load(self) -> float:
+        return (self.queue.qsize() + (self.waiting is not None) + len(self.in_flight)) / self.max_in_flight
+
+    async def enqueue(self, request: Request, timeout: float) -> None:
+        request.worker = self
+        await asyncio.wait_for(self.queue.put(request), timeout)
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+
+    async def dispatch(self) -> None:
+        while True:
+            request = self.waiting = await self.queue.get()
+            await self.credits.acquire()
+            self.waiting = None
+            if request.rejected:
+                self.credits.release()
+                continue
+            self.in_flight[request.request_id] = request
+            try:
+                # 客户端在上传期间断开时不再发送剩余的分块
+                while request.frames and not request.rejected:
+                    await self.websocket.send(request.frames.pop(0))
+            except ConnectionClosed:
+                # 连接断开由handler移除该worker并处理未完成的请求
+                return
+            request.buffered = 0
+            request.ready.set()
+
+    def complete(self, request_id: int) -> None:
+        request = self.in_flight.pop(request_id, None)
+        if request is None:
+            return
+        self.credits.release()
+        self.completed += 1
+        self.latency += time.monotonic() - request.created_at
+
+    def stats(self) -> Dict:
+        return {
+            'queued': self.queue.qsize() + (self.waiting is not None),
+            'in_flight': len(self.in_flight),
+            'max_in_flight': self.max_in_flight,
+            'max_queue_depth': self.max_queue_depth,
+            'completed': self.completed,
+            'mean_latency': self.latency / self.completed if self.completed else 0.0,
+        }
+
+
+class Switcher:
+    def __init__(
+            self,
+            max_queue: int = 32,
+            queue_timeout: float = 30.0,
+            max_buffered: int = 10 * 1024 * 1024
+    ) -> None:
+        # 按名字记录最近的连接, 用于旧的JSON消息和没有注册为服务的接收方
+        self.connections = {}
+        self.workers: Dict[str, List[WorkerConnection]] = {}
+        self.requests: Dict[int, Request] = {}
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        # 每个排队中的请求最多暂存的字节数, 超过后暂停读取该客户端的消息, 形成背压
+        self.max_buffered = max_buffered
+        self.rejected = 0
+
+    def register_worker(self, name: str, websocket, max_in_flight: int = 1) -> WorkerConnection:
+        worker = WorkerConnection(name, websocket, max_in_flight, self.max_queue)
+        self.workers.setdefault(name, []).append(worker)
+        global_var.logger.info(f"{name}实例已注册, 当前共{len(self.workers[name])}个实例")
+        return worker
+
+    def least_loaded(self, service: str) -> Optional[WorkerConnection]:
+        workers = self.workers.get(service)
+        if not workers:
+            return None
+        return min(workers, key=lambda worker: (worker.load, len(worker.in_flight)))
+
+    async def remove_worker(self, worker: WorkerConnection) -> None:
+        workers = self.workers.get(worker.name, [])
+        if worker in workers:
+            workers.remove(worker)
+        if not workers:
+            self.workers.pop(worker.name, None)
+        worker.task.cancel()
+
+        # 还在排队的请求转给同一服务的其他实例, 正在处理的请求回复错误
+        queued = [worker.waiting] if worker.waiting is not None else []
+        while not worker.queue.empty():
+            queued.append(worker.queue.get_nowait())
+        for request in list(worker.in_flight.values()):
+            await self.fail(request, f"服务器后端{worker.name}出错")
+        for request in queued:
+            if request.rejected:
+                continue
+            replacement = self.least_loaded(worker.name)
+            if replacement is None or replacement.queue.full():
+                await self.fail(request, f"服务器后端{worker.name}出错")
             else:
-                assert connections[message_json['to']] is not None
-                await connections[message_json['to']].send(message)
-    except ConnectionClosedError as e:
-        if message_json != {}:
-            global_var.logger.error(f"服务器与{message_json.get('to')}连接断开:\n{str(e)}")
-            connection_close_error_resp = {
-                'from': 'SERVER',
-                'to': message_json['from'],
-                'status': 404,
-                'content': f"服务器后端{message_json.get('to')}出错"
-            }
-            connection_close_error_resp = json.dumps(connection_close_error_resp)
-            await connections[message_json['from']].send(connection_close_error_resp)
+                await replacement.enqueue(request, self.queue_timeout)
+
+    async def send_error(self, websocket, receiver: str, request_id: int, content: str, status: int = 404) -> None:
+        error = encode_frame('SERVER', receiver, request_id, ContentType.error,
+                             json.dumps({'status': status, 'content': content}, ensure_ascii=False).encode('utf-8'))
+        try:
+            await websocket.send(error)
+        except ConnectionClosed:
+            pass
+
+    async def fail(self, request: Request, content: str, status: int = 404) -> None:
+        request.rejected = True
+        self.requests.pop(request.request_id, None)
+        request.ready.set()
+        await self.send_error(request.client, request.service, request.request_id, content, status)
+
+    async def abandon(self, websocket) -> None:
+        # 客户端断开: 排队中的请求标记为拒绝, 已经发给worker的请求通知worker丢弃并释放并发额度
+        for request in [request for request in self.requests.values() if request.client is websocket]:
+            del self.requests[request.request_id]
+            request.rejected = True
+            request.ready.set()
+            worker = request.worker
+            if worker is None or request.request_id not in worker.in_flight:
+                continue
+            abort = encode_frame(request.sender, request.service, request.request_id, ContentType.bytes,
+                                 flags=FLAG_ABORT)
+            try:
+                await worker.websocket.send(abort)
+            except ConnectionClosed:
+                pass
+            worker.complete(request.request_id)
+
+    async def control(self, websocket, header: FrameHeader, frame: bytes) -> Optional[WorkerConnection]:
+        _, meta, payload = decode_frame(frame)
+        command = bytes(payload)
+        worker = None
+        if command == b'hello':
+            # worker在hello的元数据中声明可以同时处理的请求数
+            worker = self.register_worker(header.sender, websocket, meta.get('max_in_flight', 1))
+            content_type, response = ContentType.text, b'ok'
+        elif command == b'stats':
+            content_type, response = ContentType.json, json.dumps(self.stats()).encode('utf-8')
         else:
-            global_var.logger.error(f"服务器与客户端连接断开:\n{str(e)}")
+            content_type, response = ContentType.error, f"unknown command {command[:32]!r}".encode('utf-8')
+        await websocket.send(encode_frame('SERVER', header.sender, header.request_id, content_type, response))
+        return worker
+
+    async def forward(self, websocket, header: FrameHeader, frame: bytes) -> None:
+        request = self.requests.get(header.request_id)
+        if request is None:
+            if header.receiver not in self.workers:
+                if header.receiver not in self.connections:
+                    await self.send_error(websocket, header.receiver, header.request_id,
+                                          f"服务器后端{header.receiver}未连接")
+                else:
+                    await self.connections[header.receiver].send(frame)
+                return
+
+            request = Request(header.request_id, header.sender, header.receiver, websocket, frame)
+            self.requests[header.request_id] = request
+            try:
+                await self.least_loaded(header.receiver).enqueue(request, self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                await self.fail(request, f"服务器后端{header.receiver}繁忙", status=503)
+                if header.flags & FLAG_MORE:
+                    # 记录被拒绝的请求, 丢弃它剩余的分块
+                    self.requests[header.request_id] = request
+            return
+
+        if request.client is not websocket:
+            await self.send_error(websocket, header.receiver, header.request_id, "请求id冲突", status=409)
+            return
+        if request.rejected:
+            if not header.flags & FLAG_MORE:
+                del self.requests[header.request_id]
+            return
+        if not request.ready.is_set() and request.buffered + len(frame) <= self.max_buffered:
+            request.frames.append(frame)
+            request.buffered += len(frame)
+            return
+        await request.ready.wait()
+        if request.rejected:
+            return
+        try:
+            await request.worker.websocket.send(frame)
+        except ConnectionClosed:
+            await self.fail(request, f"服务器后端{request.service}出错")
+
+    async def reply(self, worker: WorkerConnection, header: FrameHeader, frame: bytes) -> None:
+        request = self.requests.get(header.request_id)
+        if request is None or request.worker is not worker:
+            # 请求已完成或已被放弃(客户端断开), 不能再按名字转发, 否则会发给同名的新连接
+            global_var.logger.warning(
+                f"{header.sender}的回复#{header.request_id}没有对应的请求, 丢弃"
+            )
+            return
+
+        try:
+            await request.client.send(frame)
+        except ConnectionClosed:
+            global_var.logger.error(f"请求{header.request_id}的客户端已断开, 丢弃回复")
+        # 中间结果之后还有回复, 只有最后一条回复的最后一帧才算请求完成
+        if not header.flags & (FLAG_MORE | FLAG_PARTIAL):
+            del self.requests[header.request_id]
+            worker.complete(header.request_id)
+
+    async def handler(self, websocket):
+        # 最近一条消息的路由信息, 连接断开时用于记录日志
+        route = {}
+        worker = None
+        try:
+            async for message in websocket:
+                if isinstance(message, bytes):
+                    # 二进制帧只解析固定长度的帧头, 元数据和负载原样转发
+                    header = decode_header(message)
+                    global_var.logger.info(
+                        f"{header.sender} -> {header.receiver} #{header.request_id} {header.length} bytes"
+                    )
+                    route = {'from': header.sender, 'to': header.receiver}
+                    self.connections[header.sender] = websocket
+                    if header.receiver == 'SERVER':
+                        worker = await self.control(websocket, header, message) or worker
+                    elif worker is not None:
+                        await self.reply(worker, header, message)
+                    else:
+                        await self.forward(websocket, header, message)
+                    continue
+
+                global_var.logger.info(message[:200])
+
+                message_json = json.loads(message)
+                route = {'from': message_json['from'], 'to': message_json['to']}
+                self.connections[message_json['from']] = websocket
+                if message_json['to'] == 'SERVER' and message_json['content'] == 'hello':
+                    worker = self.register_worker(message_json['from'], websocket)
+                    connection_resp = {
+                        'from': 'SERVER',
+                        'to': message_json['from'],
+                        'content': 'ok'
+                    }
+                    connection_resp = json.dumps(connection_resp)
+                    await websocket.send(connection_resp)
+                else:
+                    assert self.connections[message_json['to']] is not None
+                    await self.connections[message_json['to']].send(message)
+        except ConnectionClosedError as e:
+            if route != {}:
+                global_var.logger.error(f"服务器与{route['from']}连接断开:\n{str(e)}")
+            else:
+                global_var.logger.error(f"服务器与客户端连接断开:\n{str(e)}")
+        finally:
+            if worker is not None:
+                await self.remove_worker(worker)
+            else:
+                await self.abandon(websocket)
+            for name in [name for name, connection in self.connections.items() if connection is websocket]:
+                del self.connections[name]
+
+    def stats(self) -> Dict:
+        services = {}
+        for name, workers in self.workers.items():
+            worker_stats = [worker.stats() for worker in workers]
+            services[name] = {
+                'instances': len(workers),
+                'queued': sum(stats['queued'] for stats in worker_stats),
+                'in_flight': sum(stats['in_flight'] for stats in worker_stats),
+                'workers': worker_stats,
+            }
+        return {
+            'pending_requests': len(self.requests),
+            'rejected': self.rejected,
+            'services': services,
+        }
+
+    async def log_stats(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            global_var.logger.info(f"Server队列状态: {json.dumps(self.stats())}")
+
+
+switcher = Switcher(global_var.switcher_max_queue, global_var.switcher_queue_timeout, global_var.ws_max_size)
+connections = switcher.connections
+handler = switcher.handler
 
 
 async def switcher_server():
@@ -48,7 +334,11 @@ async def switcher_server():
     async with websockets.serve(handler,
                                 global_var.ip,
                                 global_var.port,
-                                max_size=10 * 1024 * 1024,
+                                max_size=global_var.ws_max_size,
+                                # 媒体负载本身已经压缩, 关闭permessage-deflate避免逐帧压缩的开销
+                                compression=None,
                                 ping_timeout=60 * 3):
         global_var.logger.info('Server启动')
+        if global_var.switcher_stats_interval:
+            asyncio.create_task(switcher.log_stats(global_var.switcher_stats_interval))
         await asyncio.Future()
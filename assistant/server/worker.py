@@ -0,0 +1,238 @@
+import json
+import time
+import asyncio
+import websockets
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+from websockets.exceptions import ConnectionClosed
+
+import global_var
+
+from assistant.utils import socket_no_proxy
+from assistant.server.protocol import (ContentType, FLAG_ABORT, FLAG_MORE, FrameHeader, Message, MessageAssembler,
+                                       decode_frame, encode_frame, legacy_message, recv_message, send_message)
+
+# 进程执行器中加载的模型, 每个子进程一个
+_process_model = None
+
+
+def _load_model(factory: Callable[[], Any]) -> None:
+    global _process_model
+    _process_model = factory()
+
+
+def _call_model(method: str, *args) -> Any:
+    return getattr(_process_model, method)(*args)
+
+
+class BatchingWorker:
+    # 推理服务的worker运行时: 读取请求的协程只负责收发消息, 请求攒成小批次后在执行器中做一次批量推理,
+    # 推理期间事件循环不被阻塞, 可以继续接收请求和响应心跳
+    def __init__(
+            self,
+            name: str,
+            model: Any,
+            method: str,
+            decode: Callable[[Message], Any],
+            encode: Callable[[Message, Any], Message],
+            max_batch_size: int = 1,
+            max_wait_ms: float = 0,
+            executor: str = 'thread',
+            stream_method: Optional[str] = None,
+            stream_cancel_method: Optional[str] = None,
+            stream_timeout: float = 120
+    ) -> None:
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        if max_wait_ms < 0:
+            raise ValueError("max_wait_ms must not be negative")
+        if executor not in ('thread', 'process'):
+            raise ValueError(f"Unknown executor {executor}, expected 'thread' or 'process'")
+        self.name = name
+        # executor为'process'时model是在子进程中创建模型的工厂函数, 否则是已经加载的模型
+        self.model = model
+        self.method = method
+        self.decode = decode
+        self.encode = encode
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.executor_kind = executor
+        self.executor: Optional[Executor] = None
+        self.queue: asyncio.Queue = asyncio.Queue()
+        # 流式请求: 第一帧元数据带 stream 的请求不等上传结束, 每收到一块就调用一次 stream_method
+        self.stream_method = stream_method
+        # 流被取消或者超过 stream_timeout 秒没有新的分块时, 调用 stream_cancel_method 丢弃模型中该流的状态
+        self.stream_cancel_method = stream_cancel_method
+        self.stream_timeout = stream_timeout
+        self.streams: Dict[Tuple[str, int], asyncio.Queue] = {}
+        self.stream_tasks = set()
+        self.batches = 0
+        self.processed = 0
+
+    def start_executor(self) -> Executor:
+        # 模型只有一份, 批次串行执行, 一个线程或进程就够了
+        if self.executor_kind == 'process':
+            return ProcessPoolExecutor(max_workers=1, initializer=_load_model, initargs=(self.model,))
+        return ThreadPoolExecutor(max_workers=1, thread_name_prefix=self.name)
+
+    async def call(self, method: str, *args) -> Any:
+        loop = asyncio.get_running_loop()
+        if self.executor_kind == 'process':
+            return await loop.run_in_executor(self.executor, _call_model, method, *args)
+        return await loop.run_in_executor(self.executor, getattr(self.model, method), *args)
+
+    async def next_batch(self) -> List[Message]:
+        # 等到第一个请求后开始计时, 批次满或者等待超过 max_wait 就立即推理
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def send_error(self, websocket, request: Message, content: str) -> None:
+        error = encode_frame(self.name, request.sender, request.request_id, ContentType.error,
+                             json.dumps({'status': 500, 'content': content}, ensure_ascii=False).encode('utf-8'))
+        await websocket.send(error)
+
+    async def run_batch(self, websocket, batch: List[Message]) -> None:
+        try:
+            outputs = await self.call(self.method, [self.decode(request) for request in batch])
+        except Exception as e:
+            if len(batch) > 1:
+                # 批内某个请求的输入有问题时逐个重试, 只有出错的请求回复错误
+                for request in batch:
+                    await self.run_batch(websocket, [request])
+                return
+            global_var.logger.exception(f"{self.name}推理出错")
+            await self.send_error(websocket, batch[0], f"{self.name}推理出错: {e}")
+            return
+
+        self.batches += 1
+        self.processed += len(batch)
+        global_var.logger.info(f"{self.name}完成批次: {len(batch)}个请求, "
+                               f"平均批大小{self.processed / self.batches:.2f}")
+        # 结果按输入顺序分发回各自的请求
+        for request, output in zip(batch, outputs):
+            await send_message(websocket, self.encode(request, output), global_var.ws_chunk_size)
+
+    async def process(self, websocket) -> None:
+        while True:
+            await self.run_batch(websocket, await self.next_batch())
+
+    async def run_stream(self, websocket, request: Message, chunks: asyncio.Queue) -> None:
+        stream_id = f'{request.sender}:{request.request_id}'
+        failed = False
+        final = False
+        while not final:
+            try:
+                parts = [await asyncio.wait_for(chunks.get(), self.stream_timeout)]
+            except asyncio.TimeoutError:
+                # 上传中断, 回复错误让服务器结束该请求
+                global_var.logger.error(f"{self.name}流式请求#{request.request_id}等待分块超时")
+                await self.send_error(websocket, request, f"{self.name}等待音频超时")
+                break
+            # 推理跟不上上传速度时, 把已经到达的块合并后一起处理
+            while not chunks.empty():
+                parts.append(chunks.get_nowait())
+            if None in parts:
+                # 服务器通知客户端已断开
+                global_var.logger.info(f"{self.name}流式请求#{request.request_id}已取消")
+                break
+            final = any(last for _, last in parts)
+            if failed:
+                continue
+            audio = b''.join(payload for payload, _ in parts)
+            try:
+                output = await self.call(self.stream_method, stream_id, audio, final, request.meta)
+            except Exception as e:
+                global_var.logger.exception(f"{self.name}流式推理出错")
+                await self.send_error(websocket, request, f"{self.name}推理出错: {e}")
+                # 出错后丢弃该请求剩余的块
+                failed = True
+                continue
+            if output is not None:
+                response = self.encode(request, output)
+                response.partial = not final
+                await send_message(websocket, response, global_var.ws_chunk_size)
+        del self.streams[(request.sender, request.request_id)]
+        if (failed or not final) and self.stream_cancel_method is not None:
+            await self.call(self.stream_cancel_method, stream_id)
+
+    def feed_stream(self, websocket, header: FrameHeader, meta: Dict, payload: memoryview) -> None:
+        key = (header.sender, header.request_id)
+        chunks = self.streams.get(key)
+        if header.flags & FLAG_ABORT:
+            if chunks is not None:
+                chunks.put_nowait(None)
+            return
+        if chunks is None:
+            global_var.logger.info(f"{header.sender} -> {header.receiver} #{header.request_id} 流式请求开始")
+            chunks = self.streams[key] = asyncio.Queue()
+            request = Message(header.sender, header.receiver, header.request_id, header.content_type, b'', meta)
+            task = asyncio.create_task(self.run_stream(websocket, request, chunks))
+            self.stream_tasks.add(task)
+            task.add_done_callback(self.stream_tasks.discard)
+        chunks.put_nowait((bytes(payload), not header.flags & FLAG_MORE))
+
+    async def read(self, websocket, assembler: MessageAssembler) -> None:
+        while True:
+            data = await websocket.recv()
+            if isinstance(data, str):
+                request = legacy_message(data)
+            else:
+                if self.stream_method is not None:
+                    header, meta, payload = decode_frame(data)
+                    if (header.sender, header.request_id) in self.streams or meta.get('stream'):
+                        self.feed_stream(websocket, header, meta, payload)
+                        continue
+                request = assembler.feed(data)
+                if request is None:
+                    continue
+            global_var.logger.info(request.describe())
+            await self.queue.put(request)
+
+    async def serve(self) -> None:
+        async with websockets.connect(f'ws://{global_var.ip}:{global_var.port}/',
+                                      max_size=global_var.ws_max_size,
+                                      compression=None) as websocket:
+            # 声明可以同时处理的请求数, 让服务器在当前批次推理期间继续下发下一批请求
+            await websocket.send(encode_frame(self.name, 'SERVER', 0, ContentType.text, b'hello',
+                                              {'max_in_flight': self.max_batch_size * 2}))
+            assembler = MessageAssembler()
+            response = await recv_message(websocket, assembler)
+            global_var.logger.info(f"{self.name}启动: {response.text()}")
+
+            reader = asyncio.create_task(self.read(websocket, assembler))
+            processor = asyncio.create_task(self.process(websocket))
+            try:
+                await asyncio.gather(reader, processor)
+            except ConnectionClosed as e:
+                global_var.logger.error(f"{self.name}与服务器连接断开:\n{str(e)}")
+            finally:
+                reader.cancel()
+                processor.cancel()
+                for task in list(self.stream_tasks):
+                    task.cancel()
+                self.streams.clear()
+
+    async def run(self) -> None:
+        self.executor = self.start_executor()
+        try:
+            if global_var.run_local_mode:
+                with socket_no_proxy():
+                    await self.serve()
+            else:
+                await self.serve()
+        finally:
+            self.executor.shutdown(wait=False)
@@ -2,7 +2,6 @@ import json
 import torch
 import websockets
 import os.path
-import base64
 
 from io import BytesIO
 from PIL import Image
@@ -13,6 +12,7 @@ from diffusers import EulerAncestralDiscreteScheduler
 import global_var
 
 from assistant.utils import socket_no_proxy
+from assistant.server.protocol import ContentType, Message, MessageAssembler, recv_message, send_message
 
 IS_INITIALIZED = False
 
@@ -65,8 +65,10 @@ async def iti_client(iti):
     async def send_and_recv():
         global IS_INITIALIZED
         async with websockets.connect(f'ws://{global_var.ip}:{global_var.port}/',
-                                      max_size=10 * 1024 * 1024) as websocket:
+                                      max_size=global_var.ws_max_size,
+                                      compression=None) as websocket:
             global_var.logger.info("ITI启动")
+            assembler = MessageAssembler()
             while True:
                 if not IS_INITIALIZED:
                     message = {
@@ -86,23 +88,16 @@ async def iti_client(iti):
                     if response['content'] == 'ok':
                         IS_INITIALIZED = True
                 else:
-                    recv = await websocket.recv()
-                    global_var.logger.info(recv)
+                    request = await recv_message(websocket, assembler)
+                    global_var.logger.info(request.describe())
 
-                    recv = json.loads(recv)
+                    image = iti.image2image(request.payload, request.meta['prompt'])
 
-                    image_bytes_base64_decoded = base64.b64decode(recv['content']['image'].encode())
-                    image = iti.image2image(image_bytes_base64_decoded, recv['content']['prompt'])
-
-                    image = base64.b64encode(image).decode()
-                    message = {
-                        'from': 'ITI',
-                        'to': 'CLIENT.ITI',
-                        'content': image
-                    }
-
-                    message = json.dumps(message)
-                    await websocket.send(message)
+                    buffer = BytesIO()
+                    image.save(buffer, format='PNG')
+                    response = Message('ITI', request.sender, request.request_id,
+                                       ContentType.image, buffer.getvalue(), {'format': 'png'})
+                    await send_message(websocket, response, global_var.ws_chunk_size)
 
     if global_var.run_local_mode:
         with socket_no_proxy():
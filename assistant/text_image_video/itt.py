@@ -1,27 +1,25 @@
 import json
 import torch
 import os.path
-import base64
-import websockets
 
 from io import BytesIO
 from PIL import Image
+from typing import List
 from fastsam import FastSAM, FastSAMPrompt
 from lavis.models import load_model_and_preprocess
 
 import global_var
 
-from assistant.utils import socket_no_proxy
-
-IS_INITIALIZED = False
+from assistant.server.worker import BatchingWorker
+from assistant.server.protocol import ContentType, Message
 
 
 class ITT:
-    def __init__(self):
+    def __init__(self, model_type: str = 'large_coco'):
         self.device = global_var.device if torch.cuda.is_available() else 'cpu'
 
         self.captioning_model, self.vis_processor, _ = load_model_and_preprocess(
-            name='blip_caption', model_type='large_coco', is_eval=True, device=self.device
+            name='blip_caption', model_type=model_type, is_eval=True, device=self.device
         )
 
         sam_checkpoint = os.path.join(global_var.project_dir, 'model_weight/FastSAM-x.pt')
@@ -40,6 +38,13 @@ class ITT:
         caption = self.captioning_model.generate({'image': image})
         return caption
 
+    def captioning_images(self, images: List[bytes]) -> List[list[str]]:
+        # 一个批次的图片堆叠成一个张量, 只调用一次generate, 每张图片对应一个标题
+        raw_images = [Image.open(BytesIO(image)).convert('RGB') for image in images]
+        image = torch.stack([self.vis_processor['eval'](raw_image) for raw_image in raw_images]).to(self.device)
+        captions = self.captioning_model.generate({'image': image})
+        return [[caption] for caption in captions]
+
     def segment_anything_all(self, image_name: str):
         image_path = os.path.join(global_var.project_dir, 'text_image_video/new_images', image_name)
         everything_results = self.sam_model(image_path, device=self.device, retina_masks=True,
@@ -49,52 +54,14 @@ class ITT:
         pass
 
 
-async def itt_client(itt):
-    global IS_INITIALIZED
-
-    async def send_and_recv():
-        global IS_INITIALIZED
-        async with websockets.connect(f'ws://{global_var.ip}:{global_var.port}/',
-                                      max_size=10 * 1024 * 1024) as websocket:
-            global_var.logger.info("ITT启动")
-            while True:
-                if not IS_INITIALIZED:
-                    message = {
-                        'from': 'ITT',
-                        'to': 'SERVER',
-                        'content': 'hello'
-                    }
-
-                    message = json.dumps(message)
-                    await websocket.send(message)
-
-                    response = await websocket.recv()
-                    global_var.logger.info(response)
-
-                    response = json.loads(response)
-
-                    if response['content'] == 'ok':
-                        IS_INITIALIZED = True
-                else:
-                    recv = await websocket.recv()
-                    global_var.logger.info(recv)
-
-                    recv = json.loads(recv)
-
-                    image_bytes_base64_decoded = base64.b64decode(recv['content'].encode())
-                    text_list = itt.captioning_image(image_bytes_base64_decoded)
-
-                    message = {
-                        'from': 'ITT',
-                        'to': 'CLIENT.ITT',
-                        'content': text_list
-                    }
-
-                    message = json.dumps(message)
-                    await websocket.send(message)
-
-    if global_var.run_local_mode:
-        with socket_no_proxy():
-            await send_and_recv()
-    else:
-        await send_and_recv()
+async def itt_client(itt, max_batch_size: int = 1, max_wait_ms: float = 0, executor: str = 'thread'):
+    worker = BatchingWorker(
+        'ITT', itt, 'captioning_images',
+        decode=lambda request: request.payload,
+        encode=lambda request, text_list: Message('ITT', request.sender, request.request_id,
+                                                  ContentType.json, json.dumps(text_list).encode('utf-8')),
+        max_batch_size=max_batch_size,
+        max_wait_ms=max_wait_ms,
+        executor=executor,
+    )
+    await worker.run()
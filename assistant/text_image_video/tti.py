@@ -1,13 +1,14 @@
 import json
 import torch
-import base64
 import websockets
 
+from io import BytesIO
 from diffusers import DiffusionPipeline
 
 import global_var
 
 from assistant.utils import socket_no_proxy
+from assistant.server.protocol import ContentType, Message, MessageAssembler, recv_message, send_message
 
 IS_INITIALIZED = False
 
@@ -56,8 +57,10 @@ async def tti_client(tti):
     async def send_and_recv():
         global IS_INITIALIZED
         async with websockets.connect(f'ws://{global_var.ip}:{global_var.port}/',
-                                      max_size=10 * 1024 * 1024) as websocket:
+                                      max_size=global_var.ws_max_size,
+                                      compression=None) as websocket:
             global_var.logger.info("TTI启动")
+            assembler = MessageAssembler()
             while True:
                 if not IS_INITIALIZED:
                     message = {
@@ -77,22 +80,16 @@ async def tti_client(tti):
                     if response['content'] == 'ok':
                         IS_INITIALIZED = True
                 else:
-                    recv = await websocket.recv()
-                    global_var.logger.info(recv)
+                    request = await recv_message(websocket, assembler)
+                    global_var.logger.info(request.describe())
 
-                    recv = json.loads(recv)
+                    image = tti.text2image(request.text())
 
-                    image = tti.text2image(recv['content'])
-                    image = base64.b64encode(image).decode()
-
-                    message = {
-                        'from': 'TTI',
-                        'to': 'CLIENT.TTI',
-                        'content': image
-                    }
-
-                    message = json.dumps(message)
-                    await websocket.send(message)
+                    buffer = BytesIO()
+                    image.save(buffer, format='PNG')
+                    response = Message('TTI', request.sender, request.request_id,
+                                       ContentType.image, buffer.getvalue(), {'format': 'png'})
+                    await send_message(websocket, response, global_var.ws_chunk_size)
 
     if global_var.run_local_mode:
         with socket_no_proxy():
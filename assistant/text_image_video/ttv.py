@@ -1,13 +1,16 @@
+import os
 import torch
 import json
-import base64
+import tempfile
 import websockets
 
 from diffusers import DiffusionPipeline, DPMSolverMultistepScheduler
+from diffusers.utils import export_to_video
 
 import global_var
 
 from assistant.utils import socket_no_proxy
+from assistant.server.protocol import ContentType, Message, MessageAssembler, recv_message, send_message
 
 IS_INITIALIZED = False
 
@@ -35,6 +38,17 @@ class TTV:
         )
         return video_frames
 
+    def text2video_bytes(self, prompt: str) -> bytes:
+        # 把生成的帧编码为mp4, 以文件字节的形式返回
+        video_frames = self.text2video(prompt).frames
+        if getattr(video_frames, 'ndim', 0) == 5 or isinstance(video_frames[0], list):
+            # 新版本的diffusers按批次返回帧
+            video_frames = video_frames[0]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = export_to_video(video_frames, os.path.join(tmp_dir, 'video.mp4'))
+            with open(path, 'rb') as f:
+                return f.read()
+
 
 async def ttv_client(ttv):
     global IS_INITIALIZED
@@ -42,8 +56,10 @@ async def ttv_client(ttv):
     async def send_and_recv():
         global IS_INITIALIZED
         async with websockets.connect(f'ws://{global_var.ip}:{global_var.port}/',
-                                      max_size=10 * 1024 * 1024) as websocket:
+                                      max_size=global_var.ws_max_size,
+                                      compression=None) as websocket:
             global_var.logger.info("TTV启动")
+            assembler = MessageAssembler()
             while True:
                 if not IS_INITIALIZED:
                     message = {
@@ -63,22 +79,15 @@ async def ttv_client(ttv):
                     if response['content'] == 'ok':
                         IS_INITIALIZED = True
                 else:
-                    recv = await websocket.recv()
-                    global_var.logger.info(recv)
-
-                    recv = json.loads(recv)
+                    request = await recv_message(websocket, assembler)
+                    global_var.logger.info(request.describe())
 
-                    video_frame = ttv.text2video(recv['content'])
-                    video_frame = base64.b64encode(video_frame).decode()
-
-                    message = {
-                        'from': 'TTV',
-                        'to': 'CLIENT.TTV',
-                        'content': video_frame
-                    }
+                    # 视频通常超过单帧上限, 按 ws_chunk_size 分块发送
+                    video = ttv.text2video_bytes(request.text())
 
-                    message = json.dumps(message)
-                    await websocket.send(message)
+                    response = Message('TTV', request.sender, request.request_id,
+                                       ContentType.video, video, {'format': 'mp4'})
+                    await send_message(websocket, response, global_var.ws_chunk_size)
 
     if global_var.run_local_mode:
         with socket_no_proxy():
@@ -1,30 +1,116 @@
 import os
-import json
+import time
 import torch
-import base64
-import websockets
+import numpy as np
 
 from io import BytesIO
-from faster_whisper import WhisperModel
+from typing import Dict, List, Optional, Tuple
+from faster_whisper import WhisperModel, decode_audio
+from faster_whisper.audio import pad_or_trim
+from faster_whisper.tokenizer import Tokenizer
+from faster_whisper.vad import VadOptions, get_speech_timestamps
 
 import global_var
 
-from assistant.utils import socket_no_proxy
-
-IS_INITIALIZED = False
+from assistant.server.worker import BatchingWorker
+from assistant.server.protocol import ContentType, Message
+
+
+class TranscriptionStream:
+    # 一个流式识别请求的状态: 已经确定的文本, 还没有确定的音频, 以及最近一次的中间结果
+    def __init__(self, sampling_rate: int, dtype: str, target_rate: int) -> None:
+        self.sampling_rate = sampling_rate
+        self.dtype = np.dtype(dtype)
+        self.target_rate = target_rate
+        self.audio = np.zeros(0, dtype=np.float32)
+        # 上一块末尾不足一个采样点的字节
+        self.remainder = b''
+        self.texts: List[str] = []
+        self.partial = ''
+        # 上次解码中间结果时未确定音频的长度
+        self.decoded = 0
+        self.language: Optional[str] = None
+        self.updated_at = time.monotonic()
+
+    @property
+    def text(self) -> str:
+        return ''.join(self.texts)
+
+    def append(self, audio: bytes) -> None:
+        data = self.remainder + audio
+        usable = len(data) - len(data) % self.dtype.itemsize
+        self.remainder = data[usable:]
+        samples = np.frombuffer(data[:usable], dtype=self.dtype).astype(np.float32)
+        if self.dtype.kind == 'i':
+            samples /= -np.iinfo(self.dtype).min
+        if self.sampling_rate != self.target_rate and len(samples):
+            length = int(round(len(samples) * self.target_rate / self.sampling_rate))
+            samples = np.interp(np.linspace(0, len(samples) - 1, length), np.arange(len(samples)),
+                                samples).astype(np.float32)
+        self.audio = np.concatenate([self.audio, samples])
+        self.updated_at = time.monotonic()
 
 
 class STT:
-    def __init__(self):
-        model_size = 'medium'
+    def __init__(self, model_size: str = 'medium'):
         self.device = global_var.device if torch.cuda.is_available() else 'cpu'
         self.model = WhisperModel(model_size)
+        self.streams: Dict[str, TranscriptionStream] = {}
+        # 语音段之后的静音超过 min_silence 认为这一段已经结束, 单个语音段不超过模型的30秒窗口
+        self.vad_options = VadOptions(min_silence_duration_ms=global_var.stt_stream_min_silence_ms,
+                                      max_speech_duration_s=self.model.feature_extractor.chunk_length)
 
     def transcribe(self, audio: bytes):
         segments, info = self.model.transcribe(BytesIO(audio))
         txt = ''.join([segment.text for segment in segments])
         return txt
 
+    def transcribe_batch(self, audios: List[bytes], beam_size: int = 5) -> List[str]:
+        # 不超过30秒的音频正好是模型的一个窗口, 拼成一个批次, 编码和解码各只调用一次模型;
+        # 更长的音频硬切块会截断边界上的词, 交给 transcribe 按时间戳逐窗口解码
+        feature_extractor = self.model.feature_extractor
+        texts = [''] * len(audios)
+        waveforms, owners = [], []
+        for i, audio in enumerate(audios):
+            waveform = decode_audio(BytesIO(audio), sampling_rate=feature_extractor.sampling_rate)
+            if len(waveform) > feature_extractor.n_samples:
+                segments, info = self.model.transcribe(waveform, beam_size=beam_size)
+                texts[i] = ''.join([segment.text for segment in segments])
+            else:
+                waveforms.append(waveform)
+                owners.append(i)
+        if not waveforms:
+            return texts
+
+        features = np.stack([pad_or_trim(feature_extractor(waveform)[..., :-1]) for waveform in waveforms])
+        encoder_output = self.model.encode(features)
+
+        if self.model.model.is_multilingual:
+            # 每段音频各自检测语言
+            languages = [result[0][0][2:-2] for result in self.model.model.detect_language(encoder_output)]
+        else:
+            languages = ['en'] * len(waveforms)
+        tokenizers = {
+            language: Tokenizer(self.model.hf_tokenizer, self.model.model.is_multilingual,
+                                task='transcribe', language=language)
+            for language in set(languages)
+        }
+        prompts = [self.model.get_prompt(tokenizers[language], [], without_timestamps=True)
+                   for language in languages]
+
+        results = self.model.model.generate(
+            encoder_output,
+            prompts,
+            beam_size=beam_size,
+            max_length=self.model.max_length,
+            suppress_blank=True,
+            suppress_tokens=[-1],
+        )
+
+        for owner, language, result in zip(owners, languages, results):
+            texts[owner] = tokenizers[language].decode(result.sequences_ids[0])
+        return texts
+
     def transcribe_from_file(self, file_name=''):
         assert file_name != '', ('transcribe_from_file needs file_name, '
                                  'which should be stored in text_speech/new_audios/')
@@ -34,55 +120,95 @@ class STT:
         txt = ''.join([segment.text for segment in segments])
         return txt
 
-    def stream_transcribe(self):
-        pass
-
-
-async def stt_client(stt):
-    global IS_INITIALIZED
-
-    async def send_and_recv():
-        global IS_INITIALIZED
-        async with websockets.connect(f'ws://{global_var.ip}:{global_var.port}/',
-                                      max_size=10 * 1024 * 1024) as websocket:
-            global_var.logger.info("STT启动")
-            while True:
-                if not IS_INITIALIZED:
-                    message = {
-                        'from': 'STT',
-                        'to': 'SERVER',
-                        'content': 'hello'
-                    }
-
-                    message = json.dumps(message)
-                    await websocket.send(message)
-
-                    response = await websocket.recv()
-                    global_var.logger.info(response)
-
-                    response = json.loads(response)
-
-                    if response['content'] == 'ok':
-                        IS_INITIALIZED = True
-                else:
-                    recv = await websocket.recv()
-                    global_var.logger.info(recv)
-
-                    recv = json.loads(recv)
-
-                    audio_bytes_base64_decoded = base64.b64decode(recv['content'].encode())
-                    text = stt.transcribe(audio_bytes_base64_decoded)
-
-                    message = {
-                        'from': 'STT',
-                        'to': 'CLIENT.STT',
-                        'content': text
-                    }
-                    message = json.dumps(message)
-                    await websocket.send(message)
-
-    if global_var.run_local_mode:
-        with socket_no_proxy():
-            await send_and_recv()
-    else:
-        await send_and_recv()
+    def decode_waveform(self, waveform: np.ndarray, stream: TranscriptionStream,
+                        beam_size: int) -> Tuple[str, str]:
+        # 已经确定的文本作为提示, 让前后语音段的用词和标点保持一致
+        segments, info = self.model.transcribe(
+            waveform,
+            language=stream.language,
+            beam_size=beam_size,
+            vad_filter=False,
+            without_timestamps=True,
+            condition_on_previous_text=False,
+            initial_prompt=stream.text[-200:] or None,
+        )
+        return ''.join([segment.text for segment in segments]), info.language
+
+    def commit(self, stream: TranscriptionStream, waveform: np.ndarray) -> None:
+        text, stream.language = self.decode_waveform(waveform, stream, beam_size=5)
+        stream.texts.append(text)
+        stream.partial = ''
+
+    def stream_transcribe(self, stream_id: str, audio: bytes, final: bool = False,
+                          meta: Optional[Dict] = None) -> Optional[str]:
+        # 流式识别: 每次传入新到达的一段PCM音频, 返回当前的识别结果, 没有变化时返回None
+        # 用VAD找出已经结束的语音段, 用beam search解码后确定下来, 之后不再重复解码;
+        # 还没有结束的语音段每隔一段时间用贪心解码一次, 作为中间结果接在已确定的文本后面
+        meta = meta or {}
+        sampling_rate = self.model.feature_extractor.sampling_rate
+        now = time.monotonic()
+        for key in [key for key, stream in self.streams.items()
+                    if now - stream.updated_at > global_var.stt_stream_timeout]:
+            del self.streams[key]
+
+        stream = self.streams.get(stream_id)
+        if stream is None:
+            stream = self.streams[stream_id] = TranscriptionStream(
+                meta.get('sampling_rate', sampling_rate), meta.get('dtype', 'int16'), sampling_rate
+            )
+        stream.append(audio)
+
+        segments = get_speech_timestamps(stream.audio, self.vad_options)
+        if final:
+            del self.streams[stream_id]
+            if segments:
+                self.commit(stream, stream.audio[segments[0]['start']:])
+            return stream.text
+
+        silence = global_var.stt_stream_min_silence_ms * sampling_rate // 1000
+        # 后面已经开始了新的语音段, 或者之后的静音足够长, 这些语音段已经结束
+        if segments and len(stream.audio) - segments[-1]['end'] < silence:
+            ended = segments[:-1]
+        else:
+            ended = segments
+
+        changed = False
+        if ended:
+            end = ended[-1]['end']
+            self.commit(stream, stream.audio[ended[0]['start']: end])
+            stream.audio = stream.audio[end:]
+            stream.decoded = 0
+            changed = True
+        elif not segments and len(stream.audio) > silence:
+            # 只有静音时丢弃前面的音频, 保留末尾一段避免截掉下一个语音段的开头
+            stream.audio = stream.audio[-silence:]
+            stream.decoded = 0
+
+        interval = int(global_var.stt_stream_partial_interval * sampling_rate)
+        if len(segments) > len(ended) and len(stream.audio) - stream.decoded >= interval:
+            stream.partial, _ = self.decode_waveform(stream.audio, stream, beam_size=1)
+            stream.decoded = len(stream.audio)
+            changed = True
+
+        return stream.text + stream.partial if changed else None
+
+    def cancel_stream(self, stream_id: str) -> None:
+        self.streams.pop(stream_id, None)
+
+
+async def stt_client(stt, max_batch_size: int = 1, max_wait_ms: float = 0, executor: str = 'thread'):
+    # 请求攒成批次后调用 transcribe_batch, executor为'process'时stt是创建STT的工厂函数
+    # 第一帧元数据中带有 stream 的请求边上传边识别, 调用 stream_transcribe 返回中间结果
+    worker = BatchingWorker(
+        'STT', stt, 'transcribe_batch',
+        decode=lambda request: request.payload,
+        encode=lambda request, text: Message('STT', request.sender, request.request_id,
+                                             ContentType.text, text.encode('utf-8')),
+        max_batch_size=max_batch_size,
+        max_wait_ms=max_wait_ms,
+        executor=executor,
+        stream_method='stream_transcribe',
+        stream_cancel_method='cancel_stream',
+        stream_timeout=global_var.stt_stream_timeout,
+    )
+    await worker.run()
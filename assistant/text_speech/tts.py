@@ -1,23 +1,16 @@
 import os
 import io
-import json
-import base64
-import asyncio
-import websockets
 
+from typing import List
 from scipy.io.wavfile import write
 from transformers import AutoProcessor, AutoModel
 
-import global_var
-
-from assistant.utils import socket_no_proxy
-
-IS_INITIALIZED = False
+from assistant.server.worker import BatchingWorker
+from assistant.server.protocol import ContentType, Message
 
 
 class TTS:
-    def __init__(self):
-        model_name = "suno/bark-small"
+    def __init__(self, model_name: str = "suno/bark-small"):
         self.processor = AutoProcessor.from_pretrained(model_name)
         self.model = AutoModel.from_pretrained(model_name)
 
@@ -35,54 +28,34 @@ class TTS:
 
         return speech_values, sampling_rate
 
+    def transcribe_batch(self, txts: List[str]) -> List[tuple]:
+        # 一个批次的文本一起生成, 批内音频补齐到最长的长度, 按每条的实际长度截断
+        inputs = self.processor(
+            text=txts,
+            return_tensors="pt",
+        )
+
+        speech_values, lengths = self.model.generate(**inputs, do_sample=True, return_output_lengths=True)
+        speech_values = speech_values.cpu().numpy()
 
-async def tts_client(tts):
-    global IS_INITIALIZED
-
-    async def send_and_recv():
-        global IS_INITIALIZED
-        async with websockets.connect(f'ws://{global_var.ip}:{global_var.port}/',
-                                      max_size=10 * 1024 * 1024) as websocket:
-            global_var.logger.info("TTS启动")
-            while True:
-                if not IS_INITIALIZED:
-                    message = {
-                        'from': 'TTS',
-                        'to': 'SERVER',
-                        'content': 'hello'
-                    }
-                    message = json.dumps(message)
-                    await websocket.send(message)
-
-                    response = await websocket.recv()
-                    global_var.logger.info(response)
-
-                    response = json.loads(response)
-
-                    if response['content'] == 'ok':
-                        IS_INITIALIZED = True
-                else:
-                    recv = await websocket.recv()
-                    global_var.logger.info(recv)
-
-                    recv = json.loads(recv)
-
-                    speech_value, sampling_rate = tts.transcribe(recv['content'])
-                    speech_value = base64.b64encode(speech_value).decode()
-
-                    message = {
-                        'from': 'TTS',
-                        'to': 'CLIENT.TTS',
-                        'content': {
-                            'speech_value': speech_value,
-                            'sampling_rate': sampling_rate,
-                        }
-                    }
-                    message = json.dumps(message)
-                    await websocket.send(message)
-
-    if global_var.run_local_mode:
-        with socket_no_proxy():
-            await send_and_recv()
-    else:
-        await send_and_recv()
\ No newline at end of file
+        sampling_rate = self.model.generation_config.sample_rate
+
+        return [(speech_value[:length], sampling_rate) for speech_value, length in zip(speech_values, lengths.tolist())]
+
+
+async def tts_client(tts, max_batch_size: int = 1, max_wait_ms: float = 0, executor: str = 'thread'):
+    def decode(request: Message) -> str:
+        txt = request.text()
+        assert txt != '', 'txt should not been empty'
+        return txt
+
+    def encode(request: Message, output) -> Message:
+        speech_value, sampling_rate = output
+        # 音频采样点的原始字节直接作为负载, 采样率和数据类型放在元数据中
+        return Message('TTS', request.sender, request.request_id, ContentType.audio,
+                       speech_value.tobytes(),
+                       {'sampling_rate': int(sampling_rate), 'dtype': str(speech_value.dtype)})
+
+    worker = BatchingWorker('TTS', tts, 'transcribe_batch', decode, encode,
+                            max_batch_size=max_batch_size, max_wait_ms=max_wait_ms, executor=executor)
+    await worker.run()
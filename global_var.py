@@ -114,4 +114,37 @@ if run_local_mode:
 else:
     ip = '45.76.66.110'
     port = 9999
+
+# 单个websocket帧的最大字节数
+ws_max_size = 10 * 1024 * 1024
+
+# 二进制负载超过这个大小时分块发送, 每块不超过该大小
+ws_chunk_size = 1024 * 1024
+
+# 服务器中每个worker实例的请求队列长度, 队列满时等待的最长秒数, 超时后回复繁忙
+switcher_max_queue = 32
+switcher_queue_timeout = 30
+
+# 服务器定期输出各服务队列状态的间隔秒数, 0表示不输出
+switcher_stats_interval = 60
+
+# 推理服务的微批处理设置: 每批最多的请求数, 收到第一个请求后最多等待的毫秒数
+# 可以在main.py中用 --STT-batch-size, --STT-max-wait-ms 等参数覆盖
+worker_batching = {
+    'STT': {'max_batch_size': 8, 'max_wait_ms': 20},
+    'ITT': {'max_batch_size': 8, 'max_wait_ms': 20},
+    'TTS': {'max_batch_size': 4, 'max_wait_ms': 50},
+}
+
+# 推理在哪种执行器中运行: 'thread' 或 'process'
+worker_executor = 'thread'
+
+# 流式语音识别: 语音段之后静音超过该毫秒数认为这一段已经结束
+stt_stream_min_silence_ms = 500
+
+# 未结束的语音段每新增多少秒音频解码一次中间结果
+stt_stream_partial_interval = 1.0
+
+# 超过该秒数没有收到新音频的流式识别请求被丢弃
+stt_stream_timeout = 120
 ############################################################################
@@ -41,17 +41,32 @@ async def main():
     parser.add_argument('--TTI', action='store_true', help='启动TTI(text to image)服务')
     parser.add_argument('--TTV', action='store_true', help='启动TTV(text to video)服务')
     parser.add_argument('--Server', action='store_true', help='启动Websockets服务器')
+    for service, batching in global_var.worker_batching.items():
+        parser.add_argument(f'--{service}-batch-size', type=int, default=batching['max_batch_size'],
+                            help=f'{service}每批最多处理的请求数')
+        parser.add_argument(f'--{service}-max-wait-ms', type=float, default=batching['max_wait_ms'],
+                            help=f'{service}收到第一个请求后等待凑批的最长毫秒数')
+    parser.add_argument('--executor', choices=['thread', 'process'], default=global_var.worker_executor,
+                        help='STT, ITT, TTS的推理在线程还是子进程中运行')
     args = parser.parse_args()
 
+    def batching_client(service, model_class, client):
+        # 子进程执行器在子进程中加载模型, 这里只传入模型的类
+        model = model_class if args.executor == 'process' else model_class()
+        return client(model,
+                      max_batch_size=getattr(args, f'{service}_batch_size'),
+                      max_wait_ms=getattr(args, f'{service}_max_wait_ms'),
+                      executor=args.executor)
+
     tasks = []
     if args.TTS:
-        tasks.append(tts_client(TTS()))
+        tasks.append(batching_client('TTS', TTS, tts_client))
     if args.STT:
-        tasks.append(stt_client(STT()))
+        tasks.append(batching_client('STT', STT, stt_client))
     if args.ITI:
         tasks.append(iti_client(ITI()))
     if args.ITT:
-        tasks.append(itt_client(ITT()))
+        tasks.append(batching_client('ITT', ITT, itt_client))
     if args.TTI:
         tasks.append(tti_client(TTI()))
     if args.TTV:
@@ -126,29 +126,31 @@ class DocMergePrompter(prompter.Prompter):
         if len(state_dicts[0]["parts"]) > 0 and len(state_dicts[0]['parts']) < len(
             state_dicts[0]['documents']
         ):
-            prompt = self.aggregate_sub_prompt_base.format(num_ndas=len(state_dicts),)
+            prefix = self.aggregate_sub_prompt_base.format(num_ndas=len(state_dicts),)
+            suffix = ''
             for i, state_dict in enumerate(state_dicts):
-                prompt += self.aggregate_sub_prompt_generate.format(
+                suffix += self.aggregate_sub_prompt_generate.format(
                     nda=state_dict['current'], num=i + 1
                 )
-            return prompt
+            return self.assemble(prefix, suffix)
         else:
-            prompt = self.aggregate_full_prompt_base.format(
+            prefix = self.aggregate_full_prompt_base.format(
                 num_ndas=len(state_dicts[0]["documents"]),
                 num_ndas_summary=len(state_dicts),
             )
             for i, document in enumerate(state_dicts[0]['documents']):
-                prompt += self.aggregate_full_prompt_block1.format(
+                prefix += self.aggregate_full_prompt_block1.format(
                     document=document, num=i + 1
                 )
-            prompt += self.aggregate_full_prompt_mid.format(
+            prefix += self.aggregate_full_prompt_mid.format(
                 num_ndas_summary=len(state_dicts),
             )
+            suffix = ''
             for i, state_dict in enumerate(state_dicts):
-                prompt += self.aggregate_full_prompt_block2.format(
+                suffix += self.aggregate_full_prompt_block2.format(
                     summary=state_dict['current'], num=i + 1
                 )
-            return prompt
+            return self.assemble(prefix, suffix)
 
     def generate_prompt(
             self,
@@ -170,7 +172,7 @@ class DocMergePrompter(prompter.Prompter):
                 prompt += self.merge_doc_prompt_block.format(
                     document=document, num=i + 1
                 )
-            return prompt
+            return self.assemble(prompt)
         elif method.startswith('tot'):
             if current is None or current == "":
                 prompt += self.merge_doc_prompt_start.format(num=len(documents))
@@ -178,7 +180,7 @@ class DocMergePrompter(prompter.Prompter):
                     prompt += self.merge_doc_prompt_block.format(
                         document=document, num=i + 1
                     )
-                return prompt
+                return self.assemble(prompt)
             else:
                 prompt += self.improve_summary_prompt_start.format(
                     num=len(documents),
@@ -187,8 +189,7 @@ class DocMergePrompter(prompter.Prompter):
                     prompt += self.improve_summary_prompt_block.format(
                         document=document, num=i + 1
                     )
-                prompt += self.improve_summary_prompt_end.format(summary=current)
-                return prompt
+                return self.assemble(prompt, self.improve_summary_prompt_end.format(summary=current))
         elif method.startswith('got'):
             parts = (
                 sorted(list(parts)) if len(parts) > 0 else list(range(len(documents)))
@@ -199,7 +200,7 @@ class DocMergePrompter(prompter.Prompter):
                     prompt += self.merge_doc_prompt_block.format(
                         document=documents[part], num=i + 1
                     )
-                return prompt
+                return self.assemble(prompt)
             else:
                 prompt += self.improve_summary_prompt_start.format(
                     num=len(parts),
@@ -208,8 +209,7 @@ class DocMergePrompter(prompter.Prompter):
                     prompt += self.improve_summary_prompt_block.format(
                         document=documents[part], num=i + 1
                     )
-                prompt += self.improve_summary_prompt_end.format(summary=current)
-                return prompt
+                return self.assemble(prompt, self.improve_summary_prompt_end.format(summary=current))
         else:
             assert False, "Not implemented yet."
 
@@ -234,10 +234,11 @@ class DocMergePrompter(prompter.Prompter):
             )
             for i, part in enumerate(parts):
                 prompt += self.score_prompt_block.format(document=part, num=i + 1)
-            prompt += self.score_prompt_end.format(
-                summary=state_dicts[0]['current'],
+            # 说明和原始文档对同一问题的所有思维都相同, 作为前缀复用; 待打分的摘要作为后缀
+            return self.assemble(
+                prompt,
+                self.score_prompt_end.format(summary=state_dicts[0]['current']),
             )
-            return prompt
 
     def improve_prompt(
             self,
@@ -599,6 +600,7 @@ def run(
                 executor.run()
             except Exception as e:
                 logging.error(f"Exception: {e}")
+            logging.info(f"Prompt cache: {executor.prompt_cache_stats()}")
             path = os.path.join(
                 results_folder,
                 method.__name__,
@@ -0,0 +1,75 @@
+# 比较Llama2HF逐条采样与批量生成(单次prefill + 前缀KV复用)的耗时, CPU上可以使用很小的模型
+# python benchmark_llama_hf.py --model hf-internal-testing/tiny-random-LlamaForCausalLM --num-prompts 16 --num-responses 4
+import json
+import time
+import argparse
+import tempfile
+
+import torch
+
+from assistant.llm.llamachat_hf import Llama2HF
+
+
+def load_model(model, max_tokens, batch_size, reuse_prefix_cache):
+    config = {
+        "llama-bench": {
+            "model_id": model.split("/")[-1],
+            "hf_model_id": model,
+            "device": "cpu",
+            "prompt_token_cost": 0.0,
+            "response_token_cost": 0.0,
+            "temperature": 0.6,
+            "top_k": 10,
+            "max_tokens": max_tokens,
+            "batch_size": batch_size,
+            "reuse_prefix_cache": reuse_prefix_cache,
+        }
+    }
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as file:
+        json.dump(config, file)
+    return Llama2HF(file.name, "llama-bench")
+
+
+def sequential(lm, queries, num_responses):
+    # 原实现: 每个提示的每个样本单独编码并完整生成一次
+    for query in queries:
+        for _ in range(num_responses):
+            inputs = lm.tokenizer(lm.system_prompt + lm.format_prompt(query), return_tensors="pt")
+            with torch.inference_mode():
+                lm.model.generate(
+                    **inputs,
+                    do_sample=True,
+                    temperature=lm.temperature,
+                    top_k=lm.top_k,
+                    num_return_sequences=1,
+                    max_length=lm.max_tokens,
+                    pad_token_id=lm.tokenizer.pad_token_id,
+                )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Llama2HF batched generation benchmark")
+    parser.add_argument("--model", default="hf-internal-testing/tiny-random-LlamaForCausalLM")
+    parser.add_argument("--num-prompts", type=int, default=16)
+    parser.add_argument("--num-responses", type=int, default=4)
+    parser.add_argument("--max-tokens", type=int, default=128)
+    parser.add_argument("--batch-size", type=int, default=8)
+    args = parser.parse_args()
+
+    queries = [f"Sort the following list of numbers: {list(range(i, i + 8))}" for i in range(args.num_prompts)]
+    lm = load_model(args.model, args.max_tokens, args.batch_size, reuse_prefix_cache=False)
+
+    start = time.perf_counter()
+    sequential(lm, queries, args.num_responses)
+    print(f"{'sequential':<28}{time.perf_counter() - start:>10.2f}s")
+
+    for reuse_prefix_cache in [False, True]:
+        lm.reuse_prefix_cache = reuse_prefix_cache
+        start = time.perf_counter()
+        lm.generate(queries, args.num_responses)
+        name = "batched" + (" + prefix cache" if reuse_prefix_cache else "")
+        print(f"{name:<28}{time.perf_counter() - start:>10.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# 用本地的模拟OpenAI服务测试异步批量摘要和问答, 不需要网络和API key
+# 覆盖: 并发请求的结果顺序, 请求失败后tenacity重试, 以及连续两次 run_sync (每次新的事件循环)
+# 在主目录下运行: python test/llm/test_openai_mock_server.py
+import os
+import sys
+import json
+import types
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, ROOT)
+
+
+def stub_llm_package() -> None:
+    # assistant.llm 的 __init__ 会导入需要登录的聊天接口(HuggingChat等), 这里只注册一个空的包,
+    # 直接导入用到的子模块; 只在作为脚本运行时调用, 避免影响同一进程中的其他模块
+    if 'assistant.llm' not in sys.modules:
+        llm_package = types.ModuleType('assistant.llm')
+        llm_package.__path__ = [os.path.join(ROOT, 'assistant', 'llm')]
+        sys.modules['assistant.llm'] = llm_package
+
+
+class MockOpenAIServer:
+    # 回复OpenAI格式的chat.completions, 前 fail_first 个请求返回400, 用于触发重试
+    def __init__(self, fail_first: int = 0) -> None:
+        self.requests = []
+        self.fail_first = fail_first
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                with server.lock:
+                    server.requests.append(body)
+                    failed = len(server.requests) <= server.fail_first
+                if failed:
+                    return self.reply(400, {'error': {'message': 'mock failure', 'type': 'invalid_request_error'}})
+                # 回答中带上用户消息, 用于检查结果和输入的对应关系
+                content = 'answer: ' + body['messages'][-1]['content']
+                self.reply(200, {
+                    'id': 'mock', 'object': 'chat.completion', 'created': 0, 'model': body['model'],
+                    'choices': [{'index': 0, 'finish_reason': 'stop',
+                                 'message': {'role': 'assistant', 'content': content}}],
+                    'usage': {'prompt_tokens': 1, 'completion_tokens': 1, 'total_tokens': 2},
+                })
+
+            def reply(self, status, payload):
+                data = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.base_url = f'http://127.0.0.1:{self.server.server_address[1]}/v1'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def check_summarize_batch(server: MockOpenAIServer) -> None:
+    from assistant.llm.summarization_models import GPT3TurboSummarization
+    from assistant.memory.raptor.utils import run_sync
+
+    model = GPT3TurboSummarization('mock-summarization', api_key='test', base_url=server.base_url,
+                                   max_concurrency=4)
+    contexts = [f'document {i}' for i in range(8)]
+    # 两次 run_sync 各自使用新的事件循环, 异步客户端不能跨事件循环复用
+    for _ in range(2):
+        summaries = run_sync(model.asummarize_batch(contexts))
+        assert all(isinstance(summary, str) for summary in summaries), summaries
+        assert all(context in summary for context, summary in zip(contexts, summaries)), summaries
+
+
+def check_answer_questions(server: MockOpenAIServer) -> None:
+    from assistant.llm.qa_model import GPT3TurboQAModel
+    from assistant.memory.raptor.utils import run_sync
+
+    model = GPT3TurboQAModel('mock-qa', api_key='test', base_url=server.base_url, max_concurrency=4)
+    contexts = [f'context {i}' for i in range(6)]
+    questions = [f'question {i}' for i in range(6)]
+    for _ in range(2):
+        answers = run_sync(model.aanswer_questions(contexts, questions))
+        assert all(isinstance(answer, str) for answer in answers), answers
+        assert all(
+            context in answer and question in answer
+            for context, question, answer in zip(contexts, questions, answers)
+        ), answers
+
+
+def main():
+    stub_llm_package()
+    # 前两个请求失败, 对应的摘要在重试后成功
+    server = MockOpenAIServer(fail_first=2)
+    try:
+        check_summarize_batch(server)
+        check_answer_questions(server)
+        assert len(server.requests) == 2 * 8 + 2 * 6 + 2, len(server.requests)
+    finally:
+        server.close()
+    print('ok')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# 在合成embedding上测试RAPTOR单层聚类耗时
+# python benchmark_clustering.py --sizes 10000 50000 100000 --dim 256
+import time
+import argparse
+
+import numpy as np
+
+from assistant.memory.raptor.tree_structures import Node
+from assistant.memory.raptor.cluster_utils import RaptorClustering, labels_to_membership, cluster_members
+
+
+def synthetic_embeddings(num_nodes, dim, num_centers, seed=224):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(num_centers, dim))
+    assignments = rng.integers(0, num_centers, size=num_nodes)
+    embeddings = centers[assignments] + rng.normal(size=(num_nodes, dim))
+    return embeddings.astype(np.float32)
+
+
+def legacy_reassignment(embeddings, local_clusters_embeddings):
+    # 旧实现: 通过逐元素比较把局部聚类映射回全局下标
+    for local_cluster_embeddings in local_clusters_embeddings:
+        np.where((embeddings == local_cluster_embeddings[:, None]).all(-1))[1]
+
+
+def index_reassignment(global_indices, local_labels, n_local_clusters):
+    membership = labels_to_membership(local_labels, n_local_clusters)
+    for cluster in range(n_local_clusters):
+        global_indices[cluster_members(membership, cluster)]
+
+
+def benchmark_reassignment(embeddings, num_clusters, seed=224):
+    rng = np.random.default_rng(seed)
+    local_labels = [np.array([label]) for label in rng.integers(0, num_clusters, size=len(embeddings))]
+    global_indices = np.arange(len(embeddings))
+
+    start = time.perf_counter()
+    index_reassignment(global_indices, local_labels, num_clusters)
+    index_time = time.perf_counter() - start
+
+    # 旧实现会分配 N x M x D 的布尔张量, 规模过大时跳过
+    legacy_time = None
+    if len(embeddings) * (len(embeddings) / num_clusters) * embeddings.shape[1] <= 2e9:
+        labels = np.concatenate(local_labels)
+        local_clusters_embeddings = [embeddings[labels == cluster] for cluster in range(num_clusters)]
+        start = time.perf_counter()
+        legacy_reassignment(embeddings, local_clusters_embeddings)
+        legacy_time = time.perf_counter() - start
+
+    return index_time, legacy_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RAPTOR clustering benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 50_000, 100_000])
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--centers", type=int, default=64)
+    parser.add_argument("--reduction-dimension", type=int, default=10)
+    parser.add_argument("--reassignment-only", action="store_true")
+    args = parser.parse_args()
+
+    for num_nodes in args.sizes:
+        embeddings = synthetic_embeddings(num_nodes, args.dim, args.centers)
+
+        index_time, legacy_time = benchmark_reassignment(embeddings, args.centers)
+        legacy = f"{legacy_time:.3f}s" if legacy_time is not None else "skipped"
+        print(f"[{num_nodes} nodes] reassignment: index arrays {index_time:.3f}s, legacy {legacy}")
+
+        if args.reassignment_only:
+            continue
+
+        nodes = [
+            Node("", index, set(), {"synthetic": embedding})
+            for index, embedding in enumerate(embeddings)
+        ]
+        start = time.perf_counter()
+        clusters = RaptorClustering.perform_clustering(
+            nodes,
+            "synthetic",
+            max_length_in_cluster=float("inf"),
+            reduction_dimension=args.reduction_dimension,
+        )
+        layer_time = time.perf_counter() - start
+        print(
+            f"[{num_nodes} nodes] layer clustering: {layer_time:.1f}s, {len(clusters)} clusters"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# 比较不同faiss索引相对精确检索(flat)的召回率与延迟
+# python benchmark_faiss.py --num-vectors 100000 --dim 256 --num-queries 1000
+import time
+import argparse
+
+import numpy as np
+
+from assistant.memory.raptor.faiss_retriever import create_index, train_index, set_search_params
+
+
+def synthetic_embeddings(num_vectors, dim, num_centers=256, seed=224):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(num_centers, dim))
+    embeddings = centers[rng.integers(0, num_centers, size=num_vectors)] + rng.normal(size=(num_vectors, dim))
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings.astype(np.float32)
+
+
+def recall_at_k(indices, ground_truth):
+    hits = sum(len(set(row) & set(truth)) for row, truth in zip(indices, ground_truth))
+    return hits / ground_truth.size
+
+
+def benchmark(index_type, embeddings, queries, top_k, ground_truth=None, **params):
+    search_params = {key: params.pop(key) for key in ["nprobe", "ef_search"] if key in params}
+
+    start = time.perf_counter()
+    index = create_index(embeddings.shape[1], len(embeddings), index_type, **params)
+    train_index(index, embeddings)
+    index.add(embeddings)
+    build_time = time.perf_counter() - start
+
+    set_search_params(index, **search_params)
+    start = time.perf_counter()
+    _, indices = index.search(queries, top_k)
+    search_time = time.perf_counter() - start
+
+    recall = recall_at_k(indices, ground_truth) if ground_truth is not None else 1.0
+    return indices, build_time, search_time, recall
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Faiss index recall/latency benchmark")
+    parser.add_argument("--num-vectors", type=int, default=100_000)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--num-queries", type=int, default=1000)
+    parser.add_argument("--top-k", type=int, default=10)
+    args = parser.parse_args()
+
+    embeddings = synthetic_embeddings(args.num_vectors, args.dim)
+    queries = synthetic_embeddings(args.num_queries, args.dim, seed=7)
+
+    ground_truth, build_time, search_time, _ = benchmark("flat", embeddings, queries, args.top_k)
+    print(f"{'index':<28}{'build (s)':>12}{'ms/query':>12}{'recall@' + str(args.top_k):>12}")
+    print(f"{'flat':<28}{build_time:>12.2f}{1000 * search_time / len(queries):>12.3f}{1.0:>12.3f}")
+
+    configurations = [
+        ("ivf_flat", {"nprobe": 1}),
+        ("ivf_flat", {"nprobe": 8}),
+        ("ivf_flat", {"nprobe": 32}),
+        ("ivf_pq", {"nprobe": 8, "pq_m": 32}),
+        ("ivf_pq", {"nprobe": 32, "pq_m": 32}),
+        ("hnsw", {"ef_search": 16}),
+        ("hnsw", {"ef_search": 64}),
+        ("hnsw", {"ef_search": 256}),
+    ]
+    for index_type, params in configurations:
+        name = index_type + " " + ",".join(f"{key}={value}" for key, value in params.items())
+        _, build_time, search_time, recall = benchmark(
+            index_type, embeddings, queries, args.top_k, ground_truth, **dict(params)
+        )
+        print(f"{name:<28}{build_time:>12.2f}{1000 * search_time / len(queries):>12.3f}{recall:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
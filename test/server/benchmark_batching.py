@@ -0,0 +1,106 @@
+# 在CPU上比较推理服务逐个处理和微批处理的吞吐量
+# 本地启动Server和一个BatchingWorker, 客户端并发发送请求, 依次测试不同的批大小
+# python benchmark_batching.py --service STT --model tiny --requests 32 --batch-sizes 1 4 8
+# python benchmark_batching.py --service ITT --model base_coco
+# python benchmark_batching.py --service TTS --model suno/bark-small --requests 8 --batch-sizes 1 4
+import io
+import time
+import asyncio
+import argparse
+
+import numpy as np
+import websockets
+
+from scipy.io.wavfile import write
+
+import global_var
+
+from assistant.server.protocol import ContentType, Message
+from assistant.server.session import SwitcherSession
+from assistant.server.switcher_server import Switcher
+from assistant.server.worker import BatchingWorker
+
+
+def make_inputs(service, count):
+    rng = np.random.default_rng(0)
+    if service == 'STT':
+        # 几秒钟的正弦波加噪声, 时长不同
+        payloads = []
+        for i in range(count):
+            t = np.arange(16000 * (2 + i % 4)) / 16000
+            wave = 0.3 * np.sin(2 * np.pi * (220 + 20 * i) * t) + 0.05 * rng.standard_normal(len(t))
+            buffer = io.BytesIO()
+            write(buffer, 16000, (wave * 32767).astype(np.int16))
+            payloads.append(buffer.getvalue())
+        return ContentType.audio, payloads
+    if service == 'ITT':
+        from PIL import Image
+        payloads = []
+        for _ in range(count):
+            buffer = io.BytesIO()
+            Image.fromarray(rng.integers(0, 255, (256, 256, 3), dtype=np.uint8)).save(buffer, format='PNG')
+            payloads.append(buffer.getvalue())
+        return ContentType.image, payloads
+    sentences = ['Hello, how are you today?', 'The weather is nice.', 'Please open the door.', 'I like music.']
+    return ContentType.text, [sentences[i % len(sentences)].encode('utf-8') for i in range(count)]
+
+
+def load_model(service, model):
+    if service == 'STT':
+        from assistant.text_speech.stt import STT
+        return STT(model or 'tiny'), 'transcribe_batch'
+    if service == 'ITT':
+        from assistant.text_image_video.itt import ITT
+        return ITT(model or 'base_coco'), 'captioning_images'
+    from assistant.text_speech.tts import TTS
+    return TTS(model or 'suno/bark-small'), 'transcribe_batch'
+
+
+async def measure(service, model, method, batch_size, max_wait_ms, content_type, payloads):
+    # 只比较推理吞吐量, 回复中不带推理结果
+    worker = BatchingWorker(service, model, method,
+                            decode=lambda request: request.payload if service != 'TTS' else request.text(),
+                            encode=lambda request, output: Message(service, request.sender, request.request_id,
+                                                                   ContentType.text, b'ok'),
+                            max_batch_size=batch_size, max_wait_ms=max_wait_ms)
+    task = asyncio.create_task(worker.run())
+    await asyncio.sleep(0.2)
+
+    session = SwitcherSession()
+    start = time.perf_counter()
+    await session.request_many(service, content_type, payloads)
+    total = time.perf_counter() - start
+    await session.close()
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+    print(f"batch size {batch_size:>3}  {total:>8.2f}s  {len(payloads) / total:>7.2f} req/s  "
+          f"mean batch {worker.processed / max(worker.batches, 1):.2f}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Micro-batching throughput benchmark")
+    parser.add_argument('--service', choices=['STT', 'ITT', 'TTS'], default='STT')
+    parser.add_argument('--model', default=None, help='STT: whisper大小或路径, ITT: BLIP的model_type, TTS: Bark模型名')
+    parser.add_argument('--port', type=int, default=19998)
+    parser.add_argument('--requests', type=int, default=32)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--max-wait-ms', type=float, default=20)
+    args = parser.parse_args()
+
+    global_var.ip, global_var.port = '127.0.0.1', args.port
+    global_var.device = 'cpu'
+    switcher = Switcher()
+    server = await websockets.serve(switcher.handler, '127.0.0.1', args.port,
+                                    max_size=global_var.ws_max_size, compression=None)
+
+    model, method = load_model(args.service, args.model)
+    content_type, payloads = make_inputs(args.service, args.requests)
+    for batch_size in args.batch_sizes:
+        await measure(args.service, model, method, batch_size, args.max_wait_ms, content_type, payloads)
+
+    server.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,92 @@
+# 比较chatbot媒体请求的两种方式: 每次调用新建连接并逐个等待回复, 与共享的长连接会话流水线发送
+# 本地启动一个Server和模拟推理耗时的echo worker, 不需要加载任何模型
+# python benchmark_session.py --calls 50 --files 4 --size 200000 --delay 0.02
+import time
+import asyncio
+import argparse
+import statistics
+
+import websockets
+
+import global_var
+
+from assistant.server.protocol import (ContentType, Message, MessageAssembler, encode_frame, next_request_id,
+                                       recv_message, send_message)
+from assistant.server.session import SwitcherSession
+from assistant.server.switcher_server import Switcher
+
+
+async def echo_worker(uri, delay, max_in_flight):
+    # 模拟STT worker: 等待 delay 秒后返回负载长度
+    async with websockets.connect(uri, max_size=global_var.ws_max_size, compression=None) as websocket:
+        await websocket.send(encode_frame('STT', 'SERVER', 0, ContentType.text, b'hello',
+                                          {'max_in_flight': max_in_flight}))
+        await websocket.recv()
+        assembler = MessageAssembler()
+
+        async def handle(request):
+            await asyncio.sleep(delay)
+            await send_message(websocket, Message('STT', request.sender, request.request_id, ContentType.text,
+                                                  str(len(request.payload)).encode('utf-8')))
+
+        while True:
+            request = await recv_message(websocket, assembler)
+            asyncio.create_task(handle(request))
+
+
+async def per_call_connection(uri, files):
+    # 原实现: 每次调用新建连接, 文件逐个发送并等待回复
+    async with websockets.connect(uri, max_size=global_var.ws_max_size, compression=None) as websocket:
+        assembler = MessageAssembler()
+        for file in files:
+            await send_message(websocket, Message('CLIENT.STT', 'STT', next_request_id(), ContentType.audio, file))
+            await recv_message(websocket, assembler)
+
+
+async def pooled_session(session, files):
+    await session.request_many('STT', ContentType.audio, files)
+
+
+async def measure(name, call, calls):
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(calls):
+        call_start = time.perf_counter()
+        await call()
+        latencies.append(time.perf_counter() - call_start)
+    total = time.perf_counter() - start
+    latencies.sort()
+    print(f"{name:<28}{total:>8.2f}s  mean {statistics.fmean(latencies) * 1000:>7.1f}ms  "
+          f"p95 {latencies[int(len(latencies) * 0.95) - 1] * 1000:>7.1f}ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Switcher session latency benchmark")
+    parser.add_argument('--port', type=int, default=19999)
+    parser.add_argument('--calls', type=int, default=50)
+    parser.add_argument('--files', type=int, default=4)
+    parser.add_argument('--size', type=int, default=200_000)
+    parser.add_argument('--delay', type=float, default=0.02)
+    parser.add_argument('--max-in-flight', type=int, default=4)
+    args = parser.parse_args()
+
+    uri = f'ws://127.0.0.1:{args.port}/'
+    switcher = Switcher()
+    server = await websockets.serve(switcher.handler, '127.0.0.1', args.port,
+                                    max_size=global_var.ws_max_size, compression=None)
+    worker = asyncio.create_task(echo_worker(uri, args.delay, args.max_in_flight))
+    await asyncio.sleep(0.2)
+
+    files = [bytes(args.size) for _ in range(args.files)]
+    await measure('per-call connection', lambda: per_call_connection(uri, files), args.calls)
+
+    session = SwitcherSession(uri)
+    await measure('pooled session + pipelining', lambda: pooled_session(session, files), args.calls)
+    await session.close()
+
+    worker.cancel()
+    server.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())